@@ -0,0 +1,262 @@
+"""demo2 播放列表解析和片段接收的基准测试
+
+用合成的1千~10万个片段的播放列表测量：
+- parse: parse_m3u8 解析（含片段地址拼接）
+- tasks: build_download_tasks 构建下载任务列表
+- resolve: resolve_playlist(verbose=False) 从本地HTTP服务获取并解析（不访问外网）
+- verbose: resolve_playlist(verbose=True) 的控制台输出开销（输出重定向到内存）
+
+--receive 时改为测量片段接收路径：从本地HTTP服务下载一个大TS片段，
+对比旧的 iter_content(8192) 逐块写入（baseline）与池化缓冲区 + 合并写入（各缓冲区大小），
+输出吞吐量（MB/s）和每核吞吐量（MB/CPU秒，只统计下载线程的CPU时间）。
+
+用法:
+    python bench_demo2.py                      # 默认规模 1000 10000 100000
+    python bench_demo2.py --sizes 1000 20000   # 指定规模
+    python bench_demo2.py --check              # 单个片段的耗时随规模增长超过阈值时返回非0（用于回归检查）
+    python bench_demo2.py --receive            # 片段接收吞吐量（默认64MB片段，缓冲区 256K 1M 4M）
+    python bench_demo2.py --receive --segment-size 256M --buffer-sizes 1M 8M
+"""
+import argparse
+import contextlib
+import http.server
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import demo2_core as demo2
+
+PLAYLIST_KINDS = ('relative', 'signed', 'absolute', 'byterange', 'encrypted')
+
+
+def generate_playlist(count, kind='signed'):
+    """生成包含count个片段的合成播放列表"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:10', '#EXT-X-MEDIA-SEQUENCE:0']
+    for i in range(count):
+        if kind == 'encrypted' and i % 100 == 0:
+            lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="key{i // 100}.key",IV=0x{i:032x}')
+        lines.append('#EXTINF:4.000,')
+        if kind == 'relative':
+            lines.append(f'seg{i:06d}.ts')
+        elif kind == 'signed':
+            lines.append(f'hls/seg{i:06d}.ts?auth_key=1700000000-0-0-{i:032x}')
+        elif kind == 'absolute':
+            lines.append(f'https://cdn{i % 4}.example.com/v/abc/seg{i:06d}.ts?sign={i:x}&t=1700000000')
+        elif kind == 'byterange':
+            lines.append('#EXT-X-BYTERANGE:1048576')
+            lines.append('video.ts')
+        else:
+            lines.append(f'seg{i:06d}.ts')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def best_of(repeat, func, *args):
+    """执行repeat次，返回最短耗时（秒）和最后一次的结果"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+class _PlaylistHandler(http.server.BaseHTTPRequestHandler):
+    """本地HTTP服务：按路径返回预先生成的播放列表或片段"""
+    playlists = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.playlists.get(self.path.split('?', 1)[0])
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        content_type = 'video/mp2t' if self.path.endswith('.ts') else 'application/vnd.apple.mpegurl'
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server():
+    """启动本地HTTP服务，返回 (服务器, 基础地址)"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _PlaylistHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def run_benchmarks(sizes, kinds, repeat):
+    """执行所有基准测试，返回 [{"kind", "size", "stage", "seconds", "us_per_segment"}]"""
+    server, base_url = start_server()
+    scratch_dir = tempfile.mkdtemp(prefix='bench_demo2_')
+    results = []
+    try:
+        for kind in kinds:
+            for size in sizes:
+                data = generate_playlist(size, kind)
+                path = f'/{kind}/{size}/index.m3u8'
+                url = base_url + path
+                _PlaylistHandler.playlists[path] = data.encode()
+                # 规模越大重复次数越少，控制总耗时
+                rounds = max(1, repeat if size <= 10000 else repeat // 3)
+
+                stages = {}
+                stages['parse'], parsed = best_of(rounds, demo2.parse_m3u8, data, url)
+                playlist = {'segments': parsed['segments'], 'container': parsed['container']}
+                stages['tasks'], _ = best_of(rounds, demo2.build_download_tasks, playlist, scratch_dir)
+                if kind != 'encrypted':
+                    # 加密播放列表会下载密钥，这里只测量不需要密钥的情况
+                    stages['resolve'], _ = best_of(rounds, demo2.resolve_playlist, url, False)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        stages['verbose'], _ = best_of(rounds, demo2.resolve_playlist, url, True)
+
+                for stage, seconds in stages.items():
+                    results.append({'kind': kind, 'size': size, 'stage': stage, 'seconds': seconds,
+                                    'us_per_segment': seconds * 1e6 / size})
+    finally:
+        server.shutdown()
+        os.rmdir(scratch_dir)
+    return results
+
+
+def legacy_receive(url, path):
+    """改进前的接收方式：iter_content(8192) 每块一个新bytes对象、一次写入"""
+    resp = demo2.requests.get(url, stream=True, timeout=10)
+    validator = demo2.TsSegmentValidator()
+    with open(path, 'wb') as f:
+        for chunk in resp.iter_content(chunk_size=8192):
+            if chunk:
+                f.write(chunk)
+                validator.feed(chunk)
+    return validator.size
+
+
+def pooled_receive(url, path):
+    """当前的接收方式：download_segment_once（池化缓冲区 + 合并写入）"""
+    demo2.download_segment_once(url, path)
+    return os.path.getsize(path)
+
+
+def measure_receive(func, url, path):
+    """下载一次，返回 (墙钟秒数, 下载线程CPU秒数, 字节数)"""
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    size = func(url, path)
+    return time.perf_counter() - wall, time.thread_time() - cpu, size
+
+
+def run_receive_benchmarks(segment_size, buffer_sizes, repeat):
+    """测量片段接收吞吐量，返回 [{"method", "buffer", "mb_per_s", "mb_per_cpu_s"}]"""
+    packets = max(1, segment_size // demo2.TS_PACKET_SIZE)
+    _PlaylistHandler.playlists['/receive/segment.ts'] = (b'\x47' + bytes(demo2.TS_PACKET_SIZE - 1)) * packets
+    server, base_url = start_server()
+    url = base_url + '/receive/segment.ts'
+    scratch_dir = tempfile.mkdtemp(prefix='bench_demo2_')
+    path = os.path.join(scratch_dir, 'segment.ts')
+    # 超过该大小会拆分为Range并行下载，这里只测量单连接的接收路径
+    demo2.RANGE_SPLIT_THRESHOLD = float('inf')
+    methods = [('baseline', None, legacy_receive)]
+    methods += [('pooled', size, pooled_receive) for size in buffer_sizes]
+    results = []
+    try:
+        for method, buffer_size, func in methods:
+            if buffer_size is not None:
+                buffer_size = demo2.set_receive_buffer_size(buffer_size)
+            best = None
+            for _ in range(repeat):
+                wall, cpu, size = measure_receive(func, url, path)
+                if best is None or wall < best[0]:
+                    best = (wall, cpu, size)
+            wall, cpu, size = best
+            results.append({'method': method, 'buffer': buffer_size, 'mb_per_s': size / wall / 1e6,
+                            'mb_per_cpu_s': size / max(cpu, 1e-9) / 1e6})
+    finally:
+        demo2.set_receive_buffer_size(demo2.RECEIVE_BUFFER_SIZE)
+        server.shutdown()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(scratch_dir)
+    return results
+
+
+def print_receive_results(results):
+    """按表格输出接收吞吐量，并给出相对baseline的每核吞吐倍数"""
+    baseline = results[0]['mb_per_cpu_s']
+    print(f"{'方式':<10} {'缓冲区':>10} {'MB/s':>10} {'MB/CPU秒':>10} {'每核倍数':>8}")
+    for item in results:
+        buffer = demo2.format_size(item['buffer']) if item['buffer'] else '8.0KB'
+        print(f"{item['method']:<10} {buffer:>10} {item['mb_per_s']:>10.1f} {item['mb_per_cpu_s']:>10.1f} "
+              f"{item['mb_per_cpu_s'] / baseline:>8.2f}")
+
+
+def print_results(results):
+    """按表格输出结果"""
+    print(f"{'类型':<10} {'片段数':>8} {'阶段':<8} {'总耗时(ms)':>12} {'每片段(µs)':>12}")
+    for item in results:
+        print(f"{item['kind']:<10} {item['size']:>8} {item['stage']:<8} {item['seconds'] * 1000:>12.2f} "
+              f"{item['us_per_segment']:>12.2f}")
+
+
+def check_linear(results, tolerance):
+    """检查每个阶段单个片段的耗时在最大规模下不超过最小规模的tolerance倍，返回不满足的描述列表"""
+    failures = []
+    groups = {}
+    for item in results:
+        groups.setdefault((item['kind'], item['stage']), []).append(item)
+    for (kind, stage), items in groups.items():
+        items.sort(key=lambda item: item['size'])
+        smallest, largest = items[0], items[-1]
+        if smallest['size'] == largest['size']:
+            continue
+        ratio = largest['us_per_segment'] / max(smallest['us_per_segment'], 1e-9)
+        if ratio > tolerance:
+            failures.append(f"{kind}/{stage}: {smallest['size']}个片段 {smallest['us_per_segment']:.2f}µs/片段，"
+                            f"{largest['size']}个片段 {largest['us_per_segment']:.2f}µs/片段（{ratio:.1f}倍）")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="demo2.py 播放列表解析和片段接收基准测试")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="播放列表的片段数")
+    parser.add_argument('--kinds', nargs='+', choices=PLAYLIST_KINDS, default=list(PLAYLIST_KINDS),
+                        help="播放列表类型")
+    parser.add_argument('--repeat', type=int, default=3, help="每项重复次数，取最短耗时（默认3）")
+    parser.add_argument('--check', action='store_true', help="检查耗时是否随片段数线性增长")
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help="--check时允许的单片段耗时增长倍数（默认2.0）")
+    parser.add_argument('--receive', action='store_true', help="测量片段接收吞吐量（代替播放列表解析测试）")
+    parser.add_argument('--segment-size', type=demo2.parse_size, default=64 * 1024 * 1024,
+                        help="--receive时片段大小，如 256M（默认64M）")
+    parser.add_argument('--buffer-sizes', type=demo2.parse_size, nargs='+',
+                        default=[256 * 1024, 1024 * 1024, 4 * 1024 * 1024], help="--receive时测量的接收缓冲区大小")
+    args = parser.parse_args(argv)
+
+    if args.receive:
+        print_receive_results(run_receive_benchmarks(args.segment_size, args.buffer_sizes, args.repeat))
+        return 0
+
+    results = run_benchmarks(sorted(args.sizes), args.kinds, args.repeat)
+    print_results(results)
+    if args.check:
+        failures = check_linear(results, args.tolerance)
+        if failures:
+            print("\n以下阶段的耗时增长超过线性：")
+            for failure in failures:
+                print(f"  {failure}")
+            return 1
+        print("\n所有阶段的耗时随片段数线性增长")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
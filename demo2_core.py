@@ -0,0 +1,5763 @@
+import re
+import os
+import time
+import threading
+import shutil
+import json
+import array
+import gc
+import functools
+import importlib
+import contextlib
+import itertools
+import collections
+import io
+import heapq
+import random
+from urllib.parse import urljoin, unquote, quote, parse_qs, urlparse
+import logging
+import sys
+
+
+class _LazyModule:
+    """延迟导入的模块代理：第一次访问属性时才真正导入
+
+    status等查询命令不需要网络和子进程相关模块，延迟导入可以显著缩短启动时间。
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+requests = _LazyModule('requests')
+subprocess = _LazyModule('subprocess')
+hashlib = _LazyModule('hashlib')
+futures = _LazyModule('concurrent.futures')
+platform = _LazyModule('platform')
+
+LOG_FILE = 'demo2_log.txt'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(context)s%(message)s'
+LOG_MAX_BYTES = 5 * 1024 * 1024  # 日志文件超过该大小时轮转
+LOG_ROTATE_INTERVAL = 24 * 3600  # 日志文件写入超过该秒数时轮转
+LOG_BACKUP_COUNT = 5  # 保留的历史日志文件数（demo2_log.txt.1 ~ .5）
+LOG_DEDUPE_WINDOW = 60.0  # 相同类型的警告和错误的统计窗口（秒）
+LOG_DEDUPE_BURST = 3  # 每个窗口内相同类型的警告和错误最多记录的条数，其余只统计数量
+LOG_DEDUPE_MAX_KEYS = 1024  # 限流器最多跟踪的信息类型数
+LOG_CONTEXT_FIELDS = ('work', 'episode', 'segment')  # 日志记录中的结构化字段
+
+# 去掉地址和数字后相同的信息视为同一类型（如不同片段的同一种下载错误）
+_LOG_KEY_PATTERN = re.compile(r'https?://\S+|\d+(?:\.\d+)?')
+_log_context = threading.local()
+_log_listener = None
+_log_queue_handler = None
+
+
+class RepeatLimiter:
+    """重复信息限流器：同一类型的信息在window秒内只放行前burst条，其余只计数
+
+    窗口结束后同类信息再次出现时放行，并返回上个窗口内被省略的条数，由调用方附在信息后面。
+    """
+    def __init__(self, window=LOG_DEDUPE_WINDOW, burst=LOG_DEDUPE_BURST, max_keys=LOG_DEDUPE_MAX_KEYS):
+        self.window = window
+        self.burst = burst
+        self.max_keys = max_keys
+        self._entries = {}  # 类型 -> [窗口开始时间, 窗口内条数, 省略条数]
+        self._lock = threading.Lock()
+    
+    def check(self, message, now=None):
+        """返回 (是否放行, 上个窗口内被省略的条数)"""
+        key = _LOG_KEY_PATTERN.sub('#', message)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                if entry is None and len(self._entries) >= self.max_keys:
+                    self._prune(now)
+                self._entries[key] = [now, 1, 0]
+                return True, entry[2] if entry else 0
+            entry[1] += 1
+            if entry[1] <= self.burst:
+                return True, 0
+            entry[2] += 1
+            return False, 0
+    
+    def _prune(self, now):
+        # 丢弃已过期且没有省略记录的类型；仍然太多时全部清空
+        for key in [key for key, entry in self._entries.items() if now - entry[0] >= self.window and not entry[2]]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_keys:
+            self._entries.clear()
+    
+    def pending(self):
+        """取出所有还有省略记录的类型，返回 [(类型, 省略条数)]"""
+        with self._lock:
+            result = [(key, entry[2]) for key, entry in self._entries.items() if entry[2]]
+            for entry in self._entries.values():
+                entry[2] = 0
+        return result
+
+
+_console_limiter = RepeatLimiter()
+
+
+def print_limited(message):
+    """输出可能大量重复的信息（如片段下载失败）：同一类型的信息在LOG_DEDUPE_WINDOW秒内只显示前几条"""
+    allowed, suppressed = _console_limiter.check(message)
+    if suppressed:
+        print(f"（此前{_console_limiter.window:.0f}秒内另有{suppressed}条同类信息已省略）")
+    if allowed:
+        print(message)
+
+
+def print_suppressed():
+    """输出限流期间被省略的同类信息条数（一轮下载结束时调用）"""
+    for key, suppressed in _console_limiter.pending():
+        print(f"（另有{suppressed}条同类信息已省略: {key.strip()}）")
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """在当前线程中为日志记录附加结构化字段（作品、集数、片段序号），退出时恢复"""
+    previous = getattr(_log_context, 'fields', {})
+    _log_context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _log_context.fields = previous
+
+
+class LogContextFilter(logging.Filter):
+    """把当前线程的日志上下文和extra中的结构化字段格式化为 "[work=... episode=... segment=...] " 前缀
+
+    在产生日志的线程中执行（线程局部的上下文只在该线程可见）。
+    """
+    def filter(self, record):
+        fields = dict(getattr(_log_context, 'fields', {}))
+        for name in LOG_CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                fields[name] = value
+        items = [f"{name}={fields[name]}" for name in LOG_CONTEXT_FIELDS if fields.get(name) is not None]
+        record.context = f"[{' '.join(items)}] " if items else ''
+        return True
+
+
+class DuplicateLogFilter(logging.Filter):
+    """警告和错误的限流：相同类型的记录在统计窗口内只写入前几条，
+    窗口结束后的第一条记录附带被省略的条数"""
+    def __init__(self, limiter=None):
+        super().__init__()
+        self.limiter = limiter or RepeatLimiter()
+    
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        message = record.getMessage()
+        allowed, suppressed = self.limiter.check(message)
+        if allowed and suppressed:
+            record.msg = f"{message}（此前{self.limiter.window:.0f}秒内另有{suppressed}条同类记录已省略）"
+            record.args = None
+        return allowed
+
+
+def create_log_file_handler(path=LOG_FILE, max_bytes=LOG_MAX_BYTES, interval=LOG_ROTATE_INTERVAL,
+                            backup_count=LOG_BACKUP_COUNT):
+    """创建按大小和时间轮转的日志文件处理器（任一条件满足即轮转）"""
+    # logging.handlers导入较慢，只在真正执行任务时导入
+    import logging.handlers
+    
+    class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+        def __init__(self):
+            super().__init__(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+            self.rollover_at = time.time() + interval
+            try:
+                # 上次运行留下的日志已经超过轮转时间时，本次运行从新文件开始
+                if interval and os.path.getmtime(path) + interval <= time.time():
+                    self.rollover_at = 0
+            except OSError:
+                pass
+        
+        def shouldRollover(self, record):
+            if interval and time.time() >= self.rollover_at and os.path.exists(self.baseFilename):
+                return True
+            return super().shouldRollover(record)
+        
+        def doRollover(self):
+            super().doRollover()
+            self.rollover_at = time.time() + interval
+    
+    return SizeAndTimeRotatingFileHandler()
+
+
+def setup_logging():
+    """配置日志 - 使用demo2特定的日志文件名（只在真正执行任务时配置，查询命令不创建日志文件）
+
+    下载线程只把日志记录放入队列，由后台线程写入文件，磁盘变慢时不会阻塞下载；
+    日志按大小和时间轮转，重复的警告和错误被限流。重复调用时不会重复配置。
+    """
+    global _log_listener, _log_queue_handler
+    if _log_listener is not None:
+        return
+    import logging.handlers
+    import queue
+    import atexit
+    
+    file_handler = create_log_file_handler()
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    file_handler.addFilter(DuplicateLogFilter())
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    _log_queue_handler = queue_handler
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _log_listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """写完队列中剩余的日志记录，并记录限流期间被省略的条数（程序退出时自动调用）"""
+    global _log_listener, _log_queue_handler
+    listener = _log_listener
+    if listener is None:
+        return
+    logging.getLogger().removeHandler(_log_queue_handler)
+    _log_listener = _log_queue_handler = None
+    listener.stop()
+    for handler in listener.handlers:
+        for log_filter in handler.filters:
+            if not isinstance(log_filter, DuplicateLogFilter):
+                continue
+            for key, suppressed in log_filter.limiter.pending():
+                record = logging.LogRecord('root', logging.WARNING, __file__, 0,
+                                           f"同类记录另有{suppressed}条已省略: {key}", None, None)
+                record.context = ''
+                handler.emit(record)
+        handler.close()
+
+# 采样分析（--profile）相关常量
+PROFILE_INTERVAL = 0.01  # 采样间隔（秒），每次采样遍历所有线程的调用栈
+PROFILE_MAX_DEPTH = 64  # 每个调用栈最多记录的帧数（从最内层算起）
+PROFILE_STAGES = {  # 流水线阶段及显示名称，未标记阶段的线程记为other
+    'playlist': '获取播放列表',
+    'download': '下载片段',
+    'merge': '合并',
+    'status': '写任务状态',
+    'transcode': '转码/封装',
+    'other': '其他',
+}
+
+_active_profiler = None
+
+
+class SamplingProfiler:
+    """低开销的采样分析器：后台线程定时读取所有线程的调用栈（sys._current_frames）
+
+    每个样本按所在线程当前的流水线阶段（见profile_stage）分类，结束时输出折叠调用栈
+    （可直接用flamegraph.pl或speedscope生成火焰图）和各阶段的墙钟时间、CPU时间汇总。
+    阶段的时间是独占时间：嵌套的阶段（如下载中刷新播放列表）只计入内层阶段。
+    主线程中不属于任何阶段的样本记为other，其他线程不在阶段中时处于空闲等待，不记录样本。
+    """
+    def __init__(self, interval=PROFILE_INTERVAL, max_depth=PROFILE_MAX_DEPTH):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = collections.Counter()  # (阶段, 线程名, 调用栈) -> 样本数
+        self.stage_samples = collections.Counter()
+        self.totals = {}  # 阶段 -> {"wall", "cpu", "children", "calls"}
+        self.sample_count = 0
+        self.lateness = 0.0  # 采样线程醒来的累计延迟（秒），GIL争用严重时明显增大
+        self._stacks = {}  # 线程ID -> [[阶段, 开始墙钟时间, 开始CPU时间, 开始子进程CPU时间]]
+        self._labels = {}  # 代码对象 -> 帧名称
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_time = None
+        self._main_ident = threading.main_thread().ident
+        self.elapsed = 0.0
+    
+    def start(self):
+        global _active_profiler
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        _active_profiler = self
+    
+    def stop(self):
+        global _active_profiler
+        _active_profiler = None
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.elapsed = time.perf_counter() - self._start_time
+    
+    def _run(self):
+        own = threading.get_ident()
+        next_time = time.perf_counter() + self.interval
+        while not self._stop_event.wait(max(next_time - time.perf_counter(), 0)):
+            now = time.perf_counter()
+            self.lateness += max(now - next_time, 0.0)
+            next_time = max(next_time + self.interval, now)
+            self._sample(own)
+    
+    def _frame_label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+    
+    def _sample(self, own):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            try:
+                stage = self._stacks[ident][-1][0]
+            except (KeyError, IndexError):
+                # 未处于任何阶段的后台线程（空闲的下载线程、日志和进度刷新线程）只是在等待，不记录
+                if ident != self._main_ident:
+                    continue
+                stage = 'other'
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(self._frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            # 线程池的线程名带有序号（如 ThreadPoolExecutor-0_3），去掉序号后合并同一线程池的样本
+            thread_name = re.sub(r'_\d+$', '', names.get(ident, str(ident)))
+            self.samples[(stage, thread_name, tuple(stack))] += 1
+            self.stage_samples[stage] += 1
+        self.sample_count += 1
+    
+    def _charge(self, entry, now, cpu, children):
+        with self._lock:
+            total = self.totals.setdefault(entry[0], {'wall': 0.0, 'cpu': 0.0, 'children': 0.0, 'calls': 0})
+            total['wall'] += now - entry[1]
+            total['cpu'] += cpu - entry[2]
+            total['children'] += children - entry[3]
+    
+    def enter(self, stage):
+        """当前线程进入阶段（由profile_stage调用）"""
+        now, cpu, children = time.perf_counter(), time.thread_time(), _children_cpu_time()
+        stack = self._stacks.setdefault(threading.get_ident(), [])
+        if stack:
+            self._charge(stack[-1], now, cpu, children)
+        stack.append([stage, now, cpu, children])
+        with self._lock:
+            self.totals.setdefault(stage, {'wall': 0.0, 'cpu': 0.0, 'children': 0.0, 'calls': 0})['calls'] += 1
+    
+    def exit(self):
+        """当前线程离开最内层的阶段"""
+        now, cpu, children = time.perf_counter(), time.thread_time(), _children_cpu_time()
+        stack = self._stacks.get(threading.get_ident())
+        if not stack:
+            return
+        self._charge(stack.pop(), now, cpu, children)
+        if stack:
+            stack[-1][1:] = [now, cpu, children]
+    
+    def write_collapsed(self, path):
+        """输出折叠调用栈：每行为 阶段;线程;帧;帧... 样本数"""
+        with open(path, 'w', encoding='utf-8') as f:
+            for (stage, thread_name, stack), count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                f.write(';'.join((stage, thread_name) + stack) + f" {count}\n")
+    
+    def summary_lines(self):
+        """各阶段的墙钟时间、CPU时间和样本占比"""
+        total_samples = sum(self.stage_samples.values()) or 1
+        lines = [f"采样分析: 运行 {self.elapsed:.2f}秒, 采样 {self.sample_count} 次（间隔 {self.interval * 1000:.0f}ms）",
+                 f"{'阶段':<10} {'调用次数':>8} {'墙钟(秒)':>10} {'CPU(秒)':>10} {'子进程CPU(秒)':>14} {'样本占比':>8}"]
+        for stage, label in PROFILE_STAGES.items():
+            total = self.totals.get(stage, {'wall': 0.0, 'cpu': 0.0, 'children': 0.0, 'calls': 0})
+            if not total['calls'] and not self.stage_samples.get(stage):
+                continue
+            share = self.stage_samples.get(stage, 0) * 100 / total_samples
+            lines.append(f"{label:<10} {total['calls']:>8} {total['wall']:>10.2f} {total['cpu']:>10.2f} "
+                         f"{total['children']:>14.2f} {share:>7.1f}%")
+        if self.sample_count:
+            lines.append(f"采样线程平均延迟 {self.lateness * 1000 / self.sample_count:.2f}ms"
+                         f"（明显大于0时说明GIL争用严重）")
+        lines.append("墙钟时间按线程累计（多个下载线程同时工作时会超过运行时间），墙钟远大于CPU说明在等待网络、磁盘或GIL")
+        return lines
+    
+    def write_report(self, prefix):
+        """写出 {prefix}.collapsed 和 {prefix}.txt，返回汇总文本行"""
+        lines = self.summary_lines()
+        self.write_collapsed(f"{prefix}.collapsed")
+        with open(f"{prefix}.txt", 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return lines
+
+
+def _children_cpu_time():
+    """已结束的子进程（FFmpeg）累计的CPU时间"""
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    """标记当前线程所处的流水线阶段（也可以作为函数装饰器使用），没有开启--profile时几乎没有开销"""
+    profiler = _active_profiler
+    if profiler is None:
+        yield
+        return
+    profiler.enter(stage)
+    try:
+        yield
+    finally:
+        profiler.exit()
+
+# 断点续传相关常量 - 使用demo2特定的状态文件名
+TASK_STATUS_FILE = 'demo2_status.json'
+TASK_STATUSES = {
+    'pending': '待处理',
+    'downloading': '下载中',
+    'merging': '合并中',
+    'transcoding': '转码中',
+    'completed': '已完成',
+    'failed': '失败',
+    'interrupted': '已中断'
+}
+
+# 进度显示相关常量
+PROGRESS_REFRESH_INTERVAL = 0.5  # 渲染线程刷新间隔（秒）
+PROGRESS_JSON_INTERVAL = 5.0  # 非TTY模式下输出JSON进度行的间隔（秒）
+PROGRESS_EWMA_ALPHA = 0.2  # 滑动平均速率的平滑系数
+
+
+def format_size(num_bytes):
+    """将字节数格式化为便于阅读的字符串"""
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f}{unit}"
+        size /= 1024
+
+
+def format_duration(seconds):
+    """将秒数格式化为 H:MM:SS 或 MM:SS，未知时返回 --:--"""
+    if seconds is None or seconds < 0:
+        return '--:--'
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes:02d}:{secs:02d}"
+
+
+class _WorkerCounter:
+    """单个线程的进度计数器：只由所属线程写入，渲染线程只读"""
+    __slots__ = ('completed', 'failed', 'bytes')
+
+    def __init__(self):
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+
+
+class BatchProgress:
+    """整批任务的进度汇总，跟踪集数、字节数、整批吞吐量和预计剩余时间
+
+    total_known为False时（剧集来自边读边处理的列表），总集数随读取增加，读完之前不估算剩余时间。
+    """
+    def __init__(self, total_episodes, total_known=True):
+        self.total_episodes = total_episodes
+        self.total_known = total_known
+        self.finished_episodes = 0
+        self.failed_episodes = 0
+        self.finished_bytes = 0
+        self.start_time = time.time()
+        self.current = None  # 当前正在下载的剧集进度条
+
+    def episode_done(self, success=True):
+        """记录一集处理结束（只在主线程调用）"""
+        if success:
+            self.finished_episodes += 1
+        else:
+            self.failed_episodes += 1
+
+    def snapshot(self):
+        """合并已完成剧集和当前剧集的进度，返回整批统计信息"""
+        current = self.current
+        done = self.finished_episodes + self.failed_episodes
+        total_bytes = self.finished_bytes
+        fraction = float(done)
+        if current is not None:
+            stats = current.counts()
+            total_bytes += stats['bytes']
+            if current.total > 0:
+                fraction += (stats['completed'] + stats['failed']) / current.total
+        elapsed = time.time() - self.start_time
+        eta = None
+        if not self.total_known:
+            pass
+        elif 0 < fraction < self.total_episodes:
+            eta = elapsed * (self.total_episodes - fraction) / fraction
+        elif fraction >= self.total_episodes:
+            eta = 0
+        return {
+            'episodes_done': done,
+            'episodes_failed': self.failed_episodes,
+            'episodes_total': self.total_episodes,
+            'bytes': total_bytes,
+            'rate': total_bytes / elapsed if elapsed > 0 else 0.0,
+            'elapsed': elapsed,
+            'eta': eta,
+        }
+
+
+class ProgressBar:
+    """进度条类：无锁的进度聚合器
+
+    每个线程只写自己的计数器，后台渲染线程按固定频率合并计数并刷新显示，
+    终端输出不再阻塞下载线程。除片段数外还统计字节数、瞬时/平均速率和预计剩余时间，
+    非TTY环境下改为定期输出JSON行，便于日志收集。
+    """
+    def __init__(self, total, label=None, batch=None, refresh_interval=PROGRESS_REFRESH_INTERVAL,
+                 json_mode=None, stream=None):
+        self.total = total
+        self.label = label
+        self.batch = batch
+        self.refresh_interval = refresh_interval
+        self.stream = stream or sys.stdout
+        if json_mode is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            json_mode = not (isatty and isatty())
+        self.json_mode = json_mode
+        
+        self._local = threading.local()
+        self._counters = []
+        self._start_time = time.time()
+        self._last_time = self._start_time
+        self._last_bytes = 0
+        self._last_json_time = 0.0
+        self.instant_rate = 0.0
+        self.avg_rate = 0.0
+        
+        if batch is not None:
+            batch.current = self
+        self._stop_event = threading.Event()
+        self._renderer = threading.Thread(target=self._render_loop, name='progress-renderer', daemon=True)
+        self._renderer.start()
+    
+    def _counter(self):
+        """获取当前线程专属的计数器，首次使用时登记"""
+        counter = getattr(self._local, 'counter', None)
+        if counter is None:
+            counter = _WorkerCounter()
+            self._local.counter = counter
+            # list.append 在CPython中是原子操作，无需加锁
+            self._counters.append(counter)
+        return counter
+    
+    def recover(self):
+        """之前记为失败的片段在修复阶段下载成功"""
+        counter = self._counter()
+        counter.failed -= 1
+        counter.completed += 1
+    
+    def add_bytes(self, num_bytes):
+        """累加已接收的字节数（下载线程在接收数据时调用）"""
+        self._counter().bytes += num_bytes
+        
+    def update(self, success=True):
+        """更新进度"""
+        counter = self._counter()
+        if success:
+            counter.completed += 1
+        else:
+            counter.failed += 1
+    
+    def counts(self):
+        """合并所有线程的计数"""
+        completed = failed = num_bytes = 0
+        for counter in list(self._counters):
+            completed += counter.completed
+            failed += counter.failed
+            num_bytes += counter.bytes
+        return {'completed': completed, 'failed': failed, 'bytes': num_bytes}
+    
+    @property
+    def completed(self):
+        return self.counts()['completed']
+    
+    @property
+    def failed(self):
+        return self.counts()['failed']
+    
+    def snapshot(self):
+        """计算当前进度、速率和预计剩余时间"""
+        stats = self.counts()
+        now = time.time()
+        interval = now - self._last_time
+        if interval > 0:
+            self.instant_rate = (stats['bytes'] - self._last_bytes) / interval
+            if self.avg_rate == 0.0:
+                self.avg_rate = self.instant_rate
+            else:
+                self.avg_rate += PROGRESS_EWMA_ALPHA * (self.instant_rate - self.avg_rate)
+            self._last_time = now
+            self._last_bytes = stats['bytes']
+        
+        progress = stats['completed'] + stats['failed']
+        eta = None
+        if progress >= self.total:
+            eta = 0
+        elif progress > 0 and self.avg_rate > 0:
+            # 按已完成片段的平均大小估算整集字节数
+            estimated_total = stats['bytes'] / progress * self.total
+            eta = max(estimated_total - stats['bytes'], 0) / self.avg_rate
+        stats.update({
+            'total': self.total,
+            'percent': (progress / self.total) * 100 if self.total > 0 else 0,
+            'instant_rate': self.instant_rate,
+            'avg_rate': self.avg_rate,
+            'elapsed': now - self._start_time,
+            'eta': eta,
+        })
+        return stats
+    
+    def _render_loop(self):
+        """渲染线程：按固定频率刷新显示"""
+        while not self._stop_event.wait(self.refresh_interval):
+            try:
+                self._display()
+            except Exception:
+                pass
+    
+    def _display(self, final=False):
+        """显示进度条"""
+        stats = self.snapshot()
+        batch_stats = self.batch.snapshot() if self.batch is not None else None
+        
+        if self.json_mode:
+            now = time.time()
+            if not final and now - self._last_json_time < PROGRESS_JSON_INTERVAL:
+                return
+            self._last_json_time = now
+            record = {'type': 'episode', 'label': self.label, 'final': final}
+            record.update(stats)
+            if batch_stats is not None:
+                record['batch'] = batch_stats
+            print(json.dumps(record, ensure_ascii=False), file=self.stream, flush=True)
+            return
+        
+        progress = stats['completed'] + stats['failed']
+        bar_length = 30
+        filled_length = int(bar_length * progress // self.total) if self.total > 0 else bar_length
+        bar = '█' * filled_length + '-' * (bar_length - filled_length)
+        line = (f"\r[{bar}] {stats['percent']:.1f}% | 已完成: {stats['completed']} | 失败: {stats['failed']} | "
+                f"总计: {self.total} | {format_size(stats['bytes'])} | "
+                f"{format_size(stats['instant_rate'])}/s (均{format_size(stats['avg_rate'])}/s) | "
+                f"剩余: {format_duration(stats['eta'])}")
+        if batch_stats is not None:
+            line += (f" | 批次: {batch_stats['episodes_done']}/{batch_stats['episodes_total']} "
+                     f"剩余: {format_duration(batch_stats['eta'])}")
+        # 清除当前行并重新打印
+        print(line + '\033[K', end='', file=self.stream, flush=True)
+    
+    def finish(self):
+        """完成进度条显示，并把本集字节数计入整批统计（重复调用时不再处理）"""
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._renderer.join()
+        self._display(final=True)
+        if not self.json_mode:
+            print(file=self.stream)
+        if self.batch is not None:
+            self.batch.finished_bytes += self.counts()['bytes']
+            self.batch.current = None
+
+# MPEG-TS片段校验相关常量
+TS_PACKET_SIZE = 188  # TS包长度
+TS_SYNC_BYTE = b'\x47'  # 每个TS包的同步字节
+
+
+class SegmentValidationError(Exception):
+    """片段内容校验失败（截断、错位或返回了错误页面等）"""
+
+
+class TsSegmentValidator:
+    """MPEG-TS片段增量校验器
+
+    随数据块到达逐块检查：每隔188字节的位置必须是0x47同步字节，
+    结束时检查总长度是188的整数倍并与Content-Length一致。
+    同步字节用切片步进一次性取出后比较，整个过程在C层完成，不逐字节循环。
+    """
+    def __init__(self):
+        self.size = 0
+        self.error = None
+        self.cost = 0.0  # 校验累计耗时（秒）
+        self._first_byte = None
+    
+    def feed(self, chunk):
+        """校验一个数据块，返回是否仍然有效"""
+        if self.error is not None:
+            return False
+        start = time.perf_counter()
+        if self._first_byte is None and chunk:
+            self._first_byte = bytes(chunk[:1])
+        # 本数据块中第一个TS包起始位置（数据块可能是缓冲区的memoryview，同步字节取出后转为bytes）
+        offset = (-self.size) % TS_PACKET_SIZE
+        sync = bytes(chunk[offset::TS_PACKET_SIZE])
+        if sync.count(TS_SYNC_BYTE) != len(sync):
+            bad_index = next(i for i, b in enumerate(sync) if b != TS_SYNC_BYTE[0])
+            position = self.size + offset + bad_index * TS_PACKET_SIZE
+            if position == 0 and self._first_byte == b'<':
+                self.error = "内容不是TS数据（疑似HTML错误页面）"
+            else:
+                self.error = f"偏移 {position} 处缺少同步字节0x47"
+        self.size += len(chunk)
+        self.cost += time.perf_counter() - start
+        return self.error is None
+    
+    def finish(self, expected_length=None):
+        """结束校验，返回 (是否有效, 错误原因)"""
+        if self.error is None:
+            if self.size == 0:
+                self.error = "片段为空"
+            elif expected_length and self.size != expected_length:
+                self.error = f"长度 {self.size} 与Content-Length {expected_length} 不一致"
+            elif self.size % TS_PACKET_SIZE:
+                self.error = f"长度 {self.size} 不是{TS_PACKET_SIZE}字节的整数倍（片段被截断）"
+        return self.error is None, self.error
+
+
+class Mp4BoxValidator:
+    """fMP4（CMAF）片段增量校验器
+
+    随数据块到达逐个跳过顶层box：box长度不能小于头部、类型必须是4个可打印字符，
+    结束时数据必须恰好停在box边界上。box内容不逐字节检查，开销只与box数量有关。
+    """
+    def __init__(self):
+        self.size = 0
+        self.error = None
+        self.cost = 0.0  # 校验累计耗时（秒）
+        self.boxes = []  # 顶层box类型
+        self._header = b''  # 跨数据块的不完整box头部
+        self._skip = 0  # 当前box还未到达的字节数
+        self._open_ended = False  # 遇到长度为0（延伸到文件结尾）的box
+    
+    def _header_size(self):
+        # 长度字段为1时，后面紧跟64位的实际长度
+        return 16 if self._header[:4] == b'\x00\x00\x00\x01' else 8
+    
+    def feed(self, chunk):
+        """校验一个数据块，返回是否仍然有效"""
+        if self.error is not None:
+            return False
+        start = time.perf_counter()
+        if self.size == 0 and chunk[:1] == b'<':
+            self.error = "内容不是MP4数据（疑似HTML错误页面）"
+        pos = 0
+        length = len(chunk)
+        while self.error is None and not self._open_ended and pos < length:
+            if self._skip:
+                step = min(self._skip, length - pos)
+                self._skip -= step
+                pos += step
+                continue
+            take = min(self._header_size() - len(self._header), length - pos)
+            self._header += bytes(chunk[pos:pos + take])
+            pos += take
+            if len(self._header) < self._header_size():
+                continue
+            header_size = len(self._header)
+            box_size = int.from_bytes(self._header[:4], 'big')
+            if header_size == 16:
+                box_size = int.from_bytes(self._header[8:16], 'big')
+            box_type = self._header[4:8]
+            self._header = b''
+            if not all(32 <= b < 127 for b in box_type):
+                self.error = f"偏移 {self.size + pos - header_size} 处的box类型无效"
+            elif box_size == 0:
+                self.boxes.append(box_type.decode('ascii'))
+                self._open_ended = True
+            elif box_size < header_size:
+                self.error = f"偏移 {self.size + pos - header_size} 处的box长度 {box_size} 无效"
+            else:
+                self.boxes.append(box_type.decode('ascii'))
+                self._skip = box_size - header_size
+        self.size += length
+        self.cost += time.perf_counter() - start
+        return self.error is None
+    
+    def finish(self, expected_length=None):
+        """结束校验，返回 (是否有效, 错误原因)"""
+        if self.error is None:
+            if self.size == 0:
+                self.error = "片段为空"
+            elif expected_length and self.size != expected_length:
+                self.error = f"长度 {self.size} 与Content-Length {expected_length} 不一致"
+            elif self._skip or self._header:
+                self.error = f"长度 {self.size} 停在box中间（片段被截断）"
+        return self.error is None, self.error
+
+
+class PlainSegmentValidator:
+    """独立音频（ADTS）和字幕（WebVTT）片段的校验器
+
+    这两种格式没有可以增量检查的包结构，只检查开头不是HTML错误页面、
+    WebVTT片段以"WEBVTT"开头，结束时检查长度与Content-Length一致。
+    """
+    def __init__(self, container):
+        self.container = container
+        self.size = 0
+        self.error = None
+        self.cost = 0.0  # 校验累计耗时（秒）
+    
+    def feed(self, chunk):
+        """校验一个数据块，返回是否仍然有效"""
+        if self.error is not None:
+            return False
+        if self.size == 0 and chunk:
+            head = bytes(chunk[:16]).lstrip(b'\xef\xbb\xbf')
+            if self.container == 'webvtt' and not head.startswith(b'WEBVTT'):
+                self.error = "内容不是WebVTT字幕（缺少WEBVTT文件头）"
+            elif head[:1] == b'<':
+                self.error = "内容不是媒体数据（疑似HTML错误页面）"
+        self.size += len(chunk)
+        return self.error is None
+    
+    def finish(self, expected_length=None):
+        """结束校验，返回 (是否有效, 错误原因)"""
+        if self.error is None:
+            if self.size == 0:
+                self.error = "片段为空"
+            elif expected_length and self.size != expected_length:
+                self.error = f"长度 {self.size} 与Content-Length {expected_length} 不一致"
+        return self.error is None, self.error
+
+
+def new_segment_validator(container='ts'):
+    """按片段格式创建校验器（ts、fmp4、aac或webvtt）"""
+    if container == 'fmp4':
+        return Mp4BoxValidator()
+    if container == 'ts':
+        return TsSegmentValidator()
+    return PlainSegmentValidator(container)
+
+
+class ValidationStats:
+    """片段校验统计：各线程写自己的计数器，汇总时合并，用于衡量校验开销"""
+    def __init__(self):
+        self._local = threading.local()
+        self._counters = []
+    
+    def record(self, validator, valid):
+        """记录一次校验结果（由下载线程调用）"""
+        counter = getattr(self._local, 'counter', None)
+        if counter is None:
+            counter = {'segments': 0, 'invalid': 0, 'bytes': 0, 'cost': 0.0}
+            self._local.counter = counter
+            self._counters.append(counter)
+        counter['segments'] += 1
+        counter['bytes'] += validator.size
+        counter['cost'] += validator.cost
+        if not valid:
+            counter['invalid'] += 1
+    
+    def summary(self):
+        """合并各线程的统计结果"""
+        total = {'segments': 0, 'invalid': 0, 'bytes': 0, 'cost': 0.0}
+        for counter in list(self._counters):
+            for key in total:
+                total[key] += counter[key]
+        return total
+
+
+def process_ts_url(url):
+    """处理ts文件URL，支持带鉴权参数的格式"""
+    # 如果URL已经是一个完整的URL（包含http或https），则直接返回
+    if url.startswith('http://') or url.startswith('https://'):
+        return url
+    
+    # 否则，这是一个相对路径，需要结合基础URL使用
+    # 注意：基础URL的拼接将在调用函数时处理
+    return url
+
+# 以.ts结尾，或包含.ts?的URL（预编译，解析大播放列表时逐行使用）
+_TS_URL_PATTERN = re.compile(r'\.ts(\?.*)?$', re.IGNORECASE)
+
+
+def is_valid_ts_url(line):
+    """判断是否为有效的ts文件URL，支持带鉴权参数的格式"""
+    # 排除注释行（以#开头）
+    if line.strip().startswith('#'):
+        return False
+    
+    # 检查是否包含.ts扩展名，支持带参数的情况
+    return _TS_URL_PATTERN.search(line) is not None
+
+
+def join_segment_url(prefix, playlist_url, uri):
+    """拼接片段地址
+
+    prefix为播放列表所在目录（urljoin(playlist_url, '_')去掉末尾的'_'），
+    普通的相对路径直接拼接在后面，http(s)绝对地址原样返回；
+    以/、.、?、#开头或含有/.的路径交给urljoin处理，结果与urljoin一致。
+    """
+    if '/.' in uri:
+        return urljoin(playlist_url, uri)
+    if uri.startswith(('http://', 'https://')):
+        return uri
+    if uri[0] in '/.?#' or ':' in uri.partition('/')[0]:
+        return urljoin(playlist_url, uri)
+    return prefix + uri
+
+# 详细模式下最多显示的播放列表行数和片段名数量
+PLAYLIST_PREVIEW_LINES = 20
+
+# 独立音频、字幕轨道（EXT-X-MEDIA）相关常量
+PREFERRED_AUDIO_LANGUAGE = None  # 多个音频轨道时优先选择的语言（如"zh"、"en"），None表示选择默认轨道
+DOWNLOAD_SUBTITLES = True  # 是否下载并封装字幕轨道
+TRACK_EXTENSIONS = {'ts': '.ts', 'aac': '.aac', 'fmp4': '.mp4', 'webvtt': '.vtt'}  # 各片段格式合并后的扩展名
+
+# 播放列表预取相关常量
+PREFETCH_LOOKAHEAD = 2  # 提前解析后续几集的播放列表
+PREFETCH_EXPIRY_MARGIN = 60  # 签名URL距离过期不足该秒数时重新解析
+PREFETCH_MAX_AGE = 600  # 无法确定过期时间的带签名URL，解析后超过该秒数重新解析
+
+# 签名参数中表示过期时间（Unix时间戳）的常见字段
+SIGNED_EXPIRY_PARAMS = ('expires', 'expire', 'expiry', 'exp', 'e', 'deadline', 'x-expires')
+
+_ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_attribute_list(text):
+    """解析m3u8标签的属性列表，如 METHOD=AES-128,URI="key.key" """
+    return {name: value.strip('"') for name, value in _ATTRIBUTE_PATTERN.findall(text)}
+
+
+def pause_gc(func):
+    """装饰器：函数执行期间暂停循环垃圾回收
+
+    解析大播放列表时一次性创建大量长期存活的片段字典，循环垃圾回收会反复扫描这些对象，
+    使耗时随片段数超线性增长；这些对象之间没有循环引用，暂停回收不会造成泄漏。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return wrapper
+
+
+@pause_gc
+def parse_m3u8(data, playlist_url, any_uri=False):
+    """解析m3u8内容
+
+    any_uri: 为True时EXTINF之后的任意地址都视为片段（音频、字幕等独立轨道的播放列表，片段可能是.aac、.vtt）
+
+    返回字典：
+    variants: 多码率（master）播放列表中的清晰度变体 [{"url", "bandwidth", "resolution", "audio", "subtitles"}]
+        audio/subtitles为变体使用的音频、字幕轨道组（EXT-X-MEDIA的GROUP-ID），没有时为None
+    media: 多码率播放列表中的独立轨道（EXT-X-MEDIA）
+        [{"type", "group", "name", "language", "default", "url"}]，轨道包含在视频变体中时url为None
+    segments: 媒体片段 [{"uri", "url", "sequence", "duration", "key", "byterange", "map"}]
+        byterange为 (偏移, 长度)，没有 EXT-X-BYTERANGE 时为None
+        map为片段所属的初始化片段（EXT-X-MAP）{"uri", "url", "byterange"}，TS片段为None
+    container: 片段格式，有 EXT-X-MAP 时为"fmp4"（CMAF），any_uri播放列表按片段扩展名为"aac"或"webvtt"，否则为"ts"
+    """
+    variants = []
+    media = []
+    segments = []
+    media_sequence = 0
+    current_key = None
+    duration = 0.0
+    stream_inf = None
+    byterange = None
+    next_offsets = {}  # 字节范围省略偏移时，从同一文件上一个范围的结尾继续
+    current_map = None
+    has_extinf = False
+    prefix = urljoin(playlist_url, '_')[:-1]
+    ts_url_search = _TS_URL_PATTERN.search
+    
+    # 只做一遍线性扫描，不逐行输出；最常见的EXTINF放在最前面判断
+    for line in data.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        
+        if line[0] == '#':
+            if line.startswith('#EXTINF:'):
+                has_extinf = True
+                try:
+                    duration = float(line[8:].split(',', 1)[0])
+                except ValueError:
+                    duration = 0.0
+            elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                media_sequence = int(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-MAP:'):
+                attrs = parse_attribute_list(line.split(':', 1)[1])
+                map_range = None
+                if attrs.get('BYTERANGE'):
+                    length, _, offset = attrs['BYTERANGE'].partition('@')
+                    map_range = (int(offset or 0), int(length))
+                current_map = {
+                    'uri': attrs.get('URI', ''),
+                    'url': urljoin(playlist_url, attrs.get('URI', '')),
+                    'byterange': map_range,
+                }
+            elif line.startswith('#EXT-X-KEY:'):
+                attrs = parse_attribute_list(line.split(':', 1)[1])
+                method = attrs.get('METHOD', 'NONE').upper()
+                if method == 'NONE':
+                    current_key = None
+                else:
+                    current_key = {
+                        'method': method,
+                        'url': urljoin(playlist_url, attrs.get('URI', '')),
+                        'iv': attrs.get('IV'),
+                    }
+            elif line.startswith('#EXT-X-BYTERANGE:'):
+                length, _, offset = line.split(':', 1)[1].partition('@')
+                byterange = (int(offset) if offset else None, int(length))
+            elif line.startswith('#EXT-X-STREAM-INF:'):
+                stream_inf = parse_attribute_list(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-MEDIA:'):
+                attrs = parse_attribute_list(line.split(':', 1)[1])
+                media.append({
+                    'type': attrs.get('TYPE', '').upper(),
+                    'group': attrs.get('GROUP-ID'),
+                    'name': attrs.get('NAME'),
+                    'language': attrs.get('LANGUAGE'),
+                    'default': attrs.get('DEFAULT', '').upper() == 'YES',
+                    'url': urljoin(playlist_url, attrs['URI']) if attrs.get('URI') else None,
+                })
+            continue
+        
+        if stream_inf is not None:
+            # 多码率播放列表中紧跟 EXT-X-STREAM-INF 的是变体地址
+            variants.append({
+                'url': urljoin(playlist_url, line),
+                'bandwidth': int(stream_inf.get('BANDWIDTH', 0) or 0),
+                'resolution': stream_inf.get('RESOLUTION'),
+                'audio': stream_inf.get('AUDIO'),
+                'subtitles': stream_inf.get('SUBTITLES'),
+            })
+            stream_inf = None
+            continue
+        
+        # 检查是否为有效的ts文件URL（fMP4播放列表中EXTINF之后的地址都是分片，如.m4s）
+        if ts_url_search(line) or (has_extinf and (current_map is not None or any_uri)):
+            # 处理ts URL（支持带鉴权参数的情况）
+            uri = line
+            segment_url = join_segment_url(prefix, playlist_url, uri)
+            if byterange is not None:
+                path = segment_url.split('?', 1)[0]
+                offset = byterange[0] if byterange[0] is not None else next_offsets.get(path, 0)
+                byterange = (offset, byterange[1])
+                next_offsets[path] = offset + byterange[1]
+            segments.append({
+                'uri': uri,
+                'url': segment_url,
+                'sequence': media_sequence + len(segments),
+                'duration': duration,
+                'key': current_key,
+                'byterange': byterange,
+                'map': current_map,
+            })
+            duration = 0.0
+            byterange = None
+            has_extinf = False
+    
+    container = 'fmp4' if any(segment['map'] for segment in segments) else 'ts'
+    if container == 'ts' and segments and not ts_url_search(segments[0]['uri']):
+        container = media_container(segments[0]['uri'])
+    return {'variants': variants, 'media': media, 'segments': segments, 'container': container}
+
+
+def media_container(uri):
+    """按片段扩展名判断独立轨道的片段格式：aac（ADTS音频）、webvtt（字幕），其余按ts处理"""
+    ext = os.path.splitext(uri.split('?', 1)[0])[1].lower()
+    if ext in ('.aac', '.adts'):
+        return 'aac'
+    if ext in ('.vtt', '.webvtt'):
+        return 'webvtt'
+    return 'ts'
+
+
+def signed_url_expiry(url):
+    """从签名URL的查询参数中解析过期时间，无法确定时返回None"""
+    if '?' not in url:
+        return None
+    params = parse_qs(url.split('?', 1)[1])
+    for name, values in params.items():
+        value = values[0]
+        lower_name = name.lower()
+        if lower_name in SIGNED_EXPIRY_PARAMS and value.isdigit() and len(value) == 10:
+            return int(value)
+        if lower_name == 'auth_key':
+            # 常见CDN的auth_key格式为 "过期时间戳-随机数-用户ID-哈希"
+            timestamp = value.split('-', 1)[0]
+            if timestamp.isdigit() and len(timestamp) == 10:
+                return int(timestamp)
+    return None
+
+
+def fetch_playlist_keys(segments):
+    """下载播放列表中用到的AES密钥，并为每个片段生成解密参数"""
+    keys = {}
+    for segment in segments:
+        key = segment['key']
+        if key is None:
+            continue
+        if key['url'] not in keys:
+            resp = http_session().get(key['url'], timeout=10)
+            resp.raise_for_status()
+            keys[key['url']] = resp.content
+        if key['iv']:
+            iv = bytes.fromhex(key['iv'][2:] if key['iv'].lower().startswith('0x') else key['iv'])
+        else:
+            # 未指定IV时使用片段序号作为IV
+            iv = segment['sequence'].to_bytes(16, 'big')
+        segment['key'] = {'method': key['method'], 'url': key['url'], 'key': keys[key['url']], 'iv': iv}
+    return keys
+
+
+def preview_lines(items, limit, unit, total=None):
+    """详细模式的输出预览：只显示前limit项，避免大播放列表的控制台输出拖慢解析"""
+    total = len(items) if total is None else total
+    text = '\n'.join(items[:limit])
+    if total > limit:
+        text += f"\n...（共{total}{unit}，只显示前{limit}{unit}）"
+    return text
+
+
+@profile_stage('playlist')
+def resolve_playlist(url, verbose=True, avoid_hosts=()):
+    """完整解析一个m3u8地址：选择多码率变体、解析片段列表并下载AES密钥
+
+    avoid_hosts: 码率最高的变体有多个（不同主机上的镜像）时，优先选择不在其中的主机
+
+    返回播放列表字典，失败时返回None：
+    url: 原始m3u8地址；media_url: 实际的媒体播放列表地址；base_url: 片段基础URL
+    segments: 片段列表；container: 片段格式（ts或fmp4）；keys: 密钥
+    bandwidth: 所选多码率变体的码率（bit/s，单一码率播放列表为None）
+    renditions: 与所选变体配套的独立音频、字幕轨道（见resolve_rendition），没有时为空列表
+    resolved_at: 解析时间；expires_at: 签名URL最早过期时间
+    """
+    try:
+        media_url = url
+        bandwidth = None
+        master_media = []
+        variant = None
+        for _ in range(3):
+            resp = http_session().get(media_url, timeout=10)
+            resp.raise_for_status()
+            data = resp.text
+            if verbose:
+                print("获取到的m3u8内容:")
+                print(preview_lines(data.splitlines(), PLAYLIST_PREVIEW_LINES, '行'))
+            parsed = parse_m3u8(data, media_url)
+            if parsed['variants'] and not parsed['segments']:
+                # 多码率播放列表，选择码率最高的变体
+                variant = max(parsed['variants'],
+                              key=lambda v: (v['bandwidth'], urlparse(v['url']).hostname not in avoid_hosts))
+                if verbose:
+                    print(f"检测到多码率播放列表，选择码率 {variant['bandwidth']} 的变体: {variant['url']}")
+                media_url = variant['url']
+                bandwidth = variant['bandwidth'] or None
+                master_media = parsed['media']
+                continue
+            break
+        
+        segments = parsed['segments']
+        if verbose:
+            print("匹配到的ts文件名:")
+            print(preview_lines([segment['uri'] for segment in segments[:PLAYLIST_PREVIEW_LINES + 1]],
+                                PLAYLIST_PREVIEW_LINES, '个', total=len(segments)))
+        if not segments:
+            print("没有匹配到任何ts文件")
+            return None
+        
+        keys = fetch_playlist_keys(segments)
+        
+        renditions = []
+        for media in select_renditions(master_media, variant) if variant else []:
+            rendition = resolve_rendition(media, verbose)
+            if rendition is None:
+                if media['type'] == 'AUDIO':
+                    # 视频变体不含音频，缺少音频轨道时不下载，避免得到无声的视频
+                    return None
+                continue
+            renditions.append(rendition)
+        
+        # 片段的签名一般相同，检查首尾片段和密钥地址即可
+        expiry_urls = [segments[0]['url'], segments[-1]['url']] + list(keys)
+        for rendition in renditions:
+            expiry_urls += [rendition['segments'][0]['url'], rendition['segments'][-1]['url']] + list(rendition['keys'])
+        expiries = [signed_url_expiry(u) for u in expiry_urls]
+        expiries = [e for e in expiries if e is not None]
+        
+        url_without_query = media_url.split('?')[0]
+        return {
+            'url': url,
+            'media_url': media_url,
+            'base_url': url_without_query.rsplit('/', 1)[0] + '/',
+            'segments': segments,
+            'container': parsed['container'],
+            'bandwidth': bandwidth,
+            'keys': keys,
+            'renditions': renditions,
+            'resolved_at': time.time(),
+            'expires_at': min(expiries) if expiries else None,
+        }
+    except requests.exceptions.RequestException as e:
+        print(f"获取m3u8信息错误: {e}")
+        logging.error(f"获取m3u8信息错误: {e}")
+        return None
+
+
+def select_renditions(media, variant):
+    """选择与变体配套的独立轨道：音频轨道组中选一个（优先PREFERRED_AUDIO_LANGUAGE，其次DEFAULT=YES），
+    字幕轨道组全部下载（DOWNLOAD_SUBTITLES为False时不下载）
+
+    音频轨道没有URI表示音频已包含在视频变体中，不需要单独下载。
+    """
+    chosen = []
+    audio = [m for m in media if m['type'] == 'AUDIO' and m['group'] == variant.get('audio')]
+    if audio:
+        preferred = [m for m in audio if PREFERRED_AUDIO_LANGUAGE and m['language'] == PREFERRED_AUDIO_LANGUAGE]
+        pick = (preferred or [m for m in audio if m['default']] or audio)[0]
+        if pick['url']:
+            chosen.append(pick)
+    if DOWNLOAD_SUBTITLES:
+        chosen += [m for m in media if m['type'] == 'SUBTITLES' and m['group'] == variant.get('subtitles')
+                   and m['url']]
+    return chosen
+
+
+def resolve_rendition(media, verbose=True):
+    """解析一个独立音频或字幕轨道的播放列表，失败时返回None
+
+    返回字典：type（audio或subtitles）、name、language、media_url、segments、container、keys
+    """
+    kind = 'audio' if media['type'] == 'AUDIO' else 'subtitles'
+    label = f"{'音频' if kind == 'audio' else '字幕'}轨道 {media['name'] or media['language'] or ''}".rstrip()
+    try:
+        resp = http_session().get(media['url'], timeout=10)
+        resp.raise_for_status()
+        parsed = parse_m3u8(resp.text, media['url'], any_uri=True)
+        segments = parsed['segments']
+        if not segments:
+            print(f"{label} 没有匹配到任何片段")
+            logging.warning(f"{label} 没有匹配到任何片段: {media['url']}")
+            return None
+        keys = fetch_playlist_keys(segments)
+    except requests.exceptions.RequestException as e:
+        print(f"获取{label}错误: {e}")
+        logging.error(f"获取{label}错误: {e}")
+        return None
+    if verbose:
+        print(f"{label}: {len(segments)} 个片段（{parsed['container']}）")
+    return {
+        'type': kind,
+        'name': media['name'],
+        'language': media['language'],
+        'media_url': media['url'],
+        'segments': segments,
+        'container': parsed['container'],
+        'keys': keys,
+    }
+
+
+def playlist_needs_refresh(playlist, now=None):
+    """判断预取的播放列表是否因签名过期需要重新解析"""
+    now = now or time.time()
+    if playlist['expires_at'] is not None:
+        return playlist['expires_at'] - now < PREFETCH_EXPIRY_MARGIN
+    signed = '?' in playlist['segments'][0]['url'] or any('?' in key_url for key_url in playlist['keys'])
+    return signed and now - playlist['resolved_at'] > PREFETCH_MAX_AGE
+
+
+def get_m3u8_info(url):
+    """获取m3u8文件信息并返回ts文件列表和基础URL"""
+    playlist = resolve_playlist(url)
+    if not playlist:
+        return [], ""
+    return [segment['uri'] for segment in playlist['segments']], playlist['base_url']
+
+
+class PlaylistPrefetcher:
+    """播放列表预取器
+
+    当前集下载期间，在后台解析后续若干集的播放列表、多码率变体和AES密钥，
+    新一集开始时无需再等待播放列表请求；取用时若签名已过期或即将过期则重新解析。
+    """
+    def __init__(self, lookahead=PREFETCH_LOOKAHEAD):
+        self.lookahead = lookahead
+        self._futures = {}
+        self._executor = None
+        if lookahead > 0:
+            self._executor = futures.ThreadPoolExecutor(max_workers=lookahead, thread_name_prefix='prefetch')
+    
+    def schedule(self, urls):
+        """提交后台解析任务（已提交过的地址不会重复解析）"""
+        if self._executor is None:
+            return
+        for url in urls:
+            if url not in self._futures:
+                self._futures[url] = self._executor.submit(resolve_playlist, url, False)
+    
+    def peek(self, url):
+        """返回已经解析完成的预取结果（不取出），还在解析、没有预取或预取失败时返回None"""
+        future = self._futures.get(url)
+        if future is None or not future.done() or future.cancelled() or future.exception() is not None:
+            return None
+        return future.result()
+    
+    def get(self, url):
+        """取出预取结果，没有预取或预取失败时返回None，由调用方自行解析"""
+        future = self._futures.pop(url, None)
+        if future is None:
+            return None
+        try:
+            playlist = future.result()
+        except Exception as e:
+            logging.error(f"预取播放列表失败 {url}: {e}")
+            return None
+        if playlist and playlist_needs_refresh(playlist):
+            print("预取的播放列表签名即将过期，重新解析...")
+            logging.info(f"预取的播放列表签名即将过期，重新解析: {url}")
+            playlist = resolve_playlist(url, verbose=False)
+        return playlist
+    
+    def shutdown(self):
+        """取消尚未开始的预取任务"""
+        if self._executor is not None:
+            for future in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=False)
+
+
+# 签名过期相关常量
+AUTH_EXPIRED_STATUS_CODES = (401, 403, 410)  # 视为签名过期的HTTP状态码
+PLAYLIST_REFRESH_LIMIT = 3  # 每集下载过程中最多重新解析播放列表的次数
+
+
+# 缺失片段修复相关常量
+REPAIR_ROUNDS = 2  # 主下载结束后，重新获取播放列表、换用新连接重试缺失片段的轮数
+GAP_TOLERANCE = 0  # 修复后仍允许缺失的视频/音频片段数（命令行--gap-tolerance），超过时不合并、标记为失败
+GAP_RECORD_LIMIT = 20  # 任务状态中最多记录的缺失片段序号个数
+
+
+def _segment_path_key(url):
+    """去掉查询参数后的片段地址，用于在新旧播放列表之间对应片段"""
+    return url.split('?', 1)[0]
+
+
+class PlaylistRefresher:
+    """下载过程中签名过期时重新解析播放列表
+
+    同一集的所有下载线程共享一个实例：第一个遇到401/403/410的线程负责重新解析，
+    其他线程发现版本号已经变化就直接使用新地址，多个线程的刷新请求合并为一次。
+    新旧播放列表的片段按序号对应（序号对不上时按去掉签名后的路径对应）。
+    """
+    def __init__(self, m3u8_url, playlist, limit=PLAYLIST_REFRESH_LIMIT):
+        self.m3u8_url = m3u8_url
+        self.limit = limit
+        self.generation = 0
+        self.refresh_count = 0
+        self._lock = threading.Lock()
+        self._by_sequence = {segment['sequence']: segment for segment in playlist['segments']}
+        self._original_paths = {sequence: _segment_path_key(segment['url'])
+                                for sequence, segment in self._by_sequence.items()}
+    
+    def current(self, sequence):
+        """返回 (版本号, 片段信息)，片段信息包含当前有效的url和key"""
+        generation = self.generation
+        return generation, self._by_sequence.get(sequence)
+    
+    def refresh(self, seen_generation):
+        """请求刷新播放列表，返回调用方是否应使用新地址重试
+
+        seen_generation: 调用方失败时所用地址的版本号
+        """
+        with self._lock:
+            if self.generation != seen_generation:
+                # 其他线程已经刷新过
+                return True
+            if self.refresh_count >= self.limit:
+                return False
+            self.refresh_count += 1
+            print(f"\n片段签名已失效，重新解析播放列表（第{self.refresh_count}次）...")
+            logging.info(f"片段签名已失效，重新解析播放列表（第{self.refresh_count}次）: {self.m3u8_url}")
+            playlist = resolve_playlist(self.m3u8_url, verbose=False)
+            if not playlist:
+                return False
+            self._apply(playlist)
+            return True
+    
+    def reload(self, avoid_hosts=()):
+        """修复缺失片段前强制重新解析播放列表（不计入刷新次数），返回是否成功
+
+        avoid_hosts: 出现失败的主机；多码率播放列表中有同码率的镜像变体时优先选择其他主机上的
+        """
+        with self._lock:
+            playlist = resolve_playlist(self.m3u8_url, verbose=False, avoid_hosts=avoid_hosts)
+            if not playlist:
+                return False
+            self._apply(playlist)
+            return True
+    
+    def _apply(self, playlist):
+        """按序号（或去掉签名后的路径）把新播放列表的片段对应到原片段（调用时持有锁）"""
+        by_sequence = {segment['sequence']: segment for segment in playlist['segments']}
+        by_path = {_segment_path_key(segment['url']): segment for segment in playlist['segments']}
+        remapped = {}
+        for sequence, path in self._original_paths.items():
+            segment = by_sequence.get(sequence)
+            if segment is None or _segment_path_key(segment['url']) != path:
+                segment = by_path.get(path, segment)
+            if segment is not None:
+                remapped[sequence] = segment
+        missing = len(self._original_paths) - len(remapped)
+        if missing:
+            logging.warning(f"重新解析后有{missing}个片段无法对应: {self.m3u8_url}")
+        # 无法对应的片段保留旧地址
+        for sequence, segment in self._by_sequence.items():
+            remapped.setdefault(sequence, segment)
+        self._by_sequence = remapped
+        self.generation += 1
+
+
+def _load_aes_decryptor():
+    """加载AES-128-CBC解密实现（可选依赖pycryptodome或cryptography），都不存在时返回None"""
+    try:
+        from Crypto.Cipher import AES
+        return lambda key, iv, data: AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+    except ImportError:
+        pass
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        
+        def decrypt(key, iv, data):
+            decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+            return decryptor.update(data) + decryptor.finalize()
+        return decrypt
+    except ImportError:
+        return None
+
+
+def decrypt_segment(data, key):
+    """解密AES-128加密的片段并去除PKCS7填充"""
+    decryptor = _load_aes_decryptor()
+    if decryptor is None:
+        raise RuntimeError("未安装pycryptodome或cryptography，无法解密AES-128加密的片段")
+    if len(data) % 16:
+        raise SegmentValidationError(f"加密片段长度 {len(data)} 不是16字节的整数倍")
+    plain = decryptor(key['key'], key['iv'], bytes(data))
+    padding = plain[-1] if plain else 0
+    if 1 <= padding <= 16:
+        plain = plain[:-padding]
+    return plain
+
+
+# 连接复用与DNS缓存相关常量
+HTTP_POOL_HOSTS = 16  # 共享会话中保留连接池的主机数
+HTTP_POOL_MAXSIZE = 32  # 每个主机最多保留的空闲连接数（应不少于下载线程数）
+DNS_CACHE_TTL = 300  # DNS解析结果的缓存时间（秒），安装了dnspython时在后台查询记录实际的TTL，0表示不缓存
+DNS_CACHE_MIN_TTL = 30  # 使用实际TTL时的下限（秒），避免TTL很短的CDN频繁重新解析
+DNS_CACHE_MAX_TTL = 3600  # 使用实际TTL时的上限（秒）
+PREWARM_CONNECTIONS = 4  # 开始下载片段前与片段主机预先建立的连接数（命令行--prewarm），0表示不预热
+PREWARM_TIMEOUT = 10  # 预热连接的HEAD请求超时时间（秒）
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_dns_cache = None
+_prewarm_state = threading.local()  # 当前线程是否在发送预热请求
+
+
+class ConnectionStats:
+    """按主机统计连接建立开销：DNS解析次数和耗时、缓存命中、新建连接（含预热）次数和耗时、请求数
+
+    请求数减去新建连接数即为复用已有连接的次数，据此估算DNS缓存和连接复用节省的时间。
+    """
+    def __init__(self):
+        self._hosts = {}
+        self._lock = threading.Lock()
+    
+    def _host(self, host):
+        return self._hosts.setdefault(host, {'requests': 0, 'connects': 0, 'connect_time': 0.0, 'prewarmed': 0,
+                                             'dns_lookups': 0, 'dns_time': 0.0, 'dns_hits': 0})
+    
+    def record_dns(self, host, seconds=None):
+        """记录一次DNS解析（seconds为None表示缓存命中）"""
+        with self._lock:
+            state = self._host(host)
+            if seconds is None:
+                state['dns_hits'] += 1
+            else:
+                state['dns_lookups'] += 1
+                state['dns_time'] += seconds
+    
+    def record_connect(self, host, seconds, prewarmed=False):
+        """记录一次新建连接（TCP握手和TLS握手，含DNS解析）"""
+        with self._lock:
+            state = self._host(host)
+            state['connects'] += 1
+            state['connect_time'] += seconds
+            if prewarmed:
+                state['prewarmed'] += 1
+    
+    def record_request(self, host):
+        with self._lock:
+            self._host(host)['requests'] += 1
+    
+    def summary_lines(self):
+        """每个主机一行的统计描述"""
+        lines = []
+        with self._lock:
+            hosts = {host: dict(state) for host, state in self._hosts.items()}
+        for host, state in sorted(hosts.items(), key=lambda item: -item[1]['requests']):
+            avg_connect = state['connect_time'] / state['connects'] if state['connects'] else 0.0
+            avg_dns = state['dns_time'] / state['dns_lookups'] if state['dns_lookups'] else 0.0
+            # 预热的连接在请求之前建立，同样不占用请求的时间
+            reused = max(state['requests'] - state['connects'] + state['prewarmed'], 0)
+            saved = reused * avg_connect + state['dns_hits'] * avg_dns
+            lines.append(f"{host}: 请求 {state['requests']} 次，新建连接 {state['connects']} 次"
+                         f"（平均 {avg_connect * 1000:.1f}ms，其中预热 {state['prewarmed']} 次），"
+                         f"DNS解析 {state['dns_lookups']} 次（平均 {avg_dns * 1000:.1f}ms），缓存命中 {state['dns_hits']} 次，"
+                         f"复用连接 {reused} 次，约节省 {saved:.2f}秒")
+        return lines
+
+
+CONNECTION_STATS = ConnectionStats()
+
+
+class DnsCache:
+    """共享会话使用的DNS缓存（只影响http_session建立的连接，不替换全局的socket.getaddrinfo）
+
+    解析结果按DNS_CACHE_TTL缓存；安装了dnspython时在后台查询记录的实际TTL（限制在
+    [DNS_CACHE_MIN_TTL, DNS_CACHE_MAX_TTL] 内）并更新过期时间，不阻塞建立连接。
+    过期后重新解析失败时继续使用过期的结果，DNS服务器短暂故障不会中断下载。IP地址不经过缓存。
+    """
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._ttl_lookup = None  # 是否可以用dnspython查询TTL（第一次需要时检查）
+    
+    def _refine_ttl(self, key, resolved_at):
+        """后台用dnspython查询记录的TTL，更新缓存条目的过期时间"""
+        try:
+            import dns.resolver
+            answer = dns.resolver.resolve(key[0], 'A', lifetime=2)
+        except Exception:
+            return
+        ttl = min(max(answer.rrset.ttl, DNS_CACHE_MIN_TTL), DNS_CACHE_MAX_TTL)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] == resolved_at:
+                self._entries[key] = (resolved_at + ttl, entry[1], resolved_at)
+    
+    def resolve(self, host, port):
+        """返回host可以连接的地址列表，host本身是IP地址时返回None（由连接自行处理）"""
+        import ipaddress
+        import socket
+        import urllib3.util.connection
+        try:
+            ipaddress.ip_address(host.strip('[]'))
+            return None
+        except ValueError:
+            pass
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            CONNECTION_STATS.record_dns(host)
+            return list(entry[1])
+        start = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(host, port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError as e:
+            if entry is None:
+                raise
+            logging.warning(f"重新解析 {host} 失败（{e}），继续使用过期的解析结果")
+            return list(entry[1])
+        CONNECTION_STATS.record_dns(host, time.perf_counter() - start)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        resolved_at = time.monotonic()
+        with self._lock:
+            self._entries[key] = (resolved_at + self.ttl, addresses, resolved_at)
+        if self._ttl_lookup is None:
+            import importlib.util
+            self._ttl_lookup = importlib.util.find_spec('dns') is not None
+        if self._ttl_lookup:
+            threading.Thread(target=self._refine_ttl, args=(key, resolved_at), name='dns-ttl', daemon=True).start()
+        return addresses
+    
+    def forget(self, hosts):
+        """删除这些主机的缓存，下次连接时重新解析（可能得到其他CDN节点）"""
+        with self._lock:
+            self._entries = {key: entry for key, entry in self._entries.items() if key[0] not in hosts}
+
+
+def http_session():
+    """获取所有请求共用的requests会话
+
+    同一主机的连接在请求之间保持复用（不再每次请求都重新解析DNS、握手），
+    会话的连接使用DnsCache解析主机名，并统计每个主机的连接建立开销（见ConnectionStats）。
+    """
+    global _http_session, _dns_cache
+    with _http_session_lock:
+        if _http_session is not None:
+            return _http_session
+        import urllib3
+        
+        dns_cache = DnsCache() if DNS_CACHE_TTL > 0 else None
+        
+        def timed(connection_class):
+            class TimedConnection(connection_class):
+                def connect(self):
+                    start = time.perf_counter()
+                    host = self.host
+                    addresses = None
+                    if dns_cache is not None and self.proxy is None:
+                        try:
+                            addresses = dns_cache.resolve(host, self.port)
+                        except OSError:
+                            addresses = None  # 交给urllib3解析并报告错误
+                    if not addresses:
+                        super().connect()
+                    else:
+                        self._connect_resolved(host, addresses)
+                    CONNECTION_STATS.record_connect(host, time.perf_counter() - start,
+                                                    getattr(_prewarm_state, 'active', False))
+                
+                def _connect_resolved(self, host, addresses):
+                    """依次连接解析出的地址；TLS的SNI、证书校验和请求的Host头仍使用原来的主机名"""
+                    tls = hasattr(self, 'server_hostname')
+                    server_hostname = self.server_hostname if tls else None
+                    if tls and server_hostname is None:
+                        self.server_hostname = host
+                    try:
+                        for i, address in enumerate(addresses):
+                            self.host = address
+                            try:
+                                super().connect()
+                                return
+                            except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError):
+                                if i == len(addresses) - 1:
+                                    raise
+                    finally:
+                        self.host = host
+                        if tls:
+                            self.server_hostname = server_hostname
+            return TimedConnection
+        
+        class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+            ConnectionCls = timed(urllib3.connection.HTTPConnection)
+        
+        class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+            ConnectionCls = timed(urllib3.connection.HTTPSConnection)
+        
+        def record_request(resp, *args, **kwargs):
+            # 预热请求只用于建立连接，不计入请求数
+            if not getattr(_prewarm_state, 'active', False):
+                CONNECTION_STATS.record_request(urlparse(resp.url).hostname)
+        
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+        adapter.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                      'https': TimedHTTPSConnectionPool}
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(record_request)
+        _dns_cache = dns_cache
+        _http_session = session
+        return session
+
+
+def reset_connections(hosts):
+    """关闭共享会话中这些主机的连接池，并清除它们的DNS缓存，之后的请求重新解析、重新建立连接
+
+    其他主机的空闲连接不受影响；进行中的请求结束后，连接随已关闭的连接池一起关闭。
+    """
+    hosts = set(hosts)
+    with _http_session_lock:
+        session, dns_cache = _http_session, _dns_cache
+    if dns_cache is not None:
+        dns_cache.forget(hosts)
+    if session is None:
+        return
+    for adapter in set(session.adapters.values()):
+        for manager in [adapter.poolmanager, *adapter.proxy_manager.values()]:
+            for key in manager.pools.keys():
+                if key.key_host in hosts:
+                    # 从容器中删除时会关闭该连接池
+                    manager.pools.pop(key, None)
+
+
+def _prewarm_request(url):
+    """发送一个HEAD请求建立连接，返回未读取的响应（连接在响应释放前不会被其他请求使用）"""
+    _prewarm_state.active = True
+    try:
+        return http_session().head(url, stream=True, timeout=PREWARM_TIMEOUT, allow_redirects=False)
+    finally:
+        _prewarm_state.active = False
+
+
+def _prewarm(url, count):
+    """同时发出count个HEAD请求，全部结束后再把连接交还连接池，保证建立的是count个不同的连接"""
+    responses = []
+    with futures.ThreadPoolExecutor(max_workers=count, thread_name_prefix='prewarm') as executor:
+        for future in [executor.submit(_prewarm_request, url) for _ in range(count)]:
+            try:
+                responses.append(future.result())
+            except requests.exceptions.RequestException as e:
+                logging.info(f"预热连接失败 {urlparse(url).netloc}: {e}")
+    for resp in responses:
+        # 读完（空的）响应体后关闭，连接交还连接池
+        resp.content
+        resp.close()
+
+
+def prewarm_connections(url, count=None):
+    """在后台与url所在主机预先建立count个连接（不等待完成），片段下载开始时直接复用
+
+    使用代理池时连接建立在代理上，不预热。
+    """
+    count = PREWARM_CONNECTIONS if count is None else count
+    if count <= 0 or len(PROXY_POOL):
+        return
+    threading.Thread(target=_prewarm, args=(url, min(count, HTTP_POOL_MAXSIZE)), name='prewarm',
+                     daemon=True).start()
+
+
+# 接收缓冲区相关常量
+RECEIVE_BUFFER_SIZE = 1024 * 1024  # 接收缓冲区大小（字节），攒满一块才写入磁盘，可用--buffer-size调整
+RECEIVE_READ_SIZE = 256 * 1024  # 单次从连接读取的最大字节数
+RECEIVE_BUFFER_ALIGN = 64 * 1024  # 缓冲区大小向上对齐到该值的整数倍，写入偏移保持对齐
+RECEIVE_POOL_LIMIT = 32  # 缓冲区池最多保留的空闲缓冲区个数
+
+
+class BufferPool:
+    """可复用的接收缓冲区池
+
+    下载线程从池中借出预先分配的bytearray，用readinto直接把网络数据读进去，
+    用完归还，不再为每个数据块创建新的bytes对象。缓冲区大小调整后，旧尺寸的缓冲区归还时直接丢弃。
+    """
+    def __init__(self, size=RECEIVE_BUFFER_SIZE, limit=RECEIVE_POOL_LIMIT):
+        self.size = size
+        self.limit = limit
+        self._free = []
+        self._lock = threading.Lock()
+        self.allocated = 0  # 累计新分配的缓冲区个数
+    
+    def resize(self, size):
+        """修改缓冲区大小（向上对齐到RECEIVE_BUFFER_ALIGN），清空已有的空闲缓冲区"""
+        size = max(RECEIVE_BUFFER_ALIGN, -(-size // RECEIVE_BUFFER_ALIGN) * RECEIVE_BUFFER_ALIGN)
+        with self._lock:
+            self.size = size
+            self._free = []
+        return size
+    
+    def acquire(self):
+        """借出一个缓冲区，池为空时新分配"""
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocated += 1
+            size = self.size
+        return bytearray(size)
+    
+    def release(self, buffer):
+        """归还缓冲区"""
+        with self._lock:
+            if len(buffer) == self.size and len(self._free) < self.limit:
+                self._free.append(buffer)
+
+
+RECEIVE_BUFFERS = BufferPool()
+
+
+def set_receive_buffer_size(size):
+    """调整接收缓冲区大小，返回对齐后的实际大小"""
+    return RECEIVE_BUFFERS.resize(size)
+
+
+def _response_reader(resp):
+    """返回把响应体读入缓冲区的函数 readinto(view) -> 读取的字节数，0表示结束
+
+    未压缩的响应调用urllib3响应对象的readinto，直接读入缓冲区，不经过iter_content逐块产生的bytes对象；
+    经过压缩传输的响应需要解压，退回iter_content再复制进缓冲区。
+    读取时的连接错误转换为requests的ConnectionError，与iter_content的行为一致。
+    """
+    import urllib3.exceptions
+    if resp.headers.get('content-encoding', 'identity') == 'identity' and hasattr(resp.raw, 'readinto'):
+        raw = resp.raw
+        
+        def readinto(view):
+            try:
+                return raw.readinto(view)
+            except (OSError, urllib3.exceptions.HTTPError) as e:
+                raise requests.exceptions.ConnectionError(e) from e
+        return readinto
+    
+    chunks = resp.iter_content(chunk_size=RECEIVE_READ_SIZE)
+    pending = memoryview(b'')
+    
+    def readinto(view):
+        nonlocal pending
+        while not pending:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return 0
+            pending = memoryview(chunk)
+        count = min(len(view), len(pending))
+        view[:count] = pending[:count]
+        pending = pending[count:]
+        return count
+    return readinto
+
+
+def receive_response(resp, write, on_data=None, cancel=None):
+    """把响应体读入池中的缓冲区，攒满一整块后调用一次write，返回接收的总字节数
+
+    write(view): 写出一块数据（memoryview），除最后一块外大小都等于缓冲区大小
+    on_data(view): 每次读取后调用，用于校验和进度统计；view在回调返回后会被覆盖，不能保存
+    cancel: 可选的CancelToken，超过宽限期时抛出DownloadCancelled
+    正常读完时连接交还连接池；出错、校验失败或被取消时关闭响应，连接不会被遗留在半读状态。
+    """
+    readinto = _response_reader(resp)
+    buffer = RECEIVE_BUFFERS.acquire()
+    view = memoryview(buffer)
+    size = len(buffer)
+    filled = 0
+    total = 0
+    try:
+        while True:
+            if cancel is not None and cancel.expired():
+                raise DownloadCancelled(cancel.reason)
+            count = readinto(view[filled:min(filled + RECEIVE_READ_SIZE, size)])
+            if not count:
+                break
+            if on_data is not None:
+                on_data(view[filled:filled + count])
+            filled += count
+            total += count
+            if filled == size:
+                write(view)
+                filled = 0
+        if cancel is not None and cancel.expired():
+            # 被abort()关闭的连接可能表现为正常结束
+            raise DownloadCancelled(cancel.reason)
+        if filled:
+            write(view[:filled])
+        # 响应体已经读完，先把连接交还给连接池，之后的close不会再关闭它
+        resp.raw.release_conn()
+    finally:
+        RECEIVE_BUFFERS.release(buffer)
+        resp.close()
+    return total
+
+
+# Range拆分下载相关常量
+RANGE_SPLIT_THRESHOLD = 16 * 1024 * 1024  # 超过该大小的片段拆分为多个Range并行下载
+RANGE_CHUNK_SIZE = 4 * 1024 * 1024  # 拆分下载时每个Range分块的大小
+RANGE_SPLIT_WORKERS = 8  # Range分块下载的并发连接数
+RANGE_COALESCE_MAX_BYTES = 8 * 1024 * 1024  # 字节范围播放列表中相邻范围合并后的最大请求大小
+
+_range_executor = None
+_range_executor_lock = threading.Lock()
+
+
+def _get_range_executor():
+    """获取Range分块下载共用的线程池（与片段线程池分开，避免互相等待造成死锁）"""
+    global _range_executor
+    with _range_executor_lock:
+        if _range_executor is None:
+            _range_executor = futures.ThreadPoolExecutor(max_workers=RANGE_SPLIT_WORKERS, thread_name_prefix='range')
+        return _range_executor
+
+
+def build_download_units(segments, max_bytes=RANGE_COALESCE_MAX_BYTES):
+    """把片段列表转换为下载单元
+
+    字节范围播放列表中，同一文件首尾相接的范围合并为一个请求（不超过max_bytes），
+    减少请求次数，合并后的下载单元再由线程池并行下载。
+    返回 [{"uri", "url", "key", "sequence", "sequences", "byterange", "map"}]，sequence为首个片段的序号。
+    """
+    units = []
+    for segment in segments:
+        byterange = segment.get('byterange')
+        last = units[-1] if units else None
+        if (byterange and last and last['byterange'] and segment['key'] is None and last['key'] is None
+                and last['map'] == segment.get('map')
+                and _segment_path_key(last['url']) == _segment_path_key(segment['url'])
+                and sum(last['byterange']) == byterange[0]
+                and last['byterange'][1] + byterange[1] <= max_bytes):
+            last['byterange'] = (last['byterange'][0], last['byterange'][1] + byterange[1])
+            last['sequences'].append(segment['sequence'])
+            continue
+        units.append({
+            'uri': segment['uri'],
+            'url': segment['url'],
+            'key': segment['key'],
+            'sequence': segment['sequence'],
+            'sequences': [segment['sequence']],
+            'byterange': byterange,
+            'map': segment.get('map'),
+        })
+    return units
+
+
+def _download_range(url, path, start, end, progress=None, cancel=None):
+    """下载文件中 [start, end] 字节并写入本地文件的相同偏移处（各分块分别从代理池选择代理）"""
+    proxy = PROXY_POOL.acquire()
+    written = 0
+    started = time.monotonic()
+    resp = None
+    try:
+        resp = http_session().get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True, timeout=10,
+                                  proxies=PROXY_POOL.requests_proxies(proxy))
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            resp.close()
+            raise SegmentValidationError("服务器未按Range请求返回部分内容")
+        if cancel is not None:
+            cancel.track(resp)
+        on_data = None
+        if progress is not None:
+            on_data = lambda data: progress.add_bytes(len(data))
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            written = receive_response(resp, f.write, on_data, cancel)
+    except Exception as e:
+        if cancel is not None and cancel.expired():
+            PROXY_POOL.release(proxy, None)
+            if not isinstance(e, DownloadCancelled):
+                raise DownloadCancelled(cancel.reason) from e
+        else:
+            PROXY_POOL.release(proxy, False)
+        raise
+    finally:
+        if cancel is not None and resp is not None:
+            cancel.untrack(resp)
+    complete = written == end - start + 1
+    PROXY_POOL.release(proxy, complete, written, time.monotonic() - started)
+    if not complete:
+        raise SegmentValidationError(f"Range分块 {start}-{end} 长度不完整: {written}")
+
+
+def download_file_in_ranges(url, path, total_size, progress=None, chunk_size=RANGE_CHUNK_SIZE, cancel=None):
+    """把大文件拆分为多个Range分块并行下载，各分块直接写入文件中对应的偏移位置"""
+    with open(path, 'wb') as f:
+        f.truncate(total_size)
+    executor = _get_range_executor()
+    chunk_futures = [executor.submit(_download_range, url, path, start, min(start + chunk_size, total_size) - 1, progress,
+                                     cancel)
+                     for start in range(0, total_size, chunk_size)]
+    errors = []
+    for future in chunk_futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def validate_ts_file(path, expected_length=None, container='ts'):
+    """校验磁盘上的片段文件（ts、fmp4、aac或webvtt），返回 (校验器, 是否有效, 错误原因)"""
+    validator = new_segment_validator(container)
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            validator.feed(block)
+    valid, reason = validator.finish(expected_length)
+    return validator, valid, reason
+
+
+# 取消与优雅退出相关常量
+SHUTDOWN_GRACE_PERIOD = 10.0  # 收到中断信号后等待进行中请求完成的最长时间（秒），超时后中止
+CANCEL_POLL_INTERVAL = 0.5  # 调度线程和转码等待时检查取消请求的间隔（秒）
+FFMPEG_TERMINATE_TIMEOUT = 5.0  # 通知FFmpeg退出后等待的时间（秒），超时后强制结束
+
+
+class DownloadCancelled(Exception):
+    """下载、合并或转码因收到取消请求而中止"""
+
+
+class CancelToken:
+    """协作式取消令牌：由信号处理器设置，下载、合并和转码在安全的位置检查
+
+    cancel()之后不再开始新的工作，进行中的请求可以在宽限期内完成；
+    宽限期结束（或abort()）后，进行中的请求在下一个数据块处中止，
+    通过track()登记的响应被直接关闭，不必等待下一个数据块到达。
+    """
+    def __init__(self, grace_period=SHUTDOWN_GRACE_PERIOD):
+        self.grace_period = grace_period
+        self.reason = None
+        self._event = threading.Event()
+        self._deadline = None
+        self._lock = threading.Lock()
+        self._active = set()
+    
+    def cancel(self, reason="收到取消请求"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._deadline = time.monotonic() + self.grace_period
+            self._event.set()
+    
+    def abort(self):
+        """立即中止进行中的请求，不再等待宽限期"""
+        self.cancel("立即中止")
+        self._deadline = time.monotonic()
+        with self._lock:
+            active = list(self._active)
+        for resp in active:
+            _interrupt_response(resp)
+    
+    def track(self, resp):
+        """登记进行中的响应，abort()时关闭它使阻塞的读取立即返回"""
+        with self._lock:
+            self._active.add(resp)
+    
+    def untrack(self, resp):
+        with self._lock:
+            self._active.discard(resp)
+    
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+    
+    def expired(self):
+        """是否已超过宽限期，进行中的请求应当立即中止"""
+        return self._deadline is not None and time.monotonic() >= self._deadline
+    
+    def wait(self, timeout=None):
+        """等待timeout秒或直到被取消，被取消时返回True"""
+        return self._event.wait(timeout)
+    
+    def check(self):
+        """已取消时抛出DownloadCancelled，用于开始新工作之前"""
+        if self._event.is_set():
+            raise DownloadCancelled(self.reason)
+
+
+def _interrupt_response(resp):
+    """中断其他线程中正在读取的响应
+
+    只调用close()不能唤醒阻塞在recv上的线程，需要先关闭底层套接字的读写。
+    """
+    import socket
+    sock = getattr(getattr(resp.raw, '_connection', None), 'sock', None)
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        resp.close()
+    except Exception:
+        pass
+
+
+@contextlib.contextmanager
+def handle_shutdown_signals(token):
+    """在with块内把SIGINT/SIGTERM转换为协作式取消
+
+    第一次信号：停止调度新的片段，进行中的请求在宽限期内完成后保存进度退出；
+    第二次信号：立即中止进行中的请求；第三次信号：抛出KeyboardInterrupt。
+    只能在主线程安装，其他线程中调用时不做任何处理。
+    """
+    import signal
+    if threading.current_thread() is not threading.main_thread():
+        yield token
+        return
+    received = []
+    
+    def handler(signum, frame):
+        received.append(signum)
+        if len(received) == 1:
+            print(f"\n收到中断信号，停止调度新的片段，最多等待{token.grace_period:.0f}秒完成进行中的请求并保存进度"
+                  "（再按一次Ctrl-C立即中止）")
+            logging.warning(f"收到信号 {signum}，开始优雅退出")
+            token.cancel(f"收到信号 {signum}")
+        elif len(received) == 2:
+            print("\n立即中止进行中的请求...")
+            logging.warning(f"再次收到信号 {signum}，立即中止")
+            token.abort()
+        else:
+            # 关闭进行中的连接，工作线程不会在进程退出时继续阻塞
+            token.abort()
+            raise KeyboardInterrupt
+    
+    signums = [signal.SIGINT] + ([signal.SIGTERM] if hasattr(signal, 'SIGTERM') else [])
+    previous = {signum: signal.signal(signum, handler) for signum in signums}
+    try:
+        yield token
+    finally:
+        for signum, old in previous.items():
+            signal.signal(signum, old)
+
+
+# 重试策略相关常量
+RETRY_MAX_ATTEMPTS = 5  # 每个片段最多尝试次数
+RETRY_BASE_DELAY = 1.0  # 退避基数（秒），第n次重试的等待上限为 基数*2^n
+RETRY_MAX_DELAY = 30.0  # 单次退避的最大等待时间（秒）
+RETRY_AFTER_MAX = 120.0  # 服务器Retry-After最多遵守的秒数
+RETRYABLE_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)  # 值得重试的HTTP状态码，其余4xx直接失败
+
+# 熔断器相关常量
+BREAKER_FAILURE_THRESHOLD = 5  # 同一主机上连续失败的不同片段达到该数量后暂停请求
+BREAKER_COOLDOWN = 10.0  # 首次熔断的暂停时间（秒），探测失败后加倍
+BREAKER_MAX_COOLDOWN = 120.0  # 熔断暂停时间上限（秒）
+
+
+class SegmentDownloadError(Exception):
+    """单次片段下载失败
+
+    retryable: 是否值得重试（404等直接失败）
+    retry_after: 服务器通过Retry-After要求的等待秒数
+    host_failure: 是否计入主机熔断统计（连接错误、超时、5xx、429）
+    immediate: 是否立即重试（内容校验失败与网络状况无关，不需要退避）
+    """
+    def __init__(self, message, retryable=True, retry_after=None, host_failure=False, immediate=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.host_failure = host_failure
+        self.immediate = immediate
+
+
+def parse_retry_after(value):
+    """解析Retry-After响应头（秒数或HTTP日期），无法解析时返回None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_http_status(resp):
+    """按HTTP状态码把失败响应归类为SegmentDownloadError"""
+    status = resp.status_code
+    message = f"HTTP {status} {resp.reason or ''}".strip()
+    if status in RETRYABLE_STATUS_CODES:
+        return SegmentDownloadError(message, retry_after=parse_retry_after(resp.headers.get('retry-after')),
+                                    host_failure=status >= 500 or status == 429)
+    return SegmentDownloadError(message, retryable=False)
+
+
+class RetryPolicy:
+    """片段下载的重试策略：最多尝试次数 + Full Jitter指数退避，并遵守服务器的Retry-After"""
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def should_retry(self, attempt, error):
+        """attempt: 已经尝试的次数"""
+        return error.retryable and attempt < self.max_attempts
+    
+    def next_delay(self, attempt, error):
+        """第attempt次失败后的等待时间：在 [0, min(上限, 基数*2^attempt)] 内均匀随机，避免多线程同时重试"""
+        if error.immediate:
+            return 0.0
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if error.retry_after is not None:
+            delay = max(delay, min(error.retry_after, RETRY_AFTER_MAX))
+        return delay
+
+
+class HostCircuitBreaker:
+    """按主机的熔断器
+
+    某个CDN节点上连续失败的不同片段达到阈值后，所有发往它的请求暂停一段时间；冷却结束后只放行一个探测请求，
+    探测成功则恢复，失败则加倍暂停时间。
+    同一个片段反复失败（源站上个别对象损坏）只计一次，不会让整个主机熔断，该片段由重试次数上限结束。
+    """
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN,
+                 max_cooldown=BREAKER_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._hosts = {}
+        self._lock = threading.Lock()
+    
+    def before_request(self, host):
+        """请求前调用，返回需要等待的秒数（0表示可以立即请求）"""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state['open_until'] is None:
+                return 0.0
+            now = time.monotonic()
+            if now < state['open_until']:
+                return state['open_until'] - now
+            if state['probing']:
+                # 半开状态：已有探测请求在进行，其他请求稍后再试
+                return min(1.0, state['cooldown'])
+            state['probing'] = True
+            return 0.0
+    
+    def release_probe(self, host):
+        """探测请求没有得出结果（被取消或出现与主机无关的异常）时调用，下一个请求重新作为探测"""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is not None:
+                state['probing'] = False
+    
+    def record_success(self, host):
+        """主机正常响应，关闭熔断"""
+        with self._lock:
+            if self._hosts.pop(host, None) is not None:
+                logging.info(f"主机 {host} 恢复正常")
+    
+    def record_failure(self, host, retry_after=None, key=None):
+        """记录一次主机故障（连接错误、超时、5xx、429），本次故障导致熔断时返回True
+
+        key: 失败的请求对象（片段地址），提供时只按不同对象计数；未提供时每次失败都计数
+        """
+        with self._lock:
+            state = self._hosts.setdefault(host, {'failures': 0, 'keys': set(), 'open_until': None,
+                                                  'cooldown': self.cooldown, 'probing': False})
+            now = time.monotonic()
+            if state['open_until'] is not None and now < state['open_until']:
+                return False
+            if key is None:
+                state['failures'] += 1
+            elif key not in state['keys']:
+                state['keys'].add(key)
+                state['failures'] += 1
+            if not state['probing'] and state['failures'] < self.threshold:
+                return False
+            if state['probing']:
+                state['cooldown'] = min(state['cooldown'] * 2, self.max_cooldown)
+            state['probing'] = False
+            pause = max(state['cooldown'], min(retry_after or 0, RETRY_AFTER_MAX))
+            state['open_until'] = now + pause
+        print(f"\n主机 {host} 连续失败{state['failures']}次，暂停请求{pause:.0f}秒")
+        logging.warning(f"主机 {host} 连续失败{state['failures']}次，暂停请求{pause:.0f}秒")
+        return True
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+# 所有剧集共享的熔断器，一个节点故障时所有下载线程一起暂停
+CIRCUIT_BREAKER = HostCircuitBreaker()
+
+
+# 代理池相关常量
+PROXY_LIST = []  # 下载片段使用的HTTP/SOCKS代理，如 'http://10.0.0.2:3128'、'socks5h://10.0.0.3:1080 2'（空格后为权重，默认1），也可用--proxy指定
+PROXY_HEALTH_WINDOW = 20  # 健康评分统计每个代理最近多少次请求
+PROXY_MIN_SAMPLES = 5  # 代理至少完成这么多次请求后才参与淘汰判断
+PROXY_MIN_SUCCESS_RATE = 0.5  # 最近请求的成功率低于该值时淘汰
+PROXY_SLOW_RATIO = 0.2  # 吞吐量低于池中最快代理的该比例时淘汰
+PROXY_THROUGHPUT_ALPHA = 0.3  # 吞吐量指数移动平均的平滑系数
+PROXY_EVICT_COOLDOWN = 300.0  # 被淘汰的代理经过该秒数后清零评分重新试用
+PROXY_BANNED_STATUS_CODES = (407,)  # 代理本身拒绝服务的状态码，出现时立即淘汰该代理
+
+
+def parse_proxy_spec(spec):
+    """解析代理配置 '地址 [权重]'，返回 (地址, 权重)"""
+    parts = spec.split()
+    if not parts:
+        raise ValueError("代理地址为空")
+    url = parts[0]
+    if '://' not in url:
+        url = 'http://' + url
+    weight = float(parts[1]) if len(parts) > 1 else 1.0
+    if weight <= 0:
+        raise ValueError("代理权重必须大于0")
+    return url, weight
+
+
+def proxy_label(url):
+    """日志和统计中显示的代理名称（去掉用户名和密码）"""
+    parsed = urlparse(url)
+    label = f"{parsed.scheme}://{parsed.hostname}"
+    return f"{label}:{parsed.port}" if parsed.port else label
+
+
+class ProxyPool:
+    """片段下载使用的出口代理池
+
+    每个请求按"加权最少进行中请求"选择代理：进行中请求数+1 除以有效权重，取最小者。
+    有效权重 = 配置权重 × 健康评分（最近PROXY_HEALTH_WINDOW次请求的成功率）× 速度评分（吞吐量相对最快代理的比例），
+    成功率过低、明显慢于其他代理或代理本身拒绝服务（407）时自动淘汰，冷却PROXY_EVICT_COOLDOWN秒后清零评分重新试用。
+    代理池为空或全部被淘汰时直接连接。404等与代理无关的结果不计入评分。
+    """
+    def __init__(self, specs=()):
+        self._lock = threading.Lock()
+        self._proxies = {}
+        self._direct_warned = False
+        self.configure(specs)
+    
+    def configure(self, specs):
+        """替换代理列表；未安装PySocks时忽略SOCKS代理"""
+        proxies = {}
+        for spec in specs:
+            try:
+                url, weight = parse_proxy_spec(spec)
+            except ValueError as e:
+                print(f"警告: 忽略无效的代理配置 {spec!r}: {e}")
+                logging.warning(f"忽略无效的代理配置 {spec!r}: {e}")
+                continue
+            if url.startswith('socks'):
+                try:
+                    import socks  # noqa: F401  requests通过PySocks支持SOCKS代理
+                except ImportError:
+                    print(f"警告: 未安装PySocks（pip install requests[socks]），忽略SOCKS代理 {proxy_label(url)}")
+                    logging.warning(f"未安装PySocks，忽略SOCKS代理 {proxy_label(url)}")
+                    continue
+            proxies[url] = {'weight': weight, 'outstanding': 0,
+                            'outcomes': collections.deque(maxlen=PROXY_HEALTH_WINDOW), 'throughput': None,
+                            'requests': 0, 'failures': 0, 'bytes': 0, 'evicted_until': None, 'evictions': 0}
+        with self._lock:
+            self._proxies = proxies
+            self._direct_warned = False
+    
+    def __len__(self):
+        return len(self._proxies)
+    
+    @staticmethod
+    def requests_proxies(url):
+        """转换为requests的proxies参数，url为None（直接连接）时返回None"""
+        if url is None:
+            return None
+        return {'http': url, 'https': url}
+    
+    def _fastest(self, exclude=None):
+        """池中可用代理的最高吞吐量（调用时持有锁）"""
+        rates = [state['throughput'] for url, state in self._proxies.items()
+                 if url != exclude and state['evicted_until'] is None and state['throughput']]
+        return max(rates, default=None)
+    
+    def _effective_weight(self, state, fastest):
+        """配置权重 × 健康评分 × 速度评分（调用时持有锁）"""
+        outcomes = state['outcomes']
+        # 加1平滑，新代理的健康评分为0.5而不是未定义
+        health = (sum(outcomes) + 1) / (len(outcomes) + 2)
+        speed = 1.0
+        if state['throughput'] and fastest:
+            speed = max(state['throughput'] / fastest, 0.05)
+        return state['weight'] * health * speed
+    
+    def acquire(self):
+        """为一个请求选择代理并计入进行中请求数，返回代理地址；没有可用代理时返回None（直接连接）"""
+        if not self._proxies:
+            return None
+        now = time.monotonic()
+        readmitted = []
+        with self._lock:
+            for url, state in self._proxies.items():
+                if state['evicted_until'] is not None and now >= state['evicted_until']:
+                    # 冷却结束，评分清零后重新试用
+                    state['evicted_until'] = None
+                    state['outcomes'].clear()
+                    state['throughput'] = None
+                    readmitted.append(url)
+            fastest = self._fastest()
+            best = None
+            for url, state in self._proxies.items():
+                if state['evicted_until'] is not None:
+                    continue
+                score = (state['outstanding'] + 1) / self._effective_weight(state, fastest)
+                if best is None or score < best[0]:
+                    best = (score, url)
+            if best is not None:
+                state = self._proxies[best[1]]
+                state['outstanding'] += 1
+                state['requests'] += 1
+            warn_direct = best is None and not self._direct_warned
+            if warn_direct:
+                self._direct_warned = True
+        for url in readmitted:
+            logging.info(f"代理 {proxy_label(url)} 冷却结束，重新试用")
+        if warn_direct:
+            print("\n所有代理均已被淘汰，暂时直接连接")
+            logging.warning("所有代理均已被淘汰，暂时直接连接")
+        return None if best is None else best[1]
+    
+    def release(self, url, ok, num_bytes=0, elapsed=0.0, banned=False):
+        """记录一次请求的结果
+
+        ok: True成功，False失败（连接错误、超时、5xx、429、内容损坏），None不计入评分（404、取消等）
+        num_bytes/elapsed: 成功时接收的字节数和耗时，用于吞吐量评分
+        banned: 代理本身拒绝服务，立即淘汰
+        """
+        if url is None:
+            return
+        reason = None
+        with self._lock:
+            state = self._proxies.get(url)
+            if state is None:
+                return
+            state['outstanding'] -= 1
+            if ok is not None:
+                state['outcomes'].append(bool(ok))
+            if ok:
+                state['bytes'] += num_bytes
+                if num_bytes and elapsed > 0:
+                    rate = num_bytes / elapsed
+                    previous = state['throughput']
+                    state['throughput'] = rate if previous is None else (
+                        PROXY_THROUGHPUT_ALPHA * rate + (1 - PROXY_THROUGHPUT_ALPHA) * previous)
+            elif ok is not None:
+                state['failures'] += 1
+            if state['evicted_until'] is None:
+                reason = self._eviction_reason(url, state, banned)
+                if reason is not None:
+                    state['evicted_until'] = time.monotonic() + PROXY_EVICT_COOLDOWN
+                    state['evictions'] += 1
+                    self._direct_warned = False
+        if reason is not None:
+            print(f"\n淘汰代理 {proxy_label(url)}: {reason}，{PROXY_EVICT_COOLDOWN:.0f}秒后重新试用")
+            logging.warning(f"淘汰代理 {proxy_label(url)}: {reason}")
+    
+    def _eviction_reason(self, url, state, banned):
+        """返回淘汰原因，不需要淘汰时返回None（调用时持有锁）"""
+        if banned:
+            return "代理拒绝服务"
+        outcomes = state['outcomes']
+        if len(outcomes) < PROXY_MIN_SAMPLES:
+            return None
+        others = [other for other_url, other in self._proxies.items()
+                  if other_url != url and other['evicted_until'] is None]
+        success_rate = sum(outcomes) / len(outcomes)
+        # 只剩这一个代理时不因成功率淘汰：所有请求都失败时故障更可能在源站
+        if success_rate < PROXY_MIN_SUCCESS_RATE and others:
+            return f"最近{len(outcomes)}次请求成功率{success_rate:.0%}"
+        fastest = self._fastest(exclude=url)
+        if state['throughput'] and fastest and state['throughput'] < fastest * PROXY_SLOW_RATIO:
+            return f"吞吐量{format_size(state['throughput'])}/s，不到最快代理的{PROXY_SLOW_RATIO:.0%}"
+        return None
+    
+    def summary_lines(self):
+        """每个代理一行的统计描述"""
+        lines = []
+        with self._lock:
+            for url, state in self._proxies.items():
+                outcomes = state['outcomes']
+                rate = f"{sum(outcomes) / len(outcomes):.0%}" if outcomes else '--'
+                throughput = f"{format_size(state['throughput'])}/s" if state['throughput'] else '--'
+                status = '已淘汰' if state['evicted_until'] is not None else '可用'
+                lines.append(f"{proxy_label(url)}: {status}，请求 {state['requests']} 次，失败 {state['failures']} 次，"
+                             f"最近成功率 {rate}，吞吐量 {throughput}，下载 {format_size(state['bytes'])}，"
+                             f"被淘汰 {state['evictions']} 次")
+        return lines
+
+
+# 所有剧集共享的代理池
+PROXY_POOL = ProxyPool(PROXY_LIST)
+
+
+def download_segment_once(ts_url, ts_path, progress=None, validation_stats=None, key=None,
+                          refresher=None, sequence=None, byte_range=None, container='ts', cancel=None):
+    """尝试下载一次ts文件，成功返回True，失败抛出SegmentDownloadError，由重试策略决定是否、何时重试
+
+    数据到达时同步做TS完整性校验，校验失败的片段标记为立即重试（不等待退避）。
+    
+    progress: 可选的ProgressBar，接收数据时累加字节数
+    validation_stats: 可选的ValidationStats，记录校验结果和耗时
+    key: 可选的AES-128解密参数（来自resolve_playlist），加密片段在内存中解密后再校验写入
+    refresher/sequence: 可选的PlaylistRefresher和片段序号，签名过期（401/403/410）时
+        重新解析播放列表并立即换用新地址
+    byte_range: 可选的 (偏移, 长度)，只下载文件中的这一段（字节范围播放列表）
+    container: 片段格式，fmp4片段按MP4 box结构校验
+    cancel: 可选的CancelToken，已取消时不再发起请求，超过宽限期时在下一个数据块处中止（抛出DownloadCancelled）
+    
+    未加密且超过RANGE_SPLIT_THRESHOLD的大片段，若服务器支持Range，则拆分为多个分块并行下载。
+    数据先写入 .part 临时文件，校验通过后才改名为最终文件名，中断时不会留下被误认为完整的片段。
+    """
+    part_path = ts_path + '.part'
+    try:
+        for _ in range(PLAYLIST_REFRESH_LIMIT + 1):
+            if cancel is not None:
+                cancel.check()
+            generation = 0
+            if refresher is not None:
+                generation, segment = refresher.current(sequence)
+                if segment is not None:
+                    ts_url, key = segment['url'], segment['key']
+            resp = None
+            # 代理评分：成功/失败/不计入（None），以及接收的字节数
+            proxy = PROXY_POOL.acquire()
+            proxy_ok = False
+            proxy_banned = False
+            received = 0
+            started = time.monotonic()
+            try:
+                headers = None
+                if byte_range is not None:
+                    headers = {'Range': f'bytes={byte_range[0]}-{byte_range[0] + byte_range[1] - 1}'}
+                resp = http_session().get(ts_url, stream=True, timeout=10, headers=headers,
+                                          proxies=PROXY_POOL.requests_proxies(proxy))
+                if cancel is not None:
+                    cancel.track(resp)
+                if proxy is not None and resp.status_code in PROXY_BANNED_STATUS_CODES:
+                    # 代理本身拒绝服务，换一个代理重试，不计入源站的熔断统计
+                    resp.close()
+                    proxy_banned = True
+                    raise SegmentDownloadError(f"代理 {proxy_label(proxy)} 拒绝服务: HTTP {resp.status_code}")
+                if refresher is not None and resp.status_code in AUTH_EXPIRED_STATUS_CODES:
+                    resp.close()
+                    proxy_ok = None
+                    if refresher.refresh(generation):
+                        continue
+                if resp.status_code >= 400:
+                    resp.close()
+                    error = classify_http_status(resp)
+                    # 404等与代理无关的错误不计入代理评分
+                    proxy_ok = None if not error.host_failure else False
+                    raise error
+                if byte_range is not None and resp.status_code != 206:
+                    resp.close()
+                    raise SegmentValidationError("服务器未按Range请求返回部分内容")
+                
+                # 获取文件大小（内容经过压缩传输时长度不可比较）
+                total_size = int(resp.headers.get('content-length', 0))
+                if resp.headers.get('content-encoding', 'identity') != 'identity':
+                    total_size = 0
+                validator = new_segment_validator(container)
+                
+                if (key is None and byte_range is None and total_size >= RANGE_SPLIT_THRESHOLD
+                        and resp.headers.get('accept-ranges', '').lower() == 'bytes'):
+                    # 大片段拆分为多个Range并行下载，下载完成后整体校验
+                    resp.close()
+                    download_file_in_ranges(ts_url, part_path, total_size, progress, cancel=cancel)
+                    validator, _, _ = validate_ts_file(part_path, container=container)
+                elif key is not None:
+                    # 加密片段需要完整接收后才能解密和校验
+                    encrypted = bytearray()
+                    on_data = None
+                    if progress is not None:
+                        on_data = lambda data: progress.add_bytes(len(data))
+                    received = receive_response(resp, encrypted.extend, on_data, cancel)
+                    if total_size and len(encrypted) != total_size:
+                        raise SegmentValidationError(f"长度 {len(encrypted)} 与Content-Length {total_size} 不一致")
+                    plain = decrypt_segment(encrypted, key)
+                    validator.feed(plain)
+                    with open(part_path, 'wb') as f:
+                        f.write(plain)
+                    total_size = 0
+                else:
+                    def on_data(data):
+                        validator.feed(data)
+                        if progress is not None:
+                            progress.add_bytes(len(data))
+                    
+                    # 数据读入池中的缓冲区，攒满一块后一次写入（大块写入不经过文件对象的缓冲区）
+                    with open(part_path, 'wb') as f:
+                        received = receive_response(resp, f.write, on_data, cancel)
+                
+                valid, reason = validator.finish(total_size)
+                if validation_stats is not None:
+                    validation_stats.record(validator, valid)
+                if not valid:
+                    raise SegmentValidationError(reason)
+                os.replace(part_path, ts_path)
+                proxy_ok = True
+                return True
+            except SegmentValidationError as e:
+                # 内容损坏与网络抖动无关，立即重新下载
+                raise SegmentDownloadError(f"片段校验失败: {e}", immediate=True) from e
+            except requests.exceptions.HTTPError as e:
+                # Range分块请求返回的错误状态
+                raise classify_http_status(e.response) from e
+            except requests.exceptions.RequestException as e:
+                raise SegmentDownloadError(str(e), host_failure=True) from e
+            finally:
+                if cancel is not None and resp is not None:
+                    cancel.untrack(resp)
+                if cancel is not None and cancel.expired():
+                    proxy_ok = None
+                PROXY_POOL.release(proxy, proxy_ok, received, time.monotonic() - started, banned=proxy_banned)
+        raise SegmentDownloadError("重新解析播放列表后仍无权访问片段", retryable=False)
+    except Exception as e:
+        # 被abort()关闭的连接会以各种读取错误的形式出现，统一视为中止
+        if cancel is not None and cancel.expired() and not isinstance(e, DownloadCancelled):
+            raise DownloadCancelled(cancel.reason) from e
+        raise
+    finally:
+        # 失败或中止时删除不完整的临时文件
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def download_ts_file_with_retry(ts_url, ts_path, max_retries=RETRY_MAX_ATTEMPTS, **kwargs):
+    """下载单个ts文件，带重试机制
+
+    阻塞版本：退避时间在调用线程中等待，适合单独下载少量文件；
+    剧集的批量下载使用SegmentRetryScheduler，重试不占用下载线程。
+    其余参数同download_segment_once。
+    """
+    policy = RetryPolicy(max_attempts=max_retries)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return download_segment_once(ts_url, ts_path, **kwargs)
+        except SegmentDownloadError as e:
+            print_limited(f"\n下载失败 {ts_url}: {e}")
+            logging.error(f"下载失败 {ts_url} (第{attempt}次尝试): {e}")
+            if not policy.should_retry(attempt, e):
+                if e.retryable:
+                    print(f"已达到最大重试次数{max_retries}次，放弃下载")
+                    logging.error(f"已达到最大重试次数{max_retries}次，放弃下载 {ts_url}")
+                return False
+            delay = policy.next_delay(attempt, e)
+            if delay:
+                print_limited(f"{delay:.1f}秒后重试...")
+                time.sleep(delay)
+
+
+class SegmentRetryScheduler:
+    """片段下载调度器
+
+    工作线程每次只做一次尝试；失败后由调度线程（调用run的线程）按重试策略计算等待时间，
+    到期后重新提交，等待期间工作线程继续下载其他片段。提交前先询问熔断器，
+    被熔断主机上的片段推迟到冷却结束后再提交。
+    收到取消请求后不再提交新的片段（包括等待重试的片段），只等待进行中的片段结束。
+    """
+    def __init__(self, executor, attempt, policy=None, breaker=None):
+        """attempt(index): 在工作线程中执行一次下载，成功返回True，失败抛出SegmentDownloadError"""
+        self.executor = executor
+        self.attempt = attempt
+        self.policy = policy or DEFAULT_RETRY_POLICY
+        self.breaker = breaker or CIRCUIT_BREAKER
+    
+    def run(self, items, on_result, cancel=None):
+        """调度所有片段直到成功或放弃
+
+        items: [(index, url)]
+        on_result(index, success): 片段最终结果的回调，在调用run的线程中执行
+        cancel: 可选的CancelToken，取消后未开始的片段不回调on_result，由调用方记录为未完成
+        """
+        urls = dict(items)
+        attempts = {index: 0 for index in urls}
+        ready = [(0.0, index) for index in urls]  # (可以提交的时间, 片段)
+        heapq.heapify(ready)
+        in_flight = {}
+        
+        while ready or in_flight:
+            if cancel is not None and cancel.cancelled:
+                ready = []
+                if cancel.expired():
+                    # 宽限期已过，关闭进行中的连接
+                    cancel.abort()
+            now = time.monotonic()
+            while ready and ready[0][0] <= now:
+                _, index = heapq.heappop(ready)
+                host = urlparse(urls[index]).netloc
+                wait = self.breaker.before_request(host)
+                if wait > 0:
+                    heapq.heappush(ready, (now + wait, index))
+                    continue
+                attempts[index] += 1
+                in_flight[self.executor.submit(self.attempt, index)] = (index, host)
+            
+            timeout = max(ready[0][0] - now, 0.0) if ready else None
+            if cancel is not None:
+                # 定期醒来检查取消请求
+                timeout = CANCEL_POLL_INTERVAL if timeout is None else min(timeout, CANCEL_POLL_INTERVAL)
+            if not in_flight:
+                if cancel is not None:
+                    cancel.wait(timeout)
+                else:
+                    time.sleep(timeout)
+                continue
+            done, _ = futures.wait(in_flight, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                index, host = in_flight.pop(future)
+                judged = False  # 是否已向熔断器报告本次请求的结果
+                try:
+                    on_result(index, bool(future.result()))
+                    self.breaker.record_success(host)
+                    judged = True
+                except DownloadCancelled:
+                    # 超过宽限期被中止的片段，保持未完成状态，下次运行时重新下载
+                    logging.info(f"片段下载已中止 {urls[index]}", extra={'segment': index})
+                except SegmentDownloadError as e:
+                    print_limited(f"\n下载失败 {urls[index]}: {e}")
+                    logging.error(f"下载失败 {urls[index]} (第{attempts[index]}次尝试): {e}",
+                                  extra={'segment': index})
+                    judged = True
+                    if not e.host_failure:
+                        self.breaker.record_success(host)
+                    elif self.breaker.record_failure(host, e.retry_after, key=urls[index]):
+                        # 熔断视为该主机上所有排队片段的一次失败尝试，主机彻底不可用时整集能在有限时间内结束
+                        ready = self._charge_waiting(ready, host, urls, attempts, on_result)
+                    if cancel is not None and cancel.cancelled:
+                        continue
+                    if self.policy.should_retry(attempts[index], e):
+                        delay = self.policy.next_delay(attempts[index], e)
+                        if delay:
+                            print_limited(f"{delay:.1f}秒后重试...")
+                        heapq.heappush(ready, (time.monotonic() + delay, index))
+                    else:
+                        self._give_up(index, e.retryable, urls, on_result)
+                except Exception as e:
+                    print_limited(f"\n处理下载任务时出错 {urls[index]}: {e}")
+                    logging.error(f"处理下载任务时出错 {urls[index]}: {e}", extra={'segment': index})
+                    on_result(index, False)
+                finally:
+                    if not judged:
+                        # 半开状态下的探测请求被取消或出错时释放探测名额，否则该主机的请求会一直被推迟
+                        self.breaker.release_probe(host)
+        print_suppressed()
+    
+    def _charge_waiting(self, ready, host, urls, attempts, on_result):
+        """给主机上所有排队中的片段各记一次失败尝试，返回剩余的排队堆"""
+        remaining = []
+        for due, index in ready:
+            if urlparse(urls[index]).netloc == host:
+                attempts[index] += 1
+                if attempts[index] >= self.policy.max_attempts:
+                    self._give_up(index, True, urls, on_result)
+                    continue
+            remaining.append((due, index))
+        heapq.heapify(remaining)
+        return remaining
+    
+    def _give_up(self, index, exhausted, urls, on_result):
+        if exhausted:
+            print_limited(f"已达到最大重试次数{self.policy.max_attempts}次，放弃下载")
+            logging.error(f"已达到最大重试次数{self.policy.max_attempts}次，放弃下载 {urls[index]}",
+                          extra={'segment': index})
+        on_result(index, False)
+
+
+# 片段去重存储相关常量
+SEGMENT_STORE_DIRNAME = '.segment_store'  # 去重存储目录（位于data目录下）
+SEGMENT_INDEX_FILENAME = 'url_index.json'  # URL到内容哈希的索引文件
+SEGMENT_STORE_BUDGET = 10 * 1024 ** 3  # 去重存储最多保留的空间（字节），每集结束后淘汰最久未使用的片段，None表示不限制
+FICLONE = 0x40049409  # Linux上创建reflink的ioctl编号
+
+
+def link_or_copy(src_path, dst_path):
+    """把文件链接到目标位置：优先硬链接，其次reflink，都不支持时复制"""
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src_path, 'rb') as src_file, open(dst_path, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src_path, dst_path)
+
+
+class SegmentStore:
+    """内容寻址的片段存储
+
+    每个下载并校验通过的片段按内容哈希保存一份，剧集目录中的片段以硬链接（或reflink）指向它，
+    不同剧集、不同作品中相同内容的片段（片头片尾、广告等）只占一份空间。
+    另外维护 URL（去掉签名参数）到哈希的索引，已知URL的片段直接链接，不再访问网络。
+    对象总大小超过budget时由prune按最近使用时间淘汰（见prune）。
+    """
+    def __init__(self, root, budget=SEGMENT_STORE_BUDGET):
+        self.root = root
+        self.budget = budget
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, SEGMENT_INDEX_FILENAME)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.stats = {'url_hits': 0, 'url_hit_bytes': 0, 'duplicates': 0, 'duplicate_bytes': 0, 'stored': 0,
+                      'evicted': 0, 'evicted_bytes': 0}
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.total = sum(size for _, size, _, _ in self._scan())
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"加载片段索引失败: {e}")
+    
+    @staticmethod
+    def url_key(url, byte_range=None):
+        """片段在索引中的键：去掉签名参数的地址（其他查询参数保留，seg.ts?n=1与?n=2是不同的片段），
+        字节范围片段附加范围"""
+        key = canonical_url(url)
+        if byte_range is not None:
+            key += f"#{byte_range[0]}-{byte_range[1]}"
+        return key
+    
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+    
+    def _scan(self):
+        """列出所有对象：(最近使用时间, 大小, 链接数, 内容哈希)"""
+        objects = []
+        for prefix in os.scandir(self.objects_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, st.st_nlink, entry.name))
+        return objects
+    
+    def size(self):
+        """对象的总大小（字节）"""
+        return self.total
+    
+    def fetch(self, url_key, dest_path):
+        """URL已在索引中且对象存在时，把对象链接到dest_path并返回True"""
+        digest = self.index.get(url_key)
+        if digest is None:
+            return False
+        object_path = self._object_path(digest)
+        try:
+            link_or_copy(object_path, dest_path)
+            os.utime(object_path)
+            size = os.path.getsize(object_path)
+        except OSError:
+            # 对象已被淘汰（或在检查之后刚被删除），删除过期的索引项，改为正常下载
+            with self._lock:
+                if self.index.get(url_key) == digest:
+                    del self.index[url_key]
+                    self._dirty = True
+            return False
+        with self._lock:
+            self.stats['url_hits'] += 1
+            self.stats['url_hit_bytes'] += size
+        return True
+    
+    def add(self, path, url_key):
+        """把新下载的片段存入存储；内容已存在时用已有对象替换它"""
+        hasher = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                hasher.update(block)
+        digest = hasher.hexdigest()
+        object_path = self._object_path(digest)
+        size = os.path.getsize(path)
+        
+        with self._lock:
+            if os.path.exists(object_path):
+                duplicate = True
+                self.stats['duplicates'] += 1
+                self.stats['duplicate_bytes'] += size
+            else:
+                duplicate = False
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                try:
+                    os.link(path, object_path)
+                except OSError:
+                    shutil.copyfile(path, object_path)
+                self.stats['stored'] += 1
+                self.total += size
+            self.index[url_key] = digest
+            self._dirty = True
+        
+        if duplicate:
+            link_or_copy(object_path, path)
+            os.utime(object_path)
+    
+    def prune(self):
+        """淘汰最久未使用的对象，直到总大小不超过预算，并删除指向它们的索引项
+
+        仍被剧集目录硬链接引用的对象（链接数大于1）删除后并不释放空间，跳过它们；
+        每集结束、临时目录清理之后调用，此时已完成剧集的片段只剩存储中的一份。
+        """
+        if self.budget is None or self.total <= self.budget:
+            return
+        objects = self._scan()
+        total = sum(size for _, size, _, _ in objects)
+        removed = set()
+        for _, size, links, digest in sorted(objects):
+            if total <= self.budget:
+                break
+            if links > 1:
+                continue
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                continue
+            total -= size
+            removed.add(digest)
+            self.stats['evicted'] += 1
+            self.stats['evicted_bytes'] += size
+        with self._lock:
+            self.total = total
+            if removed:
+                self.index = {key: digest for key, digest in self.index.items() if digest not in removed}
+                self._dirty = True
+        if removed:
+            logging.info(f"去重存储淘汰 {len(removed)} 个片段，当前占用 {format_size(total)}")
+    
+    def save(self):
+        """保存URL索引（先写临时文件再替换，避免中断时损坏）"""
+        with self._lock:
+            if not self._dirty:
+                return
+            index = dict(self.index)
+            self._dirty = False
+        temp_path = self.index_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"保存片段索引失败: {e}")
+            logging.error(f"保存片段索引失败: {e}")
+    
+    def summary(self):
+        """返回本批次的去重统计描述"""
+        stats = self.stats
+        return (f"URL索引命中 {stats['url_hits']} 个片段（跳过下载 {format_size(stats['url_hit_bytes'])}），"
+                f"内容重复 {stats['duplicates']} 个片段（节省 {format_size(stats['duplicate_bytes'])}），"
+                f"新存入 {stats['stored']} 个片段，淘汰 {stats['evicted']} 个片段，"
+                f"当前占用 {format_size(self.total)}")
+
+
+@profile_stage('download')
+def download_segment(ts_url, ts_path, store=None, url_key=None, **kwargs):
+    """尝试获取一次片段：先查去重存储，未命中再下载，下载成功后存入存储
+
+    失败时抛出SegmentDownloadError，其余参数同download_segment_once。
+    """
+    if store is not None and store.fetch(url_key, ts_path):
+        return True
+    # 本地文件可能是指向存储对象的链接，必须先删除，避免覆盖写入破坏共享的对象
+    if os.path.exists(ts_path):
+        os.remove(ts_path)
+    success = download_segment_once(ts_url, ts_path, **kwargs)
+    if success and store is not None:
+        try:
+            store.add(ts_path, url_key)
+        except OSError as e:
+            logging.error(f"片段存入去重存储失败 {ts_path}: {e}")
+    return success
+
+
+def merge_ts_files(ts_files, output_path, cancel=None):
+    """合并ts文件
+
+    cancel: 可选的CancelToken，每个文件之前检查，已取消时抛出DownloadCancelled
+    """
+    try:
+        with open(output_path, 'wb') as output_file:
+            for ts_file in ts_files:
+                if cancel is not None:
+                    cancel.check()
+                if os.path.exists(ts_file):
+                    with open(ts_file, 'rb') as f:
+                        output_file.write(f.read())
+                else:
+                    print(f"\nTS文件不存在: {ts_file}")
+                    logging.error(f"TS文件不存在: {ts_file}")
+                    return False
+        return True
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        print(f"\n合并ts文件错误: {e}")
+        logging.error(f"合并ts文件错误: {e}")
+        return False
+
+FMP4_REWRITE_MFHD = True  # 组装fMP4时按输出顺序重写每个分片的序号（mfhd）
+FMP4_DIRECT_FORMATS = ('mp4', 'm4v')  # fMP4组装结果可以直接作为最终文件的输出格式
+
+
+def iter_mp4_boxes(data, start=0, end=None):
+    """遍历data[start:end]中的MP4 box，产出 (类型, 内容起始偏移, box结束偏移)"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size = int.from_bytes(data[pos:pos + 4], 'big')
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[pos + 8:pos + 16], 'big')
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield bytes(data[pos + 4:pos + 8]), pos + header, pos + size
+        pos += size
+
+
+def merge_fmp4_files(files, output_path, rewrite_mfhd=FMP4_REWRITE_MFHD, cancel=None):
+    """组装fMP4（CMAF）：初始化片段之后依次写入各个分片，得到可以边下边播的分片MP4，不需要转码
+
+    files: 按输出顺序排列的初始化片段和分片文件
+    rewrite_mfhd: 把每个moof中mfhd的序号按输出顺序重写为1、2、3...，
+        复用的片段或重新解析后的片段序号不连续时，播放器仍能按顺序处理
+    cancel: 可选的CancelToken，每个文件之前检查，已取消时抛出DownloadCancelled
+    """
+    sequence = 0
+    try:
+        with open(output_path, 'wb') as output_file:
+            for path in files:
+                if cancel is not None:
+                    cancel.check()
+                if not os.path.exists(path):
+                    print(f"\n片段文件不存在: {path}")
+                    logging.error(f"片段文件不存在: {path}")
+                    return False
+                with open(path, 'rb') as f:
+                    data = bytearray(f.read())
+                if rewrite_mfhd:
+                    for box_type, body, end in iter_mp4_boxes(data):
+                        if box_type != b'moof':
+                            continue
+                        for child_type, child_body, child_end in iter_mp4_boxes(data, body, end):
+                            # mfhd: 版本(1) + 标志(3) + 序号(4)
+                            if child_type == b'mfhd' and child_end - child_body >= 8:
+                                sequence += 1
+                                data[child_body + 4:child_body + 8] = sequence.to_bytes(4, 'big')
+                output_file.write(data)
+        return True
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        print(f"\n组装fMP4文件错误: {e}")
+        logging.error(f"组装fMP4文件错误: {e}")
+        return False
+
+
+def merge_webvtt_files(files, output_path, cancel=None):
+    """合并WebVTT字幕片段：保留第一个片段的文件头，依次追加各片段的字幕块
+
+    跨片段显示的字幕会同时出现在相邻的两个片段中，与上一个片段相同的字幕块只保留一次。
+    """
+    try:
+        previous = set()
+        header_written = False
+        with open(output_path, 'w', encoding='utf-8', newline='\n') as output_file:
+            for path in files:
+                if cancel is not None:
+                    cancel.check()
+                if not os.path.exists(path):
+                    print(f"\n字幕片段不存在: {path}")
+                    logging.error(f"字幕片段不存在: {path}")
+                    return False
+                with open(path, 'r', encoding='utf-8-sig', errors='replace') as f:
+                    text = f.read().replace('\r\n', '\n')
+                blocks = [block.strip('\n') for block in re.split(r'\n[ \t]*\n', text) if block.strip()]
+                if not blocks:
+                    continue
+                if not header_written:
+                    output_file.write(blocks[0] + '\n\n')
+                    header_written = True
+                cues = blocks[1:]
+                for cue in cues:
+                    if cue not in previous:
+                        output_file.write(cue + '\n\n')
+                previous = set(cues)
+        return True
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        print(f"\n合并字幕文件错误: {e}")
+        logging.error(f"合并字幕文件错误: {e}")
+        return False
+
+
+@profile_stage('merge')
+def merge_track_files(files, output_path, container='ts', cancel=None):
+    """按片段格式合并一个轨道的片段：fMP4组装、WebVTT合并字幕块，ts和aac直接拼接"""
+    if container == 'fmp4':
+        return merge_fmp4_files(files, output_path, cancel=cancel)
+    if container == 'webvtt':
+        return merge_webvtt_files(files, output_path, cancel=cancel)
+    return merge_ts_files(files, output_path, cancel=cancel)
+
+
+def clean_ts_files(ts_files):
+    """清理下载的ts文件"""
+    for ts_file in ts_files:
+        if os.path.exists(ts_file):
+            os.remove(ts_file)
+
+
+def extract_episode_info(url):
+    """从URL中提取剧集信息"""
+    # 解码URL中的中文
+    decoded_url = unquote(url)
+    print(f"解码后的URL: {decoded_url}")
+    
+    # 匹配剧集信息，如"第1集"、"第08集"等
+    episode_pattern = r'第(\d{1,3})[集话]'
+    match = re.search(episode_pattern, decoded_url)
+    
+    if match:
+        episode_num = match.group(1)
+        print(f"提取到剧集信息: 第{episode_num}集")
+        return episode_num
+    else:
+        print("未找到剧集信息")
+        return None
+
+
+def save_task_status(task_status):
+    """保存任务状态到JSON文件"""
+    try:
+        with open(TASK_STATUS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(task_status, f, ensure_ascii=False, indent=2)
+        logging.info(f"任务状态已保存到 {TASK_STATUS_FILE}")
+    except Exception as e:
+        print(f"保存任务状态失败: {e}")
+        logging.error(f"保存任务状态失败: {e}")
+
+
+def load_task_status():
+    """从JSON文件加载任务状态"""
+    try:
+        if os.path.exists(TASK_STATUS_FILE):
+            with open(TASK_STATUS_FILE, 'r', encoding='utf-8') as f:
+                task_status = json.load(f)
+            logging.info(f"从 {TASK_STATUS_FILE} 加载任务状态成功")
+            return task_status
+        else:
+            return {}
+    except Exception as e:
+        print(f"加载任务状态失败: {e}")
+        logging.error(f"加载任务状态失败: {e}")
+        return {}
+
+
+@profile_stage('status')
+def update_task_status(task_id, status, info=None, **fields):
+    """更新单个任务的状态
+
+    task_id: 任务键（见task_key）
+    fields: 额外记录在任务上的字段，如 work、episode
+    """
+    task_status = load_task_status()
+    if task_id not in task_status:
+        task_status[task_id] = {}
+    task_status[task_id]['status'] = status
+    task_status[task_id]['last_updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    if status != 'pending':
+        # 已经开始处理的剧集不再显示在排队顺序中
+        task_status[task_id].pop('schedule', None)
+    task_status[task_id].update(fields)
+    if info:
+        task_status[task_id]['info'] = info
+    save_task_status(task_status)
+
+
+def mark_interrupted(task_id, m3u8_url, stage, **fields):
+    """记录任务在stage阶段（downloading/merging/transcoding）被中断，下次运行时从该阶段继续"""
+    update_task_status(task_id, 'interrupted', {'error': '已中断', 'url': m3u8_url, 'stage': stage}, **fields)
+
+
+def merged_awaiting_transcode(status_info):
+    """任务是否已合并完成、只差转码（包括在转码阶段被中断的任务）"""
+    status = status_info.get('status')
+    return status == 'transcoding' or (status == 'interrupted'
+                                       and status_info.get('info', {}).get('stage') == 'transcoding')
+
+
+def get_pending_tasks():
+    """获取所有待处理或未完成的任务，返回 [(任务键, 状态信息)]"""
+    task_status = load_task_status()
+    pending_tasks = []
+    
+    for task_id, status_info in task_status.items():
+        if status_info.get('status') != 'completed':
+            pending_tasks.append((task_id, status_info))
+    
+    # 按作品和集数排序
+    pending_tasks.sort(key=lambda x: (x[1].get('work') or '', x[1].get('episode') or 0, x[0]))
+    return pending_tasks
+
+
+def describe_task(task_id, status_info):
+    """任务的显示名称，如"作品名 第3集"；旧版本以集数为键的记录显示为"第N集" """
+    if status_info.get('work') is not None or status_info.get('episode') is not None:
+        return f"{status_info.get('work') or ''} 第{status_info.get('episode')}集".strip()
+    return f"第{task_id}集"
+
+
+# 断点续传任务键相关常量
+SIGNATURE_QUERY_PARAMS = {'auth_key', 'sign', 'signature', 'token', 'expires', 'expire', 'expiry', 'exp', 'e', 't',
+                          'deadline', 'x-expires', 'txsecret', 'txtime', 'wssecret', 'wstime'}
+SEGMENT_MANIFEST_FILENAME = '.segments'  # 剧集临时目录中的片段完成清单
+
+
+def canonical_url(url):
+    """去掉签名类查询参数后的URL，同一播放列表换了签名仍得到相同结果"""
+    if '?' not in url:
+        return url
+    path, query = url.split('?', 1)
+    params = sorted(p for p in query.split('&') if p and p.split('=', 1)[0].lower() not in SIGNATURE_QUERY_PARAMS)
+    return f"{path}?{'&'.join(params)}" if params else path
+
+
+def task_key(work_title, episode_num, m3u8_url):
+    """任务状态的键：作品名/集数/播放列表地址哈希，不同作品的同一集数不会再冲突"""
+    digest = hashlib.blake2b(canonical_url(m3u8_url).encode('utf-8'), digest_size=6).hexdigest()
+    return f"{work_title or ''}/{int(episode_num):02d}/{digest}"
+
+
+def episode_scratch_dir(temp_dir, work_title, episode_num, m3u8_url):
+    """每一集独立的临时目录（存放片段、完成清单和合并后的临时文件）"""
+    digest = task_key(work_title, episode_num, m3u8_url).rsplit('/', 1)[1]
+    return os.path.join(temp_dir, work_title or '_', f"第{str(episode_num).zfill(2)}集_{digest}")
+
+
+def read_segment_manifest(scratch_dir):
+    """读取片段完成清单，一次扫描临时目录核对文件大小
+
+    返回 (片段总数或None, 已完成且磁盘上大小一致的文件名集合)
+    """
+    manifest_path = os.path.join(scratch_dir, SEGMENT_MANIFEST_FILENAME)
+    total = None
+    recorded = {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                name, _, value = line.rstrip('\n').rpartition(' ')
+                if not value.isdigit():
+                    continue
+                if name == '#total':
+                    total = int(value)
+                else:
+                    recorded[name] = int(value)
+    except OSError:
+        return None, set()
+    
+    sizes = {}
+    with os.scandir(scratch_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                sizes[entry.name] = entry.stat().st_size
+    done = {name for name, size in recorded.items() if sizes.get(name) == size}
+    return total, done
+
+
+class SegmentManifest:
+    """片段完成清单：每完成一个片段追加一行"文件名 大小"，断点续传时据此跳过已完成的片段"""
+    def __init__(self, scratch_dir, total):
+        self.path = os.path.join(scratch_dir, SEGMENT_MANIFEST_FILENAME)
+        previous_total, _ = read_segment_manifest(scratch_dir)
+        mode = 'a' if previous_total == total else 'w'
+        self._file = open(self.path, mode, encoding='utf-8')
+        if mode == 'w':
+            # 播放列表发生变化（或首次下载）时重新记录
+            self._file.write(f"#total {total}\n")
+            self._file.flush()
+    
+    def record(self, ts_path):
+        """记录一个已完成的片段（只在主线程调用）"""
+        self._file.write(f"{os.path.basename(ts_path)} {os.path.getsize(ts_path)}\n")
+        self._file.flush()
+    
+    def close(self):
+        self._file.close()
+
+# FFmpeg能力探测缓存
+MEDIA_TOOLS_CACHE_FILE = '.demo2_tools_cache.json'
+_media_tools = None
+_media_tools_lock = threading.Lock()
+
+
+def _probe_tool(name, cache):
+    """探测单个工具（ffmpeg/ffprobe）的版本和能力，结果按可执行文件路径和修改时间缓存"""
+    path = shutil.which(name)
+    if path is None:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    cache_key = f"{path}|{mtime}"
+    if cache_key in cache:
+        return cache[cache_key]
+    
+    try:
+        result = subprocess.run([path, '-hide_banner', '-version'], check=True, capture_output=True)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    version_line = result.stdout.decode('utf-8', 'replace').split('\n', 1)[0]
+    info = {'path': path, 'version': version_line, 'encoders': []}
+    if name == 'ffmpeg':
+        try:
+            encoders = subprocess.run([path, '-hide_banner', '-encoders'], capture_output=True)
+            text = encoders.stdout.decode('utf-8', 'replace')
+            info['encoders'] = [e for e in ('libx264', 'libx265', 'aac') if f" {e} " in text]
+        except OSError:
+            pass
+    cache[cache_key] = info
+    return info
+
+
+def get_media_tools():
+    """获取ffmpeg/ffprobe的探测结果
+
+    每个进程只探测一次，并缓存到磁盘（以可执行文件路径和修改时间为键，升级ffmpeg后自动失效），
+    返回 {"ffmpeg": 信息或None, "ffprobe": 信息或None}
+    """
+    global _media_tools
+    with _media_tools_lock:
+        if _media_tools is not None:
+            return _media_tools
+        cache = {}
+        if os.path.exists(MEDIA_TOOLS_CACHE_FILE):
+            try:
+                with open(MEDIA_TOOLS_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+        cache_size = len(cache)
+        tools = {name: _probe_tool(name, cache) for name in ('ffmpeg', 'ffprobe')}
+        if len(cache) != cache_size:
+            try:
+                with open(MEDIA_TOOLS_CACHE_FILE, 'w', encoding='utf-8') as f:
+                    json.dump(cache, f, ensure_ascii=False, indent=2)
+            except OSError as e:
+                logging.error(f"保存FFmpeg探测缓存失败: {e}")
+        _media_tools = tools
+        return tools
+
+
+# TS转MP4封装相关常量（未安装FFmpeg时使用）
+REMUX_READ_SIZE = TS_PACKET_SIZE * 4096  # 每次读取的TS数据量（约768KB）
+REMUX_WRITE_BUFFER = 4 * 1024 * 1024  # mdat写入缓冲区大小
+REMUX_MAX_DTS_GAP = 10 * 90000  # 相邻视频帧时间戳跳变超过该值（90kHz）视为不连续，自动拼接
+REMUX_FORMATS = ('mp4', 'm4v', 'mov')  # 可以用内置封装器输出的格式
+
+TS_STREAM_TYPE_H264 = 0x1B
+TS_STREAM_TYPE_AAC = 0x0F
+AAC_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+
+
+class RemuxUnsupportedError(Exception):
+    """输入不是内置封装器能处理的格式（非TS，或不是H.264+AAC）"""
+
+
+class _BitReader:
+    """按位读取H.264 RBSP（用于解析SPS）"""
+    def __init__(self, data):
+        self._value = int.from_bytes(data, 'big')
+        self._bits = len(data) * 8
+        self._pos = 0
+    
+    def u(self, n):
+        if self._pos + n > self._bits:
+            raise RemuxUnsupportedError("SPS数据不完整")
+        self._pos += n
+        return (self._value >> (self._bits - self._pos)) & ((1 << n) - 1)
+    
+    def ue(self):
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+    
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def parse_h264_sps(sps):
+    """解析H.264 SPS（含NAL头），返回 {"width", "height", "profile", "level"}"""
+    rbsp = sps[1:].replace(b'\x00\x00\x03', b'\x00\x00')
+    r = _BitReader(rbsp)
+    profile = r.u(8)
+    r.u(8)
+    level = r.u(8)
+    r.ue()
+    chroma_format_idc = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = r.ue()
+        if chroma_format_idc == 3:
+            r.u(1)
+        r.ue()
+        r.ue()
+        r.u(1)
+        if r.u(1):
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if r.u(1):
+                    # 跳过scaling_list
+                    last, nxt = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if nxt:
+                            nxt = (last + r.se() + 256) % 256
+                        last = nxt or last
+    r.ue()
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()
+    elif poc_type == 1:
+        r.u(1)
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue()
+    r.u(1)
+    width = (r.ue() + 1) * 16
+    map_height = r.ue() + 1
+    frame_mbs_only = r.u(1)
+    if not frame_mbs_only:
+        r.u(1)
+    r.u(1)
+    height = (2 - frame_mbs_only) * map_height * 16
+    if r.u(1):
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+        crop_x = 1 if chroma_format_idc in (0, 3) else 2
+        crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+        width -= (left + right) * crop_x
+        height -= (top + bottom) * crop_y
+    return {'width': width, 'height': height, 'profile': profile, 'level': level}
+
+
+def _split_annexb(data):
+    """把Annex B字节流（00 00 01起始码分隔）拆分为NAL单元列表"""
+    nals = []
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        nal = data[start:] if end == -1 else data[start:end]
+        nal = nal.rstrip(b'\x00')
+        if nal:
+            nals.append(nal)
+        start = end
+    return nals
+
+
+def _box(box_type, *payloads):
+    body = b''.join(payloads)
+    return (8 + len(body)).to_bytes(4, 'big') + box_type + body
+
+
+def _full_box(box_type, version, flags, *payloads):
+    return _box(box_type, bytes([version]) + flags.to_bytes(3, 'big'), *payloads)
+
+
+def _run_lengths(values):
+    """游程编码，返回 [(次数, 值)]"""
+    runs = []
+    for value in values:
+        if runs and runs[-1][1] == value:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value])
+    return runs
+
+
+class _Mp4Track:
+    """封装过程中一条轨道的样本表（只保存大小、时间和位置，样本数据直接写入mdat）"""
+    def __init__(self, track_id, kind, timescale):
+        self.track_id = track_id
+        self.kind = kind  # 'video' 或 'audio'
+        self.timescale = timescale
+        self.sizes = array.array('I')
+        self.dts = array.array('q')
+        self.cts = array.array('i')  # pts - dts
+        self.keyframes = array.array('I')  # 从1开始的关键帧序号
+        self.chunk_offsets = array.array('Q')
+        self.chunk_counts = array.array('I')
+        self.first_pts = None  # 最早的显示时间（90kHz）
+        self.sample_entry = b''
+    
+    def durations(self, default):
+        """由解码时间差得到每个样本的时长，最后一个样本沿用前一个的时长"""
+        dts = self.dts
+        result = array.array('I', (max(dts[i + 1] - dts[i], 0) for i in range(len(dts) - 1)))
+        result.append(result[-1] if result else default)
+        return result
+
+
+class TsToMp4Remuxer:
+    """内置的MPEG-TS转MP4封装器（H.264 + AAC，不重新编码）
+
+    单次顺序读取TS：解析PAT/PMT找到视频和音频流，按PES组装帧，
+    H.264由Annex B起始码格式转为长度前缀格式，AAC去掉ADTS头；样本数据立即写入mdat
+    （使用64位长度，不受4GB限制），内存中只保留样本表，最后在文件末尾写入moov。
+    """
+    def __init__(self, input_path, output_path, cancel=None):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.cancel = cancel
+        self._pmt_pid = None
+        self._streams = {}  # pid -> 'video' / 'audio'
+        self._pes = {}  # pid -> (时间戳, 数据块列表)
+        self.video = _Mp4Track(1, 'video', 90000)
+        self.audio = None
+        self._sps = None
+        self._pps = None
+        self._video_info = None
+        self._pending_video = None  # 等待下一帧确定的视频样本 [dts, pts, 数据块, 是否关键帧]
+        self._dts_shift = 0
+        self._last_raw_dts = None
+        self._unwrapped_dts = None
+        self._adts_carry = b''
+        self._audio_pts = None
+        self._audio_frames = 0
+        self._last_track = None
+        self._out = None
+        self._offset = 0
+    
+    def remux(self):
+        """执行封装，返回 {"video_samples", "audio_samples", "bytes"}"""
+        with open(self.input_path, 'rb') as f:
+            if f.read(1) != TS_SYNC_BYTE:
+                raise RemuxUnsupportedError("输入不是MPEG-TS文件")
+            f.seek(0)
+            with open(self.output_path, 'wb', buffering=REMUX_WRITE_BUFFER) as out:
+                self._out = out
+                ftyp = _box(b'ftyp', b'isom', (512).to_bytes(4, 'big'), b'isomiso2avc1mp41')
+                # mdat使用64位长度字段（size=1），结束后回填
+                out.write(ftyp + (1).to_bytes(4, 'big') + b'mdat' + bytes(8))
+                self._offset = len(ftyp) + 16
+                mdat_start = len(ftyp)
+                
+                carry = b''
+                while True:
+                    if self.cancel is not None:
+                        self.cancel.check()
+                    block = f.read(REMUX_READ_SIZE)
+                    if not block:
+                        break
+                    if carry:
+                        block = carry + block
+                    usable = len(block) - len(block) % TS_PACKET_SIZE
+                    carry = block[usable:]
+                    self._feed_packets(memoryview(block)[:usable])
+                for pid in list(self._pes):
+                    self._flush_pes(pid)
+                self._flush_video(None)
+                
+                if not self.video.sizes:
+                    raise RemuxUnsupportedError("没有找到H.264视频流")
+                out.seek(mdat_start + 8)
+                out.write((self._offset - mdat_start).to_bytes(8, 'big'))
+                out.seek(self._offset)
+                out.write(self._moov())
+        return {
+            'video_samples': len(self.video.sizes),
+            'audio_samples': len(self.audio.sizes) if self.audio else 0,
+            'bytes': self._offset,
+        }
+    
+    # ---- TS解复用 ----
+    def _feed_packets(self, view):
+        for pos in range(0, len(view), TS_PACKET_SIZE):
+            if view[pos] != 0x47:
+                raise RemuxUnsupportedError(f"偏移 {pos} 处缺少同步字节0x47")
+            pusi = view[pos + 1] & 0x40
+            pid = ((view[pos + 1] & 0x1F) << 8) | view[pos + 2]
+            control = view[pos + 3] >> 4 & 3
+            start = pos + 4
+            if control & 2:
+                start += 1 + view[pos + 4]
+            if not control & 1 or start >= pos + TS_PACKET_SIZE:
+                continue
+            payload = view[start:pos + TS_PACKET_SIZE]
+            if pid == 0 or pid == self._pmt_pid:
+                if pusi:
+                    self._parse_psi(pid, bytes(payload))
+            elif pid in self._streams:
+                if pusi:
+                    self._flush_pes(pid)
+                    self._pes[pid] = [bytes(payload)]
+                elif pid in self._pes:
+                    self._pes[pid].append(bytes(payload))
+    
+    def _parse_psi(self, pid, payload):
+        section = payload[1 + payload[0]:]
+        if len(section) < 12:
+            return
+        end = min(3 + (((section[1] & 0x0F) << 8) | section[2]) - 4, len(section))
+        if pid == 0 and section[0] == 0x00:
+            for i in range(8, end - 3, 4):
+                if int.from_bytes(section[i:i + 2], 'big') != 0:
+                    self._pmt_pid = int.from_bytes(section[i + 2:i + 4], 'big') & 0x1FFF
+                    break
+        elif section[0] == 0x02 and not self._streams:
+            i = 12 + (int.from_bytes(section[10:12], 'big') & 0x0FFF)
+            while i + 5 <= end:
+                stream_type = section[i]
+                es_pid = int.from_bytes(section[i + 1:i + 3], 'big') & 0x1FFF
+                if stream_type == TS_STREAM_TYPE_H264 and 'video' not in self._streams.values():
+                    self._streams[es_pid] = 'video'
+                elif stream_type == TS_STREAM_TYPE_AAC and 'audio' not in self._streams.values():
+                    self._streams[es_pid] = 'audio'
+                i += 5 + (int.from_bytes(section[i + 3:i + 5], 'big') & 0x0FFF)
+            if 'video' not in self._streams.values():
+                raise RemuxUnsupportedError("视频流不是H.264，需要FFmpeg处理")
+    
+    @staticmethod
+    def _read_timestamp(b):
+        return ((b[0] >> 1) & 0x07) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+    
+    def _flush_pes(self, pid):
+        chunks = self._pes.pop(pid, None)
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        if len(data) < 9 or data[:3] != b'\x00\x00\x01':
+            return
+        flags = data[7]
+        payload = data[9 + data[8]:]
+        pts = self._read_timestamp(data[9:14]) if flags & 0x80 else None
+        dts = self._read_timestamp(data[14:19]) if flags & 0xC0 == 0xC0 else pts
+        if self._streams[pid] == 'video':
+            self._on_video(payload, pts, dts)
+        else:
+            self._on_audio(payload, pts)
+    
+    # ---- 视频 ----
+    def _on_video(self, payload, pts, dts):
+        if pts is None:
+            # 没有时间戳的PES是上一帧的延续
+            if self._pending_video is not None:
+                self._pending_video[2].append(payload)
+            return
+        self._flush_video((dts, pts, [payload]))
+    
+    def _flush_video(self, next_frame):
+        pending, self._pending_video = self._pending_video, next_frame
+        if pending is None:
+            return
+        raw_dts, raw_pts, chunks = pending
+        samples = []
+        keyframe = False
+        for nal in _split_annexb(b''.join(chunks)):
+            nal_type = nal[0] & 0x1F
+            if nal_type == 7:
+                self._sps = self._sps or nal
+            elif nal_type == 8:
+                self._pps = self._pps or nal
+            elif nal_type != 9:
+                keyframe = keyframe or nal_type == 5
+                samples.append(len(nal).to_bytes(4, 'big'))
+                samples.append(nal)
+        if not samples or (not self.video.sizes and (not keyframe or self._sps is None or self._pps is None)):
+            # 第一个关键帧之前的帧无法解码，丢弃
+            return
+        dts = self._unwrap_dts(raw_dts)
+        pts = dts + self._signed_33(raw_pts - raw_dts)
+        track = self.video
+        if track.dts and (dts <= track.dts[-1] or dts - track.dts[-1] > REMUX_MAX_DTS_GAP):
+            # 合并的片段之间时间戳不连续，接在上一帧之后
+            step = track.dts[-1] - track.dts[-2] if len(track.dts) > 1 else 3000
+            self._dts_shift += track.dts[-1] + step - dts
+            pts += track.dts[-1] + step - dts
+            dts = track.dts[-1] + step
+        track.dts.append(dts)
+        track.cts.append(pts - dts)
+        if track.first_pts is None or pts < track.first_pts:
+            track.first_pts = pts
+        if keyframe:
+            track.keyframes.append(len(track.sizes) + 1)
+        self._write_sample(track, b''.join(samples))
+    
+    @staticmethod
+    def _signed_33(value):
+        value %= 1 << 33
+        return value - (1 << 33) if value >= 1 << 32 else value
+    
+    def _unwrap_dts(self, raw):
+        """处理33位时间戳回绕，并叠加不连续处的拼接偏移"""
+        if self._last_raw_dts is None:
+            self._unwrapped_dts = raw
+        else:
+            self._unwrapped_dts += self._signed_33(raw - self._last_raw_dts)
+        self._last_raw_dts = raw
+        return self._unwrapped_dts + self._dts_shift
+    
+    # ---- 音频 ----
+    def _on_audio(self, payload, pts):
+        data = self._adts_carry + payload if self._adts_carry else payload
+        if self._audio_pts is None and pts is not None:
+            self._audio_pts = pts
+        pos = 0
+        while pos + 7 <= len(data):
+            if data[pos] != 0xFF or data[pos + 1] & 0xF6 != 0xF0:
+                pos += 1
+                continue
+            frame_length = ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+            if frame_length < 7:
+                pos += 1
+                continue
+            if pos + frame_length > len(data):
+                break
+            header_length = 7 if data[pos + 1] & 0x01 else 9
+            if self.audio is None:
+                self._init_audio(data[pos:pos + 7])
+            blocks = (data[pos + 6] & 0x03) + 1
+            self.audio.dts.append(self._audio_frames * 1024)
+            self.audio.cts.append(0)
+            self._audio_frames += blocks
+            self._write_sample(self.audio, data[pos + header_length:pos + frame_length])
+            pos += frame_length
+        self._adts_carry = data[pos:]
+    
+    def _init_audio(self, header):
+        profile = (header[2] >> 6) + 1
+        rate_index = (header[2] >> 2) & 0x0F
+        channels = ((header[2] & 0x01) << 2) | (header[3] >> 6)
+        if rate_index >= len(AAC_SAMPLE_RATES):
+            raise RemuxUnsupportedError("无法识别的AAC采样率")
+        rate = AAC_SAMPLE_RATES[rate_index]
+        self.audio = _Mp4Track(2, 'audio', rate)
+        self.audio.first_pts = self._audio_pts or 0
+        config = ((profile << 11) | (rate_index << 7) | (channels << 3)).to_bytes(2, 'big')
+        
+        def descriptor(tag, body):
+            return bytes([tag, len(body)]) + body
+        esds = _full_box(b'esds', 0, 0, descriptor(3, b'\x00\x00\x00' + descriptor(
+            4, b'\x40\x15' + bytes(11) + descriptor(5, config)) + descriptor(6, b'\x02')))
+        self.audio.sample_entry = _box(
+            b'mp4a', bytes(6), (1).to_bytes(2, 'big'), bytes(8), channels.to_bytes(2, 'big'),
+            (16).to_bytes(2, 'big'), bytes(4), (rate << 16).to_bytes(4, 'big'), esds)
+    
+    # ---- MP4封装 ----
+    def _write_sample(self, track, data):
+        if self._last_track is track:
+            track.chunk_counts[-1] += 1
+        else:
+            track.chunk_offsets.append(self._offset)
+            track.chunk_counts.append(1)
+            self._last_track = track
+        track.sizes.append(len(data))
+        self._out.write(data)
+        self._offset += len(data)
+    
+    def _video_sample_entry(self):
+        info = parse_h264_sps(self._sps)
+        self._video_info = info
+        avcc = _box(b'avcC', bytes([1, self._sps[1], self._sps[2], self._sps[3], 0xFF, 0xE1]),
+                    len(self._sps).to_bytes(2, 'big'), self._sps, b'\x01',
+                    len(self._pps).to_bytes(2, 'big'), self._pps)
+        return _box(b'avc1', bytes(6), (1).to_bytes(2, 'big'), bytes(16),
+                    info['width'].to_bytes(2, 'big'), info['height'].to_bytes(2, 'big'),
+                    (0x00480000).to_bytes(4, 'big') * 2, bytes(4), (1).to_bytes(2, 'big'), bytes(32),
+                    (0x18).to_bytes(2, 'big'), b'\xff\xff', avcc)
+    
+    def _sample_table(self, track, durations):
+        u32 = lambda v: v.to_bytes(4, 'big')
+        stsd = _full_box(b'stsd', 0, 0, u32(1), track.sample_entry)
+        stts_runs = _run_lengths(durations)
+        stts = _full_box(b'stts', 0, 0, u32(len(stts_runs)), b''.join(u32(n) + u32(d) for n, d in stts_runs))
+        boxes = [stsd, stts]
+        if any(track.cts):
+            negative = min(track.cts) < 0
+            runs = _run_lengths(track.cts)
+            boxes.append(_full_box(b'ctts', 1 if negative else 0, 0, u32(len(runs)), b''.join(
+                u32(n) + (c & 0xFFFFFFFF).to_bytes(4, 'big') for n, c in runs)))
+        if track.kind == 'video':
+            boxes.append(_full_box(b'stss', 0, 0, u32(len(track.keyframes)),
+                                   b''.join(u32(k) for k in track.keyframes)))
+        stsc_entries = []
+        for index, count in enumerate(track.chunk_counts):
+            if not stsc_entries or stsc_entries[-1][1] != count:
+                stsc_entries.append((index + 1, count))
+        boxes.append(_full_box(b'stsc', 0, 0, u32(len(stsc_entries)),
+                               b''.join(u32(c) + u32(n) + u32(1) for c, n in stsc_entries)))
+        boxes.append(_full_box(b'stsz', 0, 0, u32(0), u32(len(track.sizes)),
+                               b''.join(u32(s) for s in track.sizes)))
+        if track.chunk_offsets and track.chunk_offsets[-1] > 0xFFFFFFFF:
+            boxes.append(_full_box(b'co64', 0, 0, u32(len(track.chunk_offsets)),
+                                   b''.join(o.to_bytes(8, 'big') for o in track.chunk_offsets)))
+        else:
+            boxes.append(_full_box(b'stco', 0, 0, u32(len(track.chunk_offsets)),
+                                   b''.join(u32(o) for o in track.chunk_offsets)))
+        return _box(b'stbl', *boxes)
+    
+    def _trak(self, track, start_pts):
+        u32 = lambda v: v.to_bytes(4, 'big')
+        is_video = track.kind == 'video'
+        durations = track.durations(3000 if is_video else 1024)
+        media_duration = sum(durations)
+        # 编辑列表：用空白编辑对齐音视频起点，视频跳过B帧带来的解码延迟
+        delay_ms = (track.first_pts - start_pts) * 1000 // 90000
+        media_time = (track.first_pts - track.dts[0]) if is_video else 0
+        duration_ms = media_duration * 1000 // track.timescale
+        edits = []
+        if delay_ms > 0:
+            edits.append(u32(delay_ms) + (0xFFFFFFFF).to_bytes(4, 'big') + u32(0x10000))
+        edits.append(u32(duration_ms) + u32(media_time) + u32(0x10000))
+        edts = _box(b'edts', _full_box(b'elst', 0, 0, u32(len(edits)), *edits))
+        
+        matrix = b''.join(u32(v) for v in (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000))
+        width, height = (self._video_info['width'], self._video_info['height']) if is_video else (0, 0)
+        tkhd = _full_box(b'tkhd', 0, 3, bytes(8), u32(track.track_id), bytes(4), u32(delay_ms + duration_ms),
+                         bytes(8), bytes(4), (0 if is_video else 0x0100).to_bytes(2, 'big'), bytes(2), matrix,
+                         u32(width << 16), u32(height << 16))
+        mdhd = _full_box(b'mdhd', 0, 0, bytes(8), u32(track.timescale), u32(media_duration),
+                         (0x55C4).to_bytes(2, 'big'), bytes(2))
+        handler = b'vide' if is_video else b'soun'
+        hdlr = _full_box(b'hdlr', 0, 0, bytes(4), handler, bytes(12),
+                         (b'VideoHandler' if is_video else b'SoundHandler') + b'\x00')
+        media_header = _full_box(b'vmhd', 0, 1, bytes(8)) if is_video else _full_box(b'smhd', 0, 0, bytes(4))
+        dinf = _box(b'dinf', _full_box(b'dref', 0, 0, u32(1), _full_box(b'url ', 0, 1)))
+        minf = _box(b'minf', media_header, dinf, self._sample_table(track, durations))
+        return _box(b'trak', tkhd, edts, _box(b'mdia', mdhd, hdlr, minf)), delay_ms + duration_ms
+    
+    def _moov(self):
+        u32 = lambda v: v.to_bytes(4, 'big')
+        self.video.sample_entry = self._video_sample_entry()
+        tracks = [self.video] + ([self.audio] if self.audio and self.audio.sizes else [])
+        start_pts = min(track.first_pts for track in tracks)
+        traks = []
+        movie_duration = 0
+        for track in tracks:
+            trak, duration = self._trak(track, start_pts)
+            traks.append(trak)
+            movie_duration = max(movie_duration, duration)
+        matrix = b''.join(u32(v) for v in (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000))
+        mvhd = _full_box(b'mvhd', 0, 0, bytes(8), u32(1000), u32(movie_duration), u32(0x10000),
+                         (0x0100).to_bytes(2, 'big'), bytes(10), matrix, bytes(24), u32(len(tracks) + 1))
+        return _box(b'moov', mvhd, *traks)
+
+
+def remux_ts_to_mp4(input_path, output_path, cancel=None):
+    """不经过FFmpeg把TS文件封装为MP4（H.264 + AAC），失败或取消时删除不完整的输出并抛出异常"""
+    try:
+        return TsToMp4Remuxer(input_path, output_path, cancel).remux()
+    except Exception:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+
+def _signal_process_group(proc, force=False):
+    """通知子进程及其派生的进程退出（force为True时强制结束）"""
+    if os.name == 'nt':
+        if force:
+            proc.kill()
+        else:
+            proc.terminate()
+        return
+    import signal
+    try:
+        os.killpg(proc.pid, signal.SIGKILL if force else signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def run_media_command(command, cancel=None):
+    """运行FFmpeg等外部命令，返回 (退出码, 错误输出文本)
+
+    子进程放在独立的进程组中，终端的Ctrl-C不会直接打断它；收到取消请求时先通知退出，
+    超过FFMPEG_TERMINATE_TIMEOUT仍未结束则强制结束，然后抛出DownloadCancelled。
+    """
+    kwargs = {}
+    if os.name == 'nt':
+        kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            **kwargs)
+    try:
+        while True:
+            try:
+                _, stderr = proc.communicate(timeout=CANCEL_POLL_INTERVAL if cancel is not None else None)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel.cancelled:
+                    raise DownloadCancelled(cancel.reason)
+    finally:
+        if proc.poll() is None:
+            print("正在结束FFmpeg进程...")
+            _signal_process_group(proc, force=False)
+            try:
+                proc.communicate(timeout=FFMPEG_TERMINATE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                _signal_process_group(proc, force=True)
+                proc.communicate()
+    # 使用utf-8解码错误输出，失败时使用gbk
+    try:
+        stderr_msg = stderr.decode('utf-8')
+    except UnicodeDecodeError:
+        try:
+            stderr_msg = stderr.decode('gbk')
+        except UnicodeDecodeError:
+            stderr_msg = "无法解码错误信息"
+    return proc.returncode, stderr_msg
+
+
+# 分段并行转码相关常量
+TRANSCODE_PARALLEL = True  # 需要重新编码时，按关键帧分段后由多个FFmpeg进程并行编码
+TRANSCODE_CHUNK_MIN_SECONDS = 60  # 每个分段的最短时长（秒），较短的视频不分段
+TRANSCODE_THREADS_PER_CHUNK = 2  # 每个FFmpeg编码进程使用的线程数，分段数不超过 CPU核数/该值
+
+
+def plan_transcode_chunks(duration, cpus=None):
+    """根据CPU核数和视频时长决定并行转码的分段数，返回1表示整体转码"""
+    if not duration:
+        return 1
+    if cpus is None:
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    return max(1, min(cpus // TRANSCODE_THREADS_PER_CHUNK, int(duration // TRANSCODE_CHUNK_MIN_SECONDS)))
+
+
+def transcode_in_chunks(ffmpeg_path, input_path, output_path, duration, chunks, cancel=None, work_dir=None):
+    """分段并行转码，成功返回True
+
+    1. 视频流按关键帧切分为约chunks段（流复制，不重新编码）
+    2. 每段由独立的FFmpeg进程并行编码
+    3. 编码后的分段用concat无损拼接；音频从原文件整体编码一次，分段边界处不会出现音频间隙
+    中间文件放在work_dir中（默认为输入文件旁的 .chunks 目录，即该集的临时目录，不写入交付的输出目录），结束后删除。
+    """
+    if work_dir is None:
+        work_dir = os.path.splitext(input_path)[0] + '.chunks'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    try:
+        segment_time = duration / chunks
+        command = [ffmpeg_path, '-i', input_path, '-map', '0:v:0', '-c', 'copy',
+                   '-f', 'segment', '-segment_time', f'{segment_time:.3f}', '-segment_format', 'matroska',
+                   '-reset_timestamps', '1', os.path.join(work_dir, 'src_%04d.mkv')]
+        returncode, stderr_msg = run_media_command(command, cancel)
+        if returncode != 0:
+            logging.error(f"视频分段失败: {stderr_msg}")
+            return False
+        sources = sorted(name for name in os.listdir(work_dir) if name.startswith('src_'))
+        print(f"分段并行转码: {len(sources)}段（每段约{segment_time:.0f}秒），最多{chunks}个FFmpeg进程同时编码")
+        
+        def encode(name):
+            command = [ffmpeg_path, '-i', os.path.join(work_dir, name),
+                       '-c:v', 'libx264', '-threads', str(TRANSCODE_THREADS_PER_CHUNK), '-an',
+                       '-y', os.path.join(work_dir, 'enc_' + name[4:])]
+            return run_media_command(command, cancel)
+        
+        with futures.ThreadPoolExecutor(max_workers=chunks) as executor:
+            results = list(executor.map(encode, sources))
+        for name, (returncode, stderr_msg) in zip(sources, results):
+            if returncode != 0:
+                logging.error(f"分段 {name} 转码失败: {stderr_msg}")
+                return False
+        
+        list_path = os.path.join(work_dir, 'concat.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for name in sources:
+                f.write(f"file 'enc_{name[4:]}'\n")
+        command = [ffmpeg_path, '-f', 'concat', '-safe', '0', '-i', list_path, '-i', input_path,
+                   '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy', '-c:a', 'aac',
+                   '-strict', 'experimental', '-y', output_path]
+        returncode, stderr_msg = run_media_command(command, cancel)
+        if returncode != 0:
+            logging.error(f"拼接转码分段失败: {stderr_msg}")
+            return False
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# 转码结果缓存相关常量
+TRANSCODE_CACHE_DIRNAME = '.transcode_cache'  # 转码结果缓存目录（位于data目录下，不混入交付的video目录）
+TRANSCODE_CACHE_INDEX_FILENAME = 'index.json'  # 缓存条目的大小和最近使用时间
+TRANSCODE_CACHE_BUDGET = 20 * 1024 ** 3  # 缓存最多占用的空间（字节），超出时淘汰最久未使用的结果，0表示不缓存
+
+
+class TranscodeCache:
+    """FFmpeg转码结果缓存
+
+    以 合并后输入文件的内容哈希 + FFmpeg版本 + 完整参数列表（输入、输出路径替换为占位符）为键，
+    保存转码后的文件。同一集重新下载（最终文件被删除、换了输出目录、同一片源出现在其他作品下）时，
+    只需计算一次哈希，再把缓存结果硬链接（或reflink）到video目录，不再重新转码；
+    缓存与最终文件共享数据块，因此只在data和video目录位于同一文件系统时使用（见run_batch）。
+    总大小超过预算时按最近使用时间淘汰；已链接到video目录的文件不受淘汰影响。
+    """
+    def __init__(self, root, budget=TRANSCODE_CACHE_BUDGET):
+        self.root = root
+        self.budget = budget
+        self.index_path = os.path.join(root, TRANSCODE_CACHE_INDEX_FILENAME)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'hit_bytes': 0, 'stored': 0, 'evicted': 0, 'evicted_bytes': 0}
+        os.makedirs(root, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"加载转码缓存索引失败: {e}")
+    
+    @staticmethod
+    def hash_file(path):
+        """计算输入文件的内容哈希"""
+        hasher = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                hasher.update(block)
+        return hasher.hexdigest()
+    
+    @staticmethod
+    def make_key(input_digest, command, input_path, output_path, tool_version=None, variant=None):
+        """计算缓存键：输入内容哈希 + 工具版本 + 参数列表（路径替换为占位符，输出保留扩展名）"""
+        output_ext = os.path.splitext(output_path)[1]
+        args = ['{input}' if arg == input_path else '{output}' + output_ext if arg == output_path else arg
+                for arg in command]
+        recipe = json.dumps({'input': input_digest, 'version': tool_version, 'args': args, 'variant': variant},
+                            ensure_ascii=False)
+        return hashlib.blake2b(recipe.encode('utf-8'), digest_size=20).hexdigest()
+    
+    def size(self):
+        """缓存条目的总大小（字节）"""
+        with self._lock:
+            return sum(entry['size'] for entry in self.index.values())
+    
+    def _object_path(self, key):
+        entry = self.index[key]
+        return os.path.join(self.root, key[:2], key + entry.get('ext', ''))
+    
+    def fetch(self, key, dest_path):
+        """缓存中有该结果时链接到dest_path并返回True"""
+        with self._lock:
+            if key not in self.index:
+                return False
+            object_path = self._object_path(key)
+            if not os.path.exists(object_path):
+                del self.index[key]
+                self._save()
+                return False
+            self.index[key]['last_used'] = time.time()
+            size = self.index[key]['size']
+            self.stats['hits'] += 1
+            self.stats['hit_bytes'] += size
+            self._save()
+        link_or_copy(object_path, dest_path)
+        return True
+    
+    def add(self, key, path):
+        """把转码结果存入缓存（优先硬链接，不额外占用空间），然后按预算淘汰"""
+        size = os.path.getsize(path)
+        if not self.budget or size > self.budget:
+            return
+        with self._lock:
+            self.index[key] = {'size': size, 'ext': os.path.splitext(path)[1], 'last_used': time.time()}
+            object_path = self._object_path(key)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                link_or_copy(path, object_path)
+            except OSError as e:
+                del self.index[key]
+                logging.error(f"保存转码结果到缓存失败: {e}")
+                return
+            self.stats['stored'] += 1
+            self._evict(keep=key)
+            self._save()
+    
+    def _evict(self, keep=None):
+        """淘汰最久未使用的条目，直到总大小不超过预算（调用时持有锁）"""
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            object_path = self._object_path(key)
+            entry = self.index.pop(key)
+            total -= entry['size']
+            self.stats['evicted'] += 1
+            self.stats['evicted_bytes'] += entry['size']
+            try:
+                os.remove(object_path)
+            except OSError:
+                pass
+            logging.info(f"转码缓存淘汰 {key}（{format_size(entry['size'])}）")
+    
+    def _save(self):
+        """保存索引（调用时持有锁，先写临时文件再替换，避免中断时损坏）"""
+        temp_path = self.index_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logging.error(f"保存转码缓存索引失败: {e}")
+    
+    def summary(self):
+        """返回本批次的转码缓存统计描述"""
+        stats = self.stats
+        total = self.size()
+        return (f"命中 {stats['hits']} 次（跳过转码 {format_size(stats['hit_bytes'])}），新存入 {stats['stored']} 个，"
+                f"淘汰 {stats['evicted']} 个，当前占用 {format_size(total)} / {format_size(self.budget)}")
+
+
+def unconverted_output_path(input_path, output_path):
+    """未转换格式时实际保存的路径：MPEG-TS内容改用.ts扩展名，不以.mp4等名称保存TS数据"""
+    with open(input_path, 'rb') as f:
+        is_ts = f.read(1) == TS_SYNC_BYTE
+    return os.path.splitext(output_path)[0] + '.ts' if is_ts else output_path
+
+
+def existing_final_output(final_output_path):
+    """已存在的最终文件路径（包括未转换格式、以.ts保存的结果），都不存在时返回None"""
+    for path in (final_output_path, os.path.splitext(final_output_path)[0] + '.ts'):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+@profile_stage('transcode')
+def transcode_video(input_path, output_path, target_format="mp4", cancel=None, duration=None, cache=None):
+    """视频转码函数，将视频转换为指定格式，成功时返回实际保存的路径，失败时返回False
+
+    输出先写入同目录的 .part 临时文件，完成后才改名为最终文件，中断时不会留下不完整的最终文件。
+    没有FFmpeg且内置封装器无法处理时不转换格式，TS内容以.ts扩展名保存（见unconverted_output_path）。
+    cancel: 可选的CancelToken，取消时结束FFmpeg（或内置封装器）并抛出DownloadCancelled
+    duration: 可选的视频时长（秒），较长的视频按CPU核数分段并行转码（见transcode_in_chunks）
+    cache: 可选的TranscodeCache，相同输入和参数的FFmpeg转码结果直接链接，转码成功后存入缓存
+    """
+    print(f"\n开始将视频从 {os.path.basename(input_path)} 转码为 {target_format} 格式...")
+    logging.info(f"开始视频转码: {input_path} -> {output_path}")
+    stem, ext = os.path.splitext(output_path)
+    part_path = f"{stem}.part{ext}"
+    
+    try:
+        # 检查FFmpeg是否存在（探测结果按进程和磁盘缓存）
+        ffmpeg = get_media_tools()['ffmpeg']
+        use_ffmpeg = ffmpeg is not None
+        if not use_ffmpeg:
+            print("警告: 未找到FFmpeg，将使用内置封装器转换格式（不重新编码）")
+        
+        if use_ffmpeg:
+            # 使用FFmpeg进行实际转码
+            command = [
+                ffmpeg['path'], '-i', input_path,
+                '-c:v', 'libx264', '-c:a', 'aac',
+                '-strict', 'experimental',
+                '-y',  # 覆盖现有文件
+                part_path
+            ]
+            chunks = plan_transcode_chunks(duration) if TRANSCODE_PARALLEL else 1
+            
+            # 分段并行转码的结果与整体转码不同，分别缓存；两种结果都可以直接使用
+            keys = [None, None]
+            if cache is not None:
+                digest = cache.hash_file(input_path)
+                version = ffmpeg.get('version')
+                if chunks > 1:
+                    keys[0] = cache.make_key(digest, command, input_path, part_path, version, f'chunks={chunks}')
+                keys[1] = cache.make_key(digest, command, input_path, part_path, version)
+            for key in keys:
+                if key is not None and cache.fetch(key, output_path):
+                    print(f"使用转码缓存: {output_path}")
+                    logging.info(f"转码缓存命中: {input_path} -> {output_path} ({key})")
+                    return output_path
+            
+            if chunks > 1:
+                if transcode_in_chunks(ffmpeg['path'], input_path, part_path, duration, chunks, cancel):
+                    os.replace(part_path, output_path)
+                    if keys[0] is not None:
+                        cache.add(keys[0], output_path)
+                    print(f"视频转码成功: {output_path}")
+                    logging.info(f"视频分段并行转码成功: {output_path} ({chunks}个进程)")
+                    return output_path
+                print("分段并行转码失败，改为整体转码")
+                logging.warning(f"分段并行转码失败，改为整体转码: {input_path}")
+            
+            returncode, stderr_msg = run_media_command(command, cancel)
+            if returncode == 0:
+                os.replace(part_path, output_path)
+                if keys[1] is not None:
+                    cache.add(keys[1], output_path)
+                print(f"视频转码成功: {output_path}")
+                logging.info(f"视频转码成功: {output_path}")
+                return output_path
+            else:
+                print(f"视频转码失败: {stderr_msg}")
+                logging.error(f"视频转码失败: {stderr_msg}")
+                return False
+        else:
+            # 没有FFmpeg：H.264+AAC的TS直接封装为MP4，其他情况移动文件（不再额外复制一份）
+            if target_format in REMUX_FORMATS:
+                try:
+                    stats = remux_ts_to_mp4(input_path, part_path, cancel)
+                    os.replace(part_path, output_path)
+                    print(f"视频封装完成（内置封装器）: {output_path}")
+                    logging.info(f"视频封装完成（内置封装器）: {output_path} {stats}")
+                    return output_path
+                except RemuxUnsupportedError as e:
+                    print(f"内置封装器无法处理: {e}，保留原始格式")
+                    logging.warning(f"内置封装器无法处理 {input_path}: {e}")
+            saved_path = unconverted_output_path(input_path, output_path)
+            shutil.move(input_path, saved_path)
+            print(f"视频移动完成（未转换格式）: {saved_path}")
+            logging.info(f"视频移动完成（未转换格式）: {saved_path}")
+            return saved_path
+    
+    except DownloadCancelled:
+        print("转码已中断")
+        logging.warning(f"视频转码已中断: {input_path}")
+        raise
+    except Exception as e:
+        print(f"视频转码过程中出错: {e}")
+        logging.error(f"视频转码过程中出错: {e}")
+        return False
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+@profile_stage('transcode')
+def mux_tracks(video_path, tracks, output_path, target_format="mp4", cancel=None):
+    """把合并后的视频和独立的音频、字幕轨道一次封装为最终文件（流复制，不重新编码）
+
+    tracks: [{"type": "audio"或"subtitles", "name", "language", "path"}]
+    有独立音频轨道时不再保留视频变体自带的音频；mp4类格式的字幕转换为mov_text。
+    输出先写入 .part 临时文件，完成后改名。需要FFmpeg，失败时返回False。
+    """
+    ffmpeg = get_media_tools()['ffmpeg']
+    if ffmpeg is None:
+        return False
+    stem, ext = os.path.splitext(output_path)
+    part_path = f"{stem}.part{ext}"
+    audio = [track for track in tracks if track['type'] == 'audio']
+    subtitles = [track for track in tracks if track['type'] == 'subtitles']
+    
+    command = [ffmpeg['path'], '-i', video_path]
+    for track in audio + subtitles:
+        command += ['-i', track['path']]
+    command += ['-map', '0:v:0']
+    if not audio:
+        command += ['-map', '0:a?']
+    for i, track in enumerate(audio + subtitles, 1):
+        command += ['-map', f"{i}:{'a' if track['type'] == 'audio' else 's'}:0"]
+    command += ['-c', 'copy']
+    if subtitles and target_format in REMUX_FORMATS:
+        command += ['-c:s', 'mov_text']
+    for kind, group in (('a', audio), ('s', subtitles)):
+        for i, track in enumerate(group):
+            if track.get('language'):
+                command += [f'-metadata:s:{kind}:{i}', f"language={track['language']}"]
+            if track.get('name'):
+                command += [f'-metadata:s:{kind}:{i}', f"title={track['name']}"]
+    command += ['-y', part_path]
+    
+    print(f"\n封装视频和{len(audio)}个音频轨道、{len(subtitles)}个字幕轨道...")
+    try:
+        returncode, stderr_msg = run_media_command(command, cancel)
+        if returncode != 0:
+            print(f"封装轨道失败: {stderr_msg}")
+            logging.error(f"封装轨道失败: {stderr_msg}")
+            return False
+        os.replace(part_path, output_path)
+        print(f"封装轨道成功: {output_path}")
+        logging.info(f"封装轨道成功: {output_path} (音频{len(audio)}个, 字幕{len(subtitles)}个)")
+        return True
+    except DownloadCancelled:
+        print("封装已中断")
+        logging.warning(f"封装轨道已中断: {video_path}")
+        raise
+    except OSError as e:
+        print(f"封装轨道过程中出错: {e}")
+        logging.error(f"封装轨道过程中出错: {e}")
+        return False
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def save_track_files(tracks, output_path):
+    """没有封装进最终文件的音频、字幕轨道保存在最终文件旁边，如"第01集.zh.vtt"、"第01集.audio.en.aac"，返回保存的路径"""
+    stem = os.path.splitext(output_path)[0]
+    saved = []
+    for i, track in enumerate(tracks):
+        label = track.get('language') or track.get('name') or str(i)
+        parts = [stem, 'audio', label] if track['type'] == 'audio' else [stem, label]
+        target = '.'.join(parts) + os.path.splitext(track['path'])[1]
+        if target in saved:
+            target = '.'.join(parts + [str(i)]) + os.path.splitext(track['path'])[1]
+        shutil.move(track['path'], target)
+        saved.append(target)
+    return saved
+
+# 目录配置（相对路径基于当前工作目录）
+SCRATCH_DIR = 'data'  # 片段和临时合成文件目录，可以放在单独的磁盘（如tmpfs）上
+OUTPUT_DIR = 'video'  # 最终视频目录
+
+
+def ensure_directories(work_title=None):
+    """确保必要的目录存在
+    
+    参数:
+    work_title: 视频作品名称，如果提供，将在video目录下创建对应的子目录
+    
+    返回:
+    temp_dir: 临时文件目录路径
+    video_dir: 最终视频目录路径（包含作品子目录，如果提供了work_title）
+    """
+    temp_dir = os.path.abspath(SCRATCH_DIR)  # 临时文件目录
+    video_dir = os.path.abspath(OUTPUT_DIR)  # 最终视频目录
+    
+    # 创建基础目录
+    for dir_path in [temp_dir, video_dir]:
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+            print(f"创建目录: {dir_path}")
+    
+    # 如果提供了作品名称，创建对应的子目录
+    if work_title:
+        video_dir = os.path.join(video_dir, work_title)
+        if not os.path.exists(video_dir):
+            os.makedirs(video_dir)
+            print(f"创建作品目录: {video_dir}")
+    
+    return temp_dir, video_dir
+
+
+# 磁盘空间准入相关常量
+DISK_RESERVE = 1024 * 1024 * 1024  # 每个磁盘至少保留的剩余空间
+DISK_BUDGET = None  # 本批次最多新占用的磁盘空间（字节），None表示只受剩余空间限制
+SCRATCH_FOOTPRINT_FACTOR = 4  # 临时目录的峰值占用约为视频大小的倍数（片段 + 临时合成文件 + 分段转码的源分段和编码分段）
+OUTPUT_FOOTPRINT_FACTOR = 1  # 输出目录的峰值占用约为视频大小的倍数（最终文件）
+
+
+def parse_size(text):
+    """解析容量字符串（如 500M、20G、1.5T），返回字节数"""
+    text = text.strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def estimate_episode_size(playlist):
+    """估算一集视频的大小（字节），无法估算时返回None
+
+    依次使用：字节范围播放列表的范围长度之和、多码率变体的码率 × 总时长、
+    首个片段的Content-Length × 片段数。
+    """
+    segments = playlist['segments']
+    if all(segment['byterange'] for segment in segments):
+        return sum(segment['byterange'][1] for segment in segments)
+    duration = sum(segment['duration'] for segment in segments)
+    if playlist.get('bandwidth') and duration:
+        return int(playlist['bandwidth'] * duration / 8)
+    try:
+        resp = http_session().head(segments[0]['url'], timeout=10, allow_redirects=True)
+        length = int(resp.headers.get('content-length', 0))
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    return length * len(segments) if resp.ok and length else None
+
+
+class DiskBudget:
+    """磁盘空间准入控制
+
+    每集开始前按估算大小计算临时目录和输出目录的峰值占用（两者在同一磁盘上时合计约3倍），
+    只有各个磁盘在扣除这部分占用后仍高于保留空间、且本批次新占用的空间不超过预算时才允许开始。
+    已占用的空间用批次开始以来剩余空间的减少量衡量，去重存储等长期占用也会计算在内。
+    caches: 有预算的长期存储（去重存储、转码缓存，需提供root、budget和size()），
+        每集最多让它们各增长约一集的大小（且不超过预算），这部分空间计入所在磁盘的预计占用。
+    """
+    def __init__(self, scratch_dir, output_dir, budget=DISK_BUDGET, reserve=DISK_RESERVE, caches=()):
+        self.budget = budget
+        self.reserve = reserve
+        self.volumes = {}
+        for path, factor in ((scratch_dir, SCRATCH_FOOTPRINT_FACTOR), (output_dir, OUTPUT_FOOTPRINT_FACTOR)):
+            volume = self.volumes.setdefault(os.stat(path).st_dev, {
+                'path': path, 'factor': 0, 'start_free': shutil.disk_usage(path).free, 'caches': []})
+            volume['factor'] += factor
+        for cache in caches:
+            if cache is not None and cache.budget:
+                self.volumes.setdefault(os.stat(cache.root).st_dev, {
+                    'path': cache.root, 'factor': 0, 'start_free': shutil.disk_usage(cache.root).free, 'caches': []
+                })['caches'].append(cache)
+    
+    def admit(self, estimate):
+        """判断预计大小为estimate字节（None表示未知）的一集能否开始，返回 (是否允许, 原因)"""
+        used = 0
+        for volume in self.volumes.values():
+            free = shutil.disk_usage(volume['path']).free
+            used += max(volume['start_free'] - free, 0)
+            need = (estimate or 0) * volume['factor']
+            need += sum(min(max(cache.budget - cache.size(), 0), estimate or 0) for cache in volume['caches'])
+            if free - need < self.reserve:
+                return False, (f"{volume['path']} 剩余 {format_size(free)}，预计需要 {format_size(need)}"
+                               f"（保留 {format_size(self.reserve)}）")
+        if self.budget is not None:
+            need = (estimate or 0) * sum(volume['factor'] for volume in self.volumes.values())
+            if used + need > self.budget:
+                return False, (f"本批次已占用 {format_size(used)}，预计还需要 {format_size(need)}，"
+                               f"超过磁盘预算 {format_size(self.budget)}")
+        return True, None
+
+
+def finish_episode_transcode(task_id, temp_output_path, final_output_path, output_format, m3u8_url, scratch_dir,
+                             cancel=None, transcode_cache=None, **fields):
+    """转码合并后的临时文件，成功后清理该集的临时目录并标记完成
+
+    fields中native_mp4为True时，合并结果已经是完整的MP4（fMP4直接组装），输出mp4时不再转码。
+    fields中tracks为独立的音频、字幕轨道时，用FFmpeg与视频一次封装；没有FFmpeg或封装失败时只处理视频，
+    轨道文件保存在最终文件旁边。
+    转码被取消时保留合并后的临时文件，标记为在转码阶段中断，下次运行时直接转码。
+    transcode_cache: 可选的TranscodeCache，相同输入的转码结果直接链接到最终位置
+    """
+    # 更新任务状态为转码中
+    update_task_status(task_id, 'transcoding', **fields)
+    
+    tracks = [track for track in fields.get('tracks') or [] if os.path.exists(track['path'])]
+    muxed = False
+    try:
+        if tracks and get_media_tools()['ffmpeg'] is not None:
+            muxed = mux_tracks(temp_output_path, tracks, final_output_path, output_format, cancel=cancel)
+            if not muxed:
+                print("封装独立轨道失败，只处理视频，音频和字幕保存为单独的文件")
+        if muxed:
+            success = True
+        elif fields.get('native_mp4') and output_format in FMP4_DIRECT_FORMATS:
+            print("fMP4片段已直接组装为MP4，跳过转码")
+            shutil.move(temp_output_path, final_output_path)
+            success = True
+        else:
+            # 转码视频到最终格式并保存到video目录（未转换格式时扩展名可能不同）
+            saved_path = transcode_video(temp_output_path, final_output_path, output_format, cancel=cancel,
+                                         duration=fields.get('duration'), cache=transcode_cache)
+            success = bool(saved_path)
+            if success:
+                final_output_path = saved_path
+    except (DownloadCancelled, KeyboardInterrupt) as e:
+        mark_interrupted(task_id, m3u8_url, 'transcoding', **fields)
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        print("转码已中断，合并后的文件已保留，下次运行时直接转码")
+        return False
+    if success:
+        if tracks and not muxed:
+            for path in save_track_files(tracks, final_output_path):
+                print(f"轨道文件保存到: {path}")
+        # 清理临时合成文件和该集的临时目录
+        if os.path.exists(temp_output_path):
+            os.remove(temp_output_path)
+            print(f"清理临时合成文件: {temp_output_path}")
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        
+        print(f"\n视频处理完成！最终文件保存到: {final_output_path}")
+        update_task_status(task_id, 'completed', {'file_path': final_output_path, 'url': m3u8_url}, **fields)
+        return True
+    else:
+        print("视频转码失败")
+        logging.error("视频转码失败")
+        update_task_status(task_id, 'failed', {'error': '视频转码失败', 'url': m3u8_url}, **fields)
+        return False
+
+
+@pause_gc
+def build_download_tasks(playlist, scratch_dir, prefix=''):
+    """把播放列表转换为按输出顺序排列的下载任务
+
+    返回 (任务列表, 初始化片段数)，任务为 (url, 本地路径, 解密参数, 序号, 字节范围)。
+    字节范围播放列表中相邻的范围合并为一个请求；fMP4的初始化片段只下载一次，排在第一个使用它的分片之前。
+    prefix: 本地文件名前缀，独立音频、字幕轨道与视频的片段保存在同一目录时用于区分
+    """
+    download_tasks = []
+    init_sections = {}
+    for unit in build_download_units(playlist['segments']):
+        init = unit['map']
+        if init is not None and (init['url'], init['byterange']) not in init_sections:
+            init_sections[(init['url'], init['byterange'])] = len(init_sections)
+            ext = os.path.splitext(init['uri'].split('/')[-1].split('?')[0])[1] or '.mp4'
+            init_path = os.path.join(scratch_dir, f"{prefix}init_{len(init_sections) - 1}{ext}")
+            download_tasks.append((init['url'], init_path, None, None, init['byterange']))
+        # 提取文件名部分（去掉路径、URL前缀和查询参数）用于本地存储
+        ts_filename = unit['uri'].rpartition('/')[2].partition('?')[0]
+        if unit['byterange'] is not None:
+            # 同一文件的不同字节范围分别保存
+            stem, ext = os.path.splitext(ts_filename)
+            ts_filename = f"{stem}_{unit['byterange'][0]}{ext}"
+        ts_path = os.path.join(scratch_dir, prefix + ts_filename)
+        download_tasks.append((unit['url'], ts_path, unit['key'], unit['sequence'], unit['byterange']))
+    return download_tasks, len(init_sections)
+
+
+def process_single_episode(episode_num, m3u8_url, output_format="mp4", max_workers=8, work_title=None,
+                           batch_progress=None, playlist=None, segment_store=None, cancel=None,
+                           transcode_cache=None, gap_tolerance=GAP_TOLERANCE):
+    """处理单个剧集的完整流程：爬取 -> 合成 -> 转码
+
+    支持断点续传：已记录在完成清单中的片段不再下载，合并已完成时直接转码。
+    主下载结束后仍有缺失的片段时进入修复阶段：重新获取播放列表（优先换用其他主机上的同码率镜像）、
+    关闭已有连接并重新解析DNS，只重试缺失的片段，最多REPAIR_ROUNDS轮。
+    
+    batch_progress: 可选的BatchProgress，用于在进度条中显示整批进度
+    playlist: 可选的预取播放列表（resolve_playlist的返回值），提供时不再请求m3u8
+    segment_store: 可选的SegmentStore，跨剧集、跨作品复用相同的片段
+    transcode_cache: 可选的TranscodeCache，跨剧集、跨作品复用相同输入的转码结果
+    cancel: 可选的CancelToken，取消后不再下载新的片段，保存完成清单并把任务标记为已中断
+    gap_tolerance: 修复后仍允许缺失的视频/音频片段数，超过时不合并，标记为失败（已完成的片段保留，下次只下载缺失的）；
+        缺失数记录在任务状态的gaps字段中
+    """
+    print(f"\n{'='*60}")
+    if work_title:
+        print(f"开始处理 {work_title} 第{episode_num}集")
+    else:
+        print(f"开始处理第{episode_num}集")
+    print(f"M3U8地址: {m3u8_url}")
+    print(f"{'='*60}")
+    
+    # 确保目录结构
+    temp_dir, video_dir = ensure_directories(work_title)
+    
+    # 任务键和该集独立的临时目录（不同作品的同一集数互不影响）
+    task_id = task_key(work_title, episode_num, m3u8_url)
+    fields = {'work': work_title, 'episode': int(episode_num)}
+    scratch_dir = episode_scratch_dir(temp_dir, work_title, episode_num, m3u8_url)
+    
+    # 准备文件名
+    episode_str = str(episode_num).zfill(2)  # 补零为2位数，如01, 02
+    temp_filename = f"第{episode_str}集.temp.mp4"  # 临时合成文件名
+    final_filename = f"第{episode_str}集.{output_format}"  # 最终转码后的文件名
+    temp_output_path = os.path.join(scratch_dir, temp_filename)
+    
+    # 检查是否已经完成
+    final_output_path = os.path.join(video_dir, final_filename)
+    existing_path = existing_final_output(final_output_path)
+    if existing_path is not None:
+        print(f"第{episode_num}集已经处理完成，跳过")
+        update_task_status(task_id, 'completed', {'file_path': existing_path, 'url': m3u8_url}, **fields)
+        return True
+    
+    # 上次已合并完成、在转码阶段中断的，直接转码
+    previous = load_task_status().get(task_id, {})
+    if merged_awaiting_transcode(previous) and os.path.exists(temp_output_path):
+        print(f"第{episode_num}集已合并完成，直接转码")
+        if previous.get('native_mp4'):
+            fields['native_mp4'] = True
+        if previous.get('duration'):
+            fields['duration'] = previous['duration']
+        if previous.get('tracks'):
+            fields['tracks'] = previous['tracks']
+        return finish_episode_transcode(task_id, temp_output_path, final_output_path, output_format, m3u8_url,
+                                        scratch_dir, cancel=cancel, transcode_cache=transcode_cache,
+                                        **fields)
+    
+    # 更新任务状态为下载中
+    update_task_status(task_id, 'downloading', {'url': m3u8_url}, **fields)
+    stage = 'downloading'  # 中断时记录的阶段，进入转码后由finish_episode_transcode自行记录
+    
+    try:
+        # 获取m3u8信息（已预取时直接使用）
+        if playlist is None:
+            playlist = resolve_playlist(m3u8_url)
+        else:
+            print(f"使用预取的播放列表，共{len(playlist['segments'])}个片段")
+        if not playlist:
+            update_task_status(task_id, 'failed', {'error': '无法获取m3u8信息', 'url': m3u8_url}, **fields)
+            return False
+        
+        renditions = playlist.get('renditions') or []
+        all_segments = itertools.chain(playlist['segments'], *(rendition['segments'] for rendition in renditions))
+        encrypted_methods = {segment['key']['method'] for segment in all_segments if segment['key']}
+        if encrypted_methods - {'AES-128'}:
+            error = f"不支持的加密方式: {', '.join(sorted(encrypted_methods - {'AES-128'}))}"
+            print(error)
+            update_task_status(task_id, 'failed', {'error': error, 'url': m3u8_url}, **fields)
+            return False
+        if encrypted_methods and _load_aes_decryptor() is None:
+            error = "片段使用AES-128加密，请安装pycryptodome或cryptography后重试"
+            print(error)
+            update_task_status(task_id, 'failed', {'error': error, 'url': m3u8_url}, **fields)
+            return False
+        
+        # 准备下载任务（字节范围播放列表中相邻的范围合并为一个请求）
+        os.makedirs(scratch_dir, exist_ok=True)
+        container = playlist.get('container', 'ts')
+        download_tasks, init_count = build_download_tasks(playlist, scratch_dir)
+        video_task_count = len(download_tasks)
+        task_containers = [container] * video_task_count
+        # 独立的音频、字幕轨道与视频片段一起由同一个线程池下载，之后分别合并，再与视频一次封装
+        tracks = []
+        for i, rendition in enumerate(renditions):
+            name = f"{rendition['type']}{i}"
+            rendition_tasks, _ = build_download_tasks(rendition, scratch_dir, prefix=f"{name}_")
+            tracks.append({
+                'type': rendition['type'], 'name': rendition['name'], 'language': rendition['language'],
+                'container': rendition['container'],
+                'indexes': range(len(download_tasks), len(download_tasks) + len(rendition_tasks)),
+                'path': os.path.join(scratch_dir,
+                                     f"第{episode_str}集.{name}{TRACK_EXTENSIONS.get(rendition['container'], '.ts')}"),
+            })
+            download_tasks += rendition_tasks
+            task_containers += [rendition['container']] * len(rendition_tasks)
+        if tracks:
+            labels = [f"{'音频' if track['type'] == 'audio' else '字幕'}({track['language'] or track['name'] or '-'})"
+                      for track in tracks]
+            print(f"独立轨道: {', '.join(labels)}，与视频片段一起下载")
+        # 视频时长用于决定转码的分段数（记录在任务状态中，从转码阶段继续时同样可用）
+        fields['duration'] = round(sum(segment['duration'] for segment in playlist['segments']), 3)
+        
+        if container == 'fmp4':
+            if init_count == 1:
+                fields['native_mp4'] = True
+                print("检测到fMP4（CMAF）片段，下载后直接组装为MP4")
+            else:
+                print(f"检测到fMP4片段，但包含{init_count}个初始化片段，组装后仍需转码")
+        
+        # 下载所有ts文件（多线程）
+        total_ts = len(download_tasks)
+        
+        # 断点续传：跳过完成清单中记录且大小一致的片段
+        recorded_total, done_files = read_segment_manifest(scratch_dir)
+        if recorded_total != total_ts:
+            done_files = set()
+        downloaded_success = [os.path.basename(task[1]) in done_files for task in download_tasks]
+        pending_indexes = [i for i, done in enumerate(downloaded_success) if not done]
+        if len(pending_indexes) < total_ts:
+            print(f"\n断点续传：已完成{total_ts - len(pending_indexes)}个片段，剩余{len(pending_indexes)}个")
+        print(f"\n开始下载{len(pending_indexes)}个ts文件...")
+        
+        # 使用线程池下载，保持原始顺序
+        validation_stats = ValidationStats()
+        # 签名过期时所有下载线程共享一次播放列表刷新
+        refresher = PlaylistRefresher(m3u8_url, playlist)
+        manifest = SegmentManifest(scratch_dir, total_ts)
+        
+        # 创建进度条（渲染线程在下面的finally中停止，出错或中断时也不会残留）
+        label = f"{work_title} 第{episode_num}集" if work_title else f"第{episode_num}集"
+        progress_bar = ProgressBar(len(pending_indexes), label=label, batch=batch_progress)
+        
+        def attempt(index):
+            """在工作线程中尝试下载一次片段"""
+            ts_url, ts_path, key, sequence, byte_range = download_tasks[index]
+            # 签名过期时只刷新视频播放列表，独立轨道的片段不参与刷新
+            is_video = index < video_task_count
+            with log_context(work=work_title, episode=episode_num, segment=index):
+                return download_segment(ts_url, ts_path, store=segment_store,
+                                        url_key=SegmentStore.url_key(ts_url, byte_range),
+                                        progress=progress_bar, validation_stats=validation_stats, key=key,
+                                        refresher=refresher if is_video else None, sequence=sequence,
+                                        byte_range=byte_range, container=task_containers[index], cancel=cancel)
+        
+        def on_result(index, success):
+            """记录片段的最终结果（在调度线程中执行）"""
+            downloaded_success[index] = success
+            if success:
+                manifest.record(download_tasks[index][1])
+            progress_bar.update(success)
+        
+        def on_repaired(index, success):
+            """记录修复阶段的结果：修复成功的片段从失败计数转为完成"""
+            if success:
+                downloaded_success[index] = True
+                manifest.record(download_tasks[index][1])
+                progress_bar.recover()
+        
+        def current_url(index):
+            """片段当前使用的地址（视频片段在重新解析播放列表后可能已经换用新地址）"""
+            if index < video_task_count:
+                _, segment = refresher.current(download_tasks[index][3])
+                if segment is not None:
+                    return segment['url']
+            return download_tasks[index][0]
+        
+        repaired = 0
+        if pending_indexes:
+            # 在后台与片段主机建立连接，下载线程启动后直接复用（只在实际下载时预热，解析、探测和预取不发请求）
+            prewarm_connections(download_tasks[pending_indexes[0]][0])
+        try:
+            # 重试由调度线程定时重新提交，下载线程不会因退避而空等
+            with futures.ThreadPoolExecutor(max_workers=max_workers) as executor, profile_stage('download'):
+                scheduler = SegmentRetryScheduler(executor, attempt)
+                scheduler.run([(i, download_tasks[i][0]) for i in pending_indexes], on_result, cancel=cancel)
+                
+                # 修复阶段：只重试缺失的片段，换用新的播放列表和连接
+                for repair_round in range(1, REPAIR_ROUNDS + 1):
+                    missing = [i for i in pending_indexes if not downloaded_success[i]]
+                    if not missing or (cancel is not None and cancel.cancelled):
+                        break
+                    hosts = {urlparse(current_url(i)).hostname for i in missing}
+                    print(f"\n修复阶段（第{repair_round}轮）: {len(missing)}个片段缺失，"
+                          f"重新获取播放列表并换用新的连接重试")
+                    logging.warning(f"修复阶段（第{repair_round}轮）: {len(missing)}个片段缺失 "
+                                    f"(主机: {', '.join(sorted(filter(None, hosts)))})")
+                    if not refresher.reload(avoid_hosts=hosts):
+                        logging.warning(f"修复阶段重新获取播放列表失败，使用原地址重试: {m3u8_url}")
+                    reset_connections(hosts)
+                    scheduler.run([(i, current_url(i)) for i in missing], on_repaired, cancel=cancel)
+                    repaired += sum(1 for i in missing if downloaded_success[i])
+        finally:
+            manifest.close()
+            progress_bar.finish()
+        
+        # 按照原始顺序构建已下载ts文件列表
+        downloaded_ts_files = []
+        for i, success in enumerate(downloaded_success[:video_task_count]):
+            if success:
+                ts_path = download_tasks[i][1]
+                downloaded_ts_files.append(ts_path)
+        for track in tracks:
+            track['files'] = [download_tasks[i][1] for i in track['indexes'] if downloaded_success[i]]
+        
+        if segment_store is not None:
+            segment_store.save()
+        
+        # 输出校验开销，确认校验不会拖慢下载
+        stats = validation_stats.summary()
+        if stats['segments']:
+            per_mb = stats['cost'] * 1e6 / max(stats['bytes'] / (1024 * 1024), 1e-9)
+            print(f"片段校验: {stats['segments']}次, 损坏并重新下载: {stats['invalid']}次, "
+                  f"校验耗时: {stats['cost'] * 1000:.2f}ms (约{per_mb:.0f}µs/MB)")
+            logging.info(f"片段校验统计: {stats}")
+        
+        if cancel is not None:
+            # 已完成的片段都记录在清单中，中断后下次运行只下载剩余的片段
+            cancel.check()
+        
+        # 缺失片段统计：视频和音频的缺失会造成画面或声音中断，字幕缺失只记录不计入容忍度
+        gap_indexes = [i for i in range(video_task_count) if not downloaded_success[i]]
+        subtitle_gaps = 0
+        for track in tracks:
+            track_gaps = [i for i in track['indexes'] if not downloaded_success[i]]
+            if track['type'] == 'audio':
+                gap_indexes += track_gaps
+            else:
+                subtitle_gaps += len(track_gaps)
+        sequences = [download_tasks[i][3] for i in gap_indexes if download_tasks[i][3] is not None]
+        fields['gaps'] = {'missing': len(gap_indexes), 'subtitles': subtitle_gaps, 'repaired': repaired,
+                          'sequences': sequences[:GAP_RECORD_LIMIT]}
+        if repaired:
+            print(f"修复阶段补回 {repaired} 个片段")
+            logging.info(f"修复阶段补回 {repaired} 个片段")
+        
+        if not downloaded_ts_files:
+            print("没有成功下载任何ts文件")
+            logging.error("没有成功下载任何ts文件")
+            update_task_status(task_id, 'failed', {'error': '没有成功下载任何ts文件', 'url': m3u8_url}, **fields)
+            return False
+        if any(track['type'] == 'audio' and not track['files'] for track in tracks):
+            # 视频变体不含音频，没有音频片段时不合成无声的视频
+            print("没有成功下载任何音频片段")
+            logging.error("没有成功下载任何音频片段")
+            update_task_status(task_id, 'failed', {'error': '没有成功下载任何音频片段', 'url': m3u8_url}, **fields)
+            return False
+        if len(gap_indexes) > gap_tolerance:
+            # 已完成的片段记录在清单中，下次运行时只下载缺失的片段
+            error = f"缺失{len(gap_indexes)}个片段（允许{gap_tolerance}个）"
+            print(f"{error}，不合并，下次运行时只重新下载缺失的片段")
+            logging.error(f"{error}: {m3u8_url}")
+            update_task_status(task_id, 'failed', {'error': error, 'url': m3u8_url}, **fields)
+            return False
+        if gap_indexes or subtitle_gaps:
+            print(f"警告: 缺失{len(gap_indexes)}个视频/音频片段、{subtitle_gaps}个字幕片段，在允许范围内，继续合并")
+            logging.warning(f"缺失{len(gap_indexes)}个视频/音频片段、{subtitle_gaps}个字幕片段，在允许范围内: {m3u8_url}")
+        
+        # 更新任务状态为合并中
+        update_task_status(task_id, 'merging', **fields)
+        stage = 'merging'
+        
+        # 合并ts文件（临时文件）
+        print(f"\n开始合并ts文件到临时文件: {temp_output_path}")
+        
+        if merge_track_files(downloaded_ts_files, temp_output_path, container, cancel=cancel):
+            print(f"视频合成成功: {temp_output_path}")
+            logging.info(f"视频合成成功: {temp_output_path}")
+            merged_tracks = []
+            for track in tracks:
+                if not track['files']:
+                    continue
+                if merge_track_files(track['files'], track['path'], track['container'], cancel=cancel):
+                    merged_tracks.append({key: track[key] for key in ('type', 'name', 'language', 'path')})
+                elif track['type'] == 'audio':
+                    print("音频轨道合成失败")
+                    logging.error(f"音频轨道合成失败: {track['path']}")
+                    update_task_status(task_id, 'failed', {'error': '音频轨道合成失败', 'url': m3u8_url}, **fields)
+                    return False
+                else:
+                    print(f"字幕轨道合成失败，跳过: {track['path']}")
+                    logging.warning(f"字幕轨道合成失败: {track['path']}")
+            if merged_tracks:
+                fields['tracks'] = merged_tracks
+            # 先记录合并完成再清理片段，中断后可以直接从转码继续
+            update_task_status(task_id, 'transcoding', **fields)
+            stage = None
+            
+            # 清理临时ts文件
+            print("清理临时ts文件...")
+            clean_ts_files(downloaded_ts_files)
+            for track in tracks:
+                clean_ts_files(track['files'])
+            print("临时ts文件清理完成")
+            
+            return finish_episode_transcode(task_id, temp_output_path, final_output_path, output_format, m3u8_url,
+                                            scratch_dir, cancel=cancel, transcode_cache=transcode_cache,
+                                            **fields)
+        else:
+            print("视频合成失败")
+            logging.error("视频合成失败")
+            update_task_status(task_id, 'failed', {'error': '视频合成失败', 'url': m3u8_url}, **fields)
+            return False
+    
+    except (DownloadCancelled, KeyboardInterrupt) as e:
+        if stage == 'merging':
+            # 合并到一半的临时文件不完整，下次运行时重新合并
+            for path in [temp_output_path] + [track['path'] for track in tracks]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if stage is not None:
+            mark_interrupted(task_id, m3u8_url, stage, **fields)
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        print(f"\n第{episode_num}集已中断，进度已保存，下次运行时继续")
+        logging.warning(f"第{episode_num}集在{TASK_STATUSES[stage or 'transcoding']}阶段中断")
+        return False
+    except Exception as e:
+        print(f"处理第{episode_num}集时发生未知错误: {e}")
+        logging.error(f"处理第{episode_num}集时发生未知错误: {e}")
+        update_task_status(task_id, 'failed', {'error': str(e), 'url': m3u8_url}, **fields)
+        return False
+
+
+def expand_jobs(works_list):
+    """展开为按顺序处理的剧集列表 [(作品名, 集数, m3u8地址)]，每个作品集使用独立的集数编号（从1开始）"""
+    return [(work['title'], episode_num, url)
+            for work in works_list
+            for episode_num, url in enumerate(work['urls'], 1)]
+
+
+def jobs_from_status():
+    """从任务状态中恢复未完成的剧集列表（resume未指定列表文件时使用）"""
+    jobs = []
+    for task_id, status_info in get_pending_tasks():
+        url = status_info.get('info', {}).get('url')
+        if url and status_info.get('episode') is not None:
+            jobs.append((status_info.get('work'), status_info['episode'], url))
+    return jobs
+
+
+class ResumePlanTally:
+    """断点续传规划的汇总：各阶段的集数、剩余片段数和尚未开始的集数"""
+    def __init__(self):
+        self.counts = {}
+        self.remaining_segments = 0
+        self.unknown = 0
+    
+    def add(self, item):
+        self.counts[item['stage']] = self.counts.get(item['stage'], 0) + 1
+        if item['stage'] == 'download':
+            if item['remaining'] is None:
+                self.unknown += 1
+            else:
+                self.remaining_segments += item['remaining']
+    
+    def print(self):
+        counts = self.counts
+        print(f"\n断点续传规划: 已完成 {counts.get('done', 0)} 集, 待转码 {counts.get('transcode', 0)} 集, "
+              f"待合并 {counts.get('merge', 0)} 集, 待下载 {counts.get('download', 0)} 集"
+              f"（剩余片段 {self.remaining_segments} 个，另有 {self.unknown} 集尚未开始）")
+
+
+def plan_episode(work_title, episode_num, url, task_status, temp_dir, video_root, output_format="mp4"):
+    """断点续传规划中的一集：根据任务状态和磁盘上的中间文件判断剩余的工作（见plan_resume）"""
+    task_id = task_key(work_title, episode_num, url)
+    episode_str = str(episode_num).zfill(2)
+    final_output_path = os.path.join(video_root, work_title or '', f"第{episode_str}集.{output_format}")
+    scratch_dir = episode_scratch_dir(temp_dir, work_title, episode_num, url)
+    remaining = None
+    if existing_final_output(final_output_path) is not None:
+        stage = 'done'
+        remaining = 0
+    elif (merged_awaiting_transcode(task_status.get(task_id, {}))
+          and os.path.exists(os.path.join(scratch_dir, f"第{episode_str}集.temp.mp4"))):
+        stage = 'transcode'
+        remaining = 0
+    else:
+        total, done_files = read_segment_manifest(scratch_dir)
+        if total is not None:
+            remaining = max(total - len(done_files), 0)
+        stage = 'merge' if remaining == 0 else 'download'
+    return {'work': work_title, 'episode': episode_num, 'url': url, 'task_id': task_id,
+            'stage': stage, 'remaining': remaining}
+
+
+def plan_resume(jobs, output_format="mp4"):
+    """断点续传规划：根据任务状态和磁盘上的中间文件，一次性计算每集剩余的工作
+
+    返回 [{"work", "episode", "url", "task_id", "stage", "remaining"}]，stage取值：
+    done（最终文件已存在）、transcode（只需转码）、merge（片段齐全只需合并）、download（还有片段要下载），
+    remaining为剩余片段数（未知时为None）。
+    """
+    task_status = load_task_status()
+    temp_dir, video_root = ensure_directories()
+    return [plan_episode(work_title, episode_num, url, task_status, temp_dir, video_root, output_format)
+            for work_title, episode_num, url in jobs]
+
+
+def mark_planned_done(item, task_status):
+    """最终文件已存在但状态未记录完成（例如在写入状态前中断）时补记为完成"""
+    if task_status.get(item['task_id'], {}).get('status') != 'completed':
+        update_task_status(item['task_id'], 'completed', {'url': item['url']},
+                           work=item['work'], episode=item['episode'])
+
+
+def iter_remaining_jobs(jobs, output_format="mp4"):
+    """断点续传规划的流式版本：边读边对每集做与plan_resume相同的检查，跳过已完成的剧集，其余剧集原样产出
+
+    用于边读边处理的列表文件，不需要先读完整个列表；已完成但状态未记录的剧集补记为完成，
+    列表读完时显示与print_resume_plan相同的汇总。剩余的片段、合并和转码由process_single_episode按阶段继续。
+    """
+    task_status = load_task_status()
+    temp_dir, video_root = ensure_directories()
+    tally = ResumePlanTally()
+    for work_title, episode_num, url in jobs:
+        item = plan_episode(work_title, episode_num, url, task_status, temp_dir, video_root, output_format)
+        tally.add(item)
+        if item['stage'] == 'done':
+            mark_planned_done(item, task_status)
+            continue
+        logging.info(f"断点续传规划: {work_title} 第{episode_num}集 {item['stage']}"
+                     + (f"（剩余片段 {item['remaining']} 个）" if item['stage'] == 'download' else ""))
+        yield work_title, episode_num, url
+    tally.print()
+
+
+def print_resume_plan(plan):
+    """显示断点续传规划的汇总"""
+    tally = ResumePlanTally()
+    for item in plan:
+        tally.add(item)
+    tally.print()
+
+
+def iter_m3u8_list(source):
+    """逐行解析m3u8地址列表，边读边产出 (作品名称, m3u8地址)，不把整个文件读入内存
+
+    source: 文件路径，'-'表示标准输入。数据格式：
+    - 以"[视频作品名称]"格式开头的标题行，后面可以跟调度选项（见parse_title_line），如"[作品] priority=10"
+    - 后续为一个或多个视频URL地址，每行一个URL
+    - 不同视频作品之间使用空行分隔
+    """
+    current_title = None
+    if source == '-':
+        f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    else:
+        try:
+            f = open(source, 'r', encoding='utf-8')
+        except OSError as e:
+            print(f"读取m3u8列表文件错误: {e}")
+            logging.error(f"读取m3u8列表文件错误: {e}")
+            return
+    
+    try:
+        for i, line in enumerate(f):
+            line = line.strip()
+            
+            if not line:  # 空行，结束当前作品的URL收集
+                current_title = None
+                continue
+            
+            if line.startswith('[') and ']' in line:  # 标题行
+                current_title, options = parse_title_line(line)
+                if options:
+                    set_work_options(current_title, options)
+            elif current_title is not None:  # URL行
+                # 检查是否包含.m3u8（支持带查询参数的m3u8地址）
+                if '.m3u8' in line:
+                    yield current_title, line
+                else:  # 无效行
+                    print(f"警告：{current_title}作品中第{i+1}行不是有效的m3u8地址: {line}")
+                    logging.warning(f"{current_title}作品中第{i+1}行不是有效的m3u8地址: {line}")
+            else:  # 无效行
+                print(f"警告：第{i+1}行不是有效的标题或m3u8地址: {line}")
+                logging.warning(f"第{i+1}行不是有效的标题或m3u8地址: {line}")
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"读取m3u8列表文件错误: {e}")
+        logging.error(f"读取m3u8列表文件错误: {e}")
+    finally:
+        if source == '-':
+            f.detach()  # 不关闭标准输入
+        else:
+            f.close()
+
+
+def read_m3u8_list(txt_path):
+    """从指定的txt文件中读取m3u8地址列表（格式见iter_m3u8_list）
+
+    返回格式：[{"title": "作品名称", "urls": ["url1", "url2"]}]，相邻的同名作品合并为一个
+    """
+    works_list = []
+    for title, url in iter_m3u8_list(txt_path):
+        if not works_list or works_list[-1]['title'] != title:
+            works_list.append({'title': title, 'urls': []})
+        works_list[-1]['urls'].append(url)
+    return works_list
+
+
+class SeenUrlSet:
+    """紧凑的已见地址集合：只保存规范化地址（见canonical_url）的64位哈希，不保存地址字符串
+
+    几万条地址只占几MB内存；64位哈希在这个规模下发生碰撞的概率可以忽略。
+    """
+    def __init__(self):
+        self._digests = set()
+        self.duplicates = 0
+    
+    def add(self, url, scope=''):
+        """记录地址，同一scope（如作品名）中已经见过时返回False"""
+        key = f"{scope}\n{canonical_url(url)}"
+        digest = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+        if digest in self._digests:
+            self.duplicates += 1
+            return False
+        self._digests.add(digest)
+        return True
+
+
+def iter_jobs(sources, dedupe=True):
+    """流式读取一个或多个列表文件（'-'表示标准输入），边解析边产出 (作品名, 集数, m3u8地址)
+
+    每个作品的集数从1开始，同一作品出现在多个位置或多个文件中时继续编号；
+    dedupe为True时跳过同一作品中重复的地址（忽略签名类查询参数）。集数在去重之前编号，
+    跳过重复地址不会改变后续剧集的集数（以及文件名和断点续传的任务键）；
+    同一地址出现在不同作品下时各自处理，片段和转码结果通过去重存储、转码缓存复用。
+    """
+    seen = SeenUrlSet() if dedupe else None
+    episode_counts = {}
+    for source in sources:
+        for title, url in iter_m3u8_list(source):
+            episode_counts[title] = episode_counts.get(title, 0) + 1
+            if seen is not None and not seen.add(url, scope=title):
+                logging.info(f"跳过{title}中重复的m3u8地址（第{episode_counts[title]}集）: {url}")
+                continue
+            yield title, episode_counts[title], url
+    duplicates = seen.duplicates if seen is not None else 0
+    total = sum(episode_counts.values()) - duplicates
+    print(f"\n列表读取完成：{len(episode_counts)} 个视频作品，共 {total} 个m3u8地址"
+          + (f"，跳过重复地址 {duplicates} 个" if duplicates else ""))
+    logging.info(f"列表读取完成: 作品{len(episode_counts)}个, 地址{total}个, 重复{duplicates}个")
+
+
+def open_job_stream(sources, dedupe=True):
+    """检查列表文件并返回剧集的流式迭代器（见iter_jobs），文件不存在或没有有效地址时返回None
+
+    只读取到第一个有效地址为止，其余内容在处理过程中按需读取。
+    dedupe: 是否跳过同一作品中重复的地址
+    """
+    missing = [path for path in sources if path != '-' and not os.path.exists(path)]
+    for path in missing:
+        print(f"错误：文件 {path} 不存在")
+        logging.error(f"文件 {path} 不存在")
+    if missing:
+        return None
+    jobs = iter_jobs(sources, dedupe=dedupe)
+    first = next(jobs, None)
+    if first is None:
+        print("没有找到有效的m3u8地址")
+        logging.error("没有找到有效的m3u8地址")
+        return None
+    return itertools.chain([first], jobs)
+
+def show_task_summary():
+    """显示任务完成情况摘要，并返回成功和失败的任务数量"""
+    task_status = load_task_status()
+    if not task_status:
+        print("没有任务状态记录")
+        return 0, 0
+    
+    print("\n任务完成情况摘要:")
+    status_counts = {}
+    for episode_num, status_info in task_status.items():
+        status = status_info.get('status', 'unknown')
+        status_counts[status] = status_counts.get(status, 0) + 1
+    
+    for status, count in status_counts.items():
+        print(f"{TASK_STATUSES.get(status, status)}: {count}集")
+    
+    # 返回成功和失败的任务数量
+    success_count = status_counts.get('completed', 0)
+    failed_count = status_counts.get('failed', 0)
+    return success_count, failed_count
+
+def play_audio(success=True):
+    """播放任务完成或失败的音频"""
+    if success:
+        audio_file = "mission_complete.wav"
+    else:
+        audio_file = "mission_fail.wav"
+    
+    # 检查音频文件是否存在
+    if not os.path.exists(audio_file):
+        print(f"警告: 音频文件 {audio_file} 不存在，无法播放提示音")
+        return
+    
+    try:
+        system = platform.system()
+        if system == "Windows":
+            # 在Windows上使用PowerShell播放音频
+            subprocess.run(["powershell", "-c", f"(New-Object Media.SoundPlayer '{audio_file}').PlaySync()"], 
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        elif system == "Darwin":  # macOS
+            subprocess.run(["afplay", audio_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        elif system == "Linux":
+            # 在Linux上尝试使用aplay或mpg123
+            try:
+                subprocess.run(["aplay", audio_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except FileNotFoundError:
+                try:
+                    subprocess.run(["mpg123", audio_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                except FileNotFoundError:
+                    print("警告: 未找到合适的音频播放器，无法播放提示音")
+        else:
+            print(f"警告: 不支持的操作系统 {system}，无法播放提示音")
+    except Exception as e:
+        print(f"播放音频时出错: {e}")
+
+def load_works(txt_path):
+    """检查并读取m3u8地址列表文件，没有有效地址时返回None"""
+    # 检查文件是否存在
+    if not os.path.exists(txt_path):
+        print(f"错误：文件 {txt_path} 不存在")
+        logging.error(f"文件 {txt_path} 不存在")
+        return None
+    
+    # 读取m3u8地址列表，支持新的数据格式
+    works_list = read_m3u8_list(txt_path)
+    if not works_list:
+        print("没有找到有效的m3u8地址")
+        logging.error("没有找到有效的m3u8地址")
+        return None
+    
+    # 统计总URL数量
+    total_urls = sum(len(work['urls']) for work in works_list)
+    print(f"\n成功读取到 {len(works_list)} 个视频作品，共 {total_urls} 个有效的m3u8地址")
+    return works_list
+
+
+# 剧集调度相关常量
+SCHEDULE_POLICY = 'fifo'  # 剧集调度策略（见SCHEDULE_POLICIES），命令行--policy可以覆盖
+SCHEDULE_POLICIES = {
+    'fifo': '列表顺序',  # 严格按列表顺序，不考虑优先级和截止时间
+    'priority': '优先级',  # 截止时间临近的优先，其次优先级高的作品，同优先级按列表顺序
+    'round_robin': '作品轮流',  # 同上，同优先级的作品轮流处理（已处理集数最少的作品先）
+    'sjf': '短剧集优先',  # 同上，同优先级时播放列表总时长最短的剧集先处理
+}
+SCHEDULE_WINDOW = 200  # 非fifo策略下从列表中提前读入、参与排序的剧集数
+SJF_PROBE_LOOKAHEAD = 8  # sjf策略下后台解析播放列表以获取时长的排队剧集数（已记录时长的剧集不再解析）
+WORK_PRIORITIES = {}  # 作品优先级，如 {"作品名": 10}，数值越大越先处理（默认0）；也可以写在标题行中
+WORK_DEADLINES = {}  # 作品截止时间，如 {"作品名": "2026-10-20T18:00"}；也可以写在标题行中
+DEADLINE_URGENT_WINDOW = 3600  # 距离截止时间不足该秒数（或已超时）的剧集最先处理，按截止时间先后
+
+_work_options = {}  # 列表文件标题行中的调度选项：作品名 -> {"priority", "deadline"}
+
+
+def parse_title_line(line):
+    """解析标题行，返回 (作品名, 调度选项)
+
+    标题行格式为"[作品名]"，后面可以跟空格分隔的选项：priority=整数、deadline=ISO时间（如2026-10-20T18:00），
+    例如"[紧急更新] priority=10 deadline=2026-10-20T18:00"。无法识别的选项被忽略并给出警告。
+    """
+    end = line.rindex(']')
+    title = line[1:end]
+    options = {}
+    for item in line[end + 1:].split():
+        name, _, value = item.partition('=')
+        try:
+            if name == 'priority':
+                options['priority'] = int(value)
+            elif name == 'deadline':
+                options['deadline'] = parse_deadline(value)
+            else:
+                raise ValueError("未知的选项")
+        except ValueError as e:
+            print(f"警告：{title}的调度选项无效 {item}: {e}")
+            logging.warning(f"{title}的调度选项无效 {item}: {e}")
+    return title, options
+
+
+def parse_deadline(value):
+    """把ISO格式的时间（如2026-10-20T18:00，不带时区时按本地时间）转换为时间戳"""
+    import datetime
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def set_work_options(title, options):
+    """记录列表文件中作品的调度选项（同一作品出现多次时后面的覆盖前面的）"""
+    _work_options.setdefault(title, {}).update(options)
+
+
+def work_priority(title):
+    """作品优先级：标题行选项优先，其次WORK_PRIORITIES，默认0"""
+    options = _work_options.get(title, {})
+    return options['priority'] if 'priority' in options else WORK_PRIORITIES.get(title, 0)
+
+
+def work_deadline(title):
+    """作品截止时间（时间戳），没有时返回None"""
+    options = _work_options.get(title, {})
+    if 'deadline' in options:
+        return options['deadline']
+    value = WORK_DEADLINES.get(title)
+    return parse_deadline(value) if isinstance(value, str) else value
+
+
+class EpisodeScheduler:
+    """剧集调度器：在已读入的剧集中决定下一集处理哪一集
+
+    依次比较：
+    1. 距离截止时间不足DEADLINE_URGENT_WINDOW秒（或已超时）的剧集最先，按截止时间先后
+    2. 作品优先级高的先
+    3. 调度策略：round_robin让本批次已处理集数最少的作品先，sjf让播放列表总时长短的先（时长未知的排在后面）
+    4. 列表顺序（同一作品内即集数顺序）
+    fifo策略只按列表顺序。duration_of(job)返回剧集时长（秒），未知时返回None，只有sjf使用。
+    """
+    def __init__(self, policy=SCHEDULE_POLICY, duration_of=None):
+        if policy not in SCHEDULE_POLICIES:
+            raise ValueError(f"未知的调度策略: {policy}")
+        self.policy = policy
+        self.duration_of = duration_of or (lambda job: None)
+        self._items = []  # [(读入顺序, 剧集)]
+        self._served = collections.Counter()  # 作品 -> 本批次已开始处理的集数
+        self._seq = itertools.count()
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def push(self, job):
+        """加入一集 (作品名, 集数, m3u8地址)"""
+        self._items.append((next(self._seq), job))
+    
+    def _key(self, item, now):
+        seq, job = item
+        if self.policy == 'fifo':
+            return (seq,)
+        work_title = job[0]
+        deadline = work_deadline(work_title)
+        urgent = deadline is not None and deadline - now < DEADLINE_URGENT_WINDOW
+        key = (not urgent, deadline if urgent else 0, -work_priority(work_title))
+        if self.policy == 'round_robin':
+            key += (self._served[work_title],)
+        elif self.policy == 'sjf':
+            duration = self.duration_of(job)
+            key += (duration is None, duration or 0)
+        return key + (seq,)
+    
+    def ordered(self):
+        """按当前的调度顺序返回所有排队中的剧集"""
+        now = time.time()
+        return [job for _, job in sorted(self._items, key=lambda item: self._key(item, now))]
+    
+    def pop(self):
+        """取出下一集"""
+        now = time.time()
+        index = min(range(len(self._items)), key=lambda i: self._key(self._items[i], now))
+        _, job = self._items.pop(index)
+        self._served[job[0]] += 1
+        return job
+    
+    def drain(self):
+        """取出所有排队中的剧集（按读入顺序）"""
+        jobs = [job for _, job in self._items]
+        self._items = []
+        return jobs
+
+
+def record_schedule(policy, ordered):
+    """把排队中剧集的调度信息（策略、队列位置、优先级、截止时间）写入任务状态，供status子命令显示
+
+    ordered: 按调度顺序排列的剧集（EpisodeScheduler.ordered的返回值）
+    还没有状态记录的剧集记为"待处理"，已有记录的剧集只更新调度信息，不改变状态。
+    """
+    task_status = load_task_status()
+    for position, (work_title, episode_num, url) in enumerate(ordered, 1):
+        entry = task_status.setdefault(task_key(work_title, episode_num, url), {
+            'status': 'pending', 'work': work_title, 'episode': int(episode_num), 'info': {'url': url}})
+        deadline = work_deadline(work_title)
+        entry['schedule'] = {
+            'policy': policy,
+            'position': position,
+            'priority': work_priority(work_title),
+            'deadline': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deadline)) if deadline else None,
+        }
+    save_task_status(task_status)
+
+
+def run_batch(jobs, resume=False, max_workers=8, lookahead=PREFETCH_LOOKAHEAD, play_sound=True,
+              disk_budget=DISK_BUDGET, cancel=None, policy=SCHEDULE_POLICY, gap_tolerance=GAP_TOLERANCE):
+    """依次处理剧集列表（expand_jobs的返回值）或剧集迭代器（iter_jobs的返回值）
+
+    jobs为迭代器时边读边处理：只提前读取lookahead集用于预取，不需要先读完整个列表。
+    resume: 先用plan_resume计算剩余工作，只处理未完成的剧集，已完成的不再逐个访问
+        （jobs为迭代器时用iter_remaining_jobs边读边做同样的规划，跳过已完成的剧集，列表读完时显示汇总）
+    max_workers: 每集的下载线程数
+    lookahead: 后台预取后续几集的播放列表
+    disk_budget: 本批次最多新占用的磁盘空间（字节），None表示只受剩余空间限制
+    policy: 剧集调度策略（见SCHEDULE_POLICIES）；fifo按列表顺序，其他策略提前读入SCHEDULE_WINDOW集，
+        按截止时间、作品优先级和策略排序后处理（见EpisodeScheduler）
+    gap_tolerance: 每集修复后仍允许缺失的视频/音频片段数
+    
+    每集开始前估算所需磁盘空间，空间不足的剧集推迟到队列末尾，等其他剧集完成后再尝试；
+    没有任何剧集能够开始时，剩余剧集标记为失败并结束，不会在写到一半时耗尽磁盘。
+    
+    cancel: 可选的CancelToken；未提供时创建一个，并在处理期间把SIGINT/SIGTERM转换为取消请求。
+    取消后不再开始新的剧集，当前剧集保存进度后结束，返回False。
+    """
+    streaming = not isinstance(jobs, list)
+    if resume and streaming:
+        jobs = iter_remaining_jobs(jobs)
+    elif resume:
+        plan = plan_resume(jobs)
+        print_resume_plan(plan)
+        task_status = load_task_status()
+        for item in plan:
+            if item['stage'] == 'done':
+                mark_planned_done(item, task_status)
+        jobs = [(item['work'], item['episode'], item['url']) for item in plan if item['stage'] != 'done']
+        if not jobs:
+            print("所有剧集均已完成，无需继续")
+            return True
+    
+    episodes_per_work = {}
+    if not streaming:
+        for work_title, _, _ in jobs:
+            episodes_per_work[work_title] = episodes_per_work.get(work_title, 0) + 1
+    
+    start_total_time = time.time()
+    batch_progress = BatchProgress(0 if streaming else len(jobs), total_known=not streaming)
+    
+    # 跨剧集、跨作品共享的片段去重存储
+    temp_dir, video_dir = ensure_directories()
+    segment_store = SegmentStore(os.path.join(temp_dir, SEGMENT_STORE_DIRNAME))
+    segment_store.prune()
+    # 转码结果缓存放在data目录下，不混入交付的video目录；只在data和video目录位于同一文件系统时启用，
+    # 缓存与最终文件互为硬链接，不会把每个完整视频复制到临时目录（例如tmpfs）中
+    transcode_cache = None
+    if TRANSCODE_CACHE_BUDGET:
+        if os.stat(temp_dir).st_dev == os.stat(video_dir).st_dev:
+            transcode_cache = TranscodeCache(os.path.join(temp_dir, TRANSCODE_CACHE_DIRNAME))
+        else:
+            print("临时目录与输出目录不在同一文件系统，不使用转码缓存")
+            logging.info(f"转码缓存已停用: {temp_dir} 与 {video_dir} 不在同一文件系统")
+    disk = DiskBudget(temp_dir, video_dir, budget=disk_budget, caches=(segment_store, transcode_cache))
+    
+    # 当前集下载期间在后台预取后续剧集的播放列表
+    prefetcher = PlaylistPrefetcher(lookahead)
+    if cancel is None:
+        cancel = CancelToken()
+        signals = handle_shutdown_signals(cancel)
+    else:
+        signals = contextlib.nullcontext(cancel)
+    current_work = None
+    source = iter(jobs)
+    # 已读取、等待处理的剧集：fifo只读入预取范围内的几集，其他策略读入SCHEDULE_WINDOW集参与排序
+    known_durations = {}
+    if policy == 'sjf':
+        for status_info in load_task_status().values():
+            if status_info.get('duration') and status_info.get('info', {}).get('url'):
+                known_durations[status_info['info']['url']] = status_info['duration']
+    
+    def duration_of(job):
+        """sjf使用的剧集时长：已预取的播放列表，其次上次运行记录的时长"""
+        playlist = prefetcher.peek(job[2])
+        if playlist:
+            return sum(segment['duration'] for segment in playlist['segments'])
+        return known_durations.get(job[2])
+    
+    queue = EpisodeScheduler(policy, duration_of)
+    window = prefetcher.lookahead + 1 if policy == 'fifo' else max(SCHEDULE_WINDOW, prefetcher.lookahead + 1)
+    if policy != 'fifo':
+        print(f"剧集调度策略: {SCHEDULE_POLICIES[policy]}（提前读入最多{window}集参与排序）")
+    deferred = []  # 因磁盘空间不足推迟的剧集
+    progressed = False  # 上次推迟之后是否有剧集完成（完成后才可能腾出空间）
+    recorded = None  # 上次写入任务状态的排队顺序（去掉之后取出的剧集），顺序不变时不再重写状态文件
+    
+    try:
+        with signals:
+            while True:
+                if cancel.cancelled:
+                    break
+                # 按需从列表中读取剧集，保证调度窗口内的剧集已经读入
+                while source is not None and len(queue) < window:
+                    job = next(source, None)
+                    if job is None:
+                        source = None
+                        batch_progress.total_known = True
+                        break
+                    queue.push(job)
+                    if streaming:
+                        batch_progress.total_episodes += 1
+                if not len(queue):
+                    if not deferred or not progressed:
+                        break
+                    for job in deferred:
+                        queue.push(job)
+                    deferred, progressed = [], False
+                if policy == 'sjf':
+                    # 后台解析排在最前、时长还未知的几集，得到时长后参与排序
+                    unknown = [job[2] for job in queue.ordered() if duration_of(job) is None]
+                    prefetcher.schedule(unknown[:SJF_PROBE_LOOKAHEAD])
+                if policy != 'fifo':
+                    ordered = queue.ordered()
+                    if ordered != recorded:
+                        record_schedule(policy, ordered)
+                work_title, episode_num, m3u8_url = queue.pop()
+                if policy != 'fifo':
+                    recorded = [job for job in ordered if job != (work_title, episode_num, m3u8_url)]
+                prefetcher.schedule(url for _, _, url in queue.ordered()[:prefetcher.lookahead])
+                
+                playlist = prefetcher.get(m3u8_url)
+                if playlist is None:
+                    playlist = resolve_playlist(m3u8_url, verbose=False)
+                estimate = estimate_episode_size(playlist) if playlist else None
+                admitted, reason = disk.admit(estimate)
+                if not admitted:
+                    print(f"\n{work_title} 第{episode_num}集暂缓处理：磁盘空间不足，{reason}")
+                    logging.warning(f"{work_title} 第{episode_num}集暂缓处理: {reason}")
+                    deferred.append((work_title, episode_num, m3u8_url))
+                    continue
+                
+                if work_title != current_work:
+                    current_work = work_title
+                    print(f"\n{'='*80}")
+                    print(f"开始处理视频作品：{work_title}")
+                    if work_title in episodes_per_work:
+                        print(f"包含集数：{episodes_per_work[work_title]}")
+                    print(f"{'='*80}")
+                
+                # 处理当前集数
+                print(f"\n--- 开始处理 {work_title} 第{episode_num}集 ---")
+                if estimate:
+                    print(f"预计视频大小: {format_size(estimate)}")
+                success = False
+                try:
+                    with log_context(work=work_title, episode=episode_num):
+                        success = process_single_episode(episode_num, m3u8_url, output_format="mp4",
+                                                         max_workers=max_workers, work_title=work_title,
+                                                         batch_progress=batch_progress, playlist=playlist,
+                                                         segment_store=segment_store, cancel=cancel,
+                                                         transcode_cache=transcode_cache,
+                                                         gap_tolerance=gap_tolerance)
+                    if success:
+                        print(f"\n{work_title} 第{episode_num}集处理完成！")
+                    elif cancel.cancelled:
+                        print(f"\n{work_title} 第{episode_num}集已中断")
+                    else:
+                        print(f"\n{work_title} 第{episode_num}集处理失败！")
+                except Exception as e:
+                    print(f"\n处理 {work_title} 第{episode_num}集时发生错误: {e}")
+                    logging.error(f"处理 {work_title} 第{episode_num}集时发生错误: {e}")
+                batch_progress.episode_done(success)
+                progressed = True
+                # 该集的临时目录已清理，超出预算的片段现在可以淘汰
+                segment_store.prune()
+                deadline = work_deadline(work_title)
+                if deadline is not None and time.time() > deadline:
+                    late = format_duration(time.time() - deadline)
+                    print(f"{work_title} 第{episode_num}集超过截止时间 {late}")
+                    logging.warning(f"{work_title} 第{episode_num}集超过截止时间 {late}")
+                
+                # 每集之间休息1-2秒，避免请求过于频繁（收到取消请求时立即结束等待）
+                cancel.wait(1 + time.time() % 1)
+    finally:
+        prefetcher.shutdown()
+        segment_store.save()
+    
+    if cancel.cancelled:
+        print(f"\n处理已中断（{cancel.reason}），进度已保存，使用 resume 子命令继续")
+        logging.warning(f"批处理已中断: {cancel.reason}")
+        show_task_summary()
+        return False
+    
+    for work_title, episode_num, m3u8_url in deferred:
+        error = "磁盘空间不足，未能开始"
+        print(f"{work_title} 第{episode_num}集{error}")
+        update_task_status(task_key(work_title, episode_num, m3u8_url), 'failed', {'error': error, 'url': m3u8_url},
+                           work=work_title, episode=int(episode_num))
+        batch_progress.episode_done(False)
+    
+    end_total_time = time.time()
+    print(f"\n{'='*60}")
+    print(f"所有指定集数处理完成！总耗时: {end_total_time - start_total_time:.2f}秒")
+    print(f"片段去重: {segment_store.summary()}")
+    logging.info(f"片段去重统计: {segment_store.stats}")
+    if transcode_cache is not None:
+        print(f"转码缓存: {transcode_cache.summary()}")
+        logging.info(f"转码缓存统计: {transcode_cache.stats}")
+    connection_lines = CONNECTION_STATS.summary_lines()
+    if connection_lines:
+        print("连接统计:")
+        for line in connection_lines:
+            print(f"  {line}")
+            logging.info(f"连接统计: {line}")
+    if PROXY_POOL:
+        print("代理统计:")
+        for line in PROXY_POOL.summary_lines():
+            print(f"  {line}")
+            logging.info(f"代理统计: {line}")
+    
+    # 显示任务完成情况
+    success_count, failed_count = show_task_summary()
+    
+    # 播放完成音频
+    if play_sound:
+        play_audio(success_count > 0 and failed_count == 0)
+    return batch_progress.failed_episodes == 0
+
+
+def main():
+    """主程序入口（交互模式）"""
+    # 询问用户txt文件路径
+    txt_path = input("请输入存储m3u8地址的txt文件路径（默认text.txt）: ").strip()
+    if not txt_path:
+        txt_path = "text.txt"
+    
+    # 边读边处理，大列表不需要等待整个文件解析完成
+    jobs = open_job_stream([txt_path])
+    if jobs is None:
+        return
+    
+    # 任务状态按 作品/集数/地址 区分，不同作品的集数不会冲突，
+    # 未完成的任务由断点续传自动继续，无需再询问
+    run_batch(jobs, resume=True)
+
+
+def cmd_status(args):
+    """status子命令：查询任务状态（不导入网络模块、不写日志，启动开销很小）"""
+    task_status = load_task_status()
+    if args.json:
+        print(json.dumps(task_status, ensure_ascii=False, indent=2))
+        return 0
+    success_count, failed_count = show_task_summary()
+    gapped = [(task_id, info) for task_id, info in task_status.items()
+              if info.get('status') == 'completed' and (info.get('gaps') or {}).get('missing')]
+    if gapped:
+        print("\n带有缺失片段完成的任务（在--gap-tolerance允许范围内）:")
+        for task_id, info in gapped:
+            gaps = info['gaps']
+            sequences = ', '.join(str(sequence) for sequence in gaps.get('sequences', []))
+            print(f"  {describe_task(task_id, info)}: 缺失{gaps['missing']}个片段" + (f"（序号 {sequences}）" if sequences else ""))
+    unfinished = get_pending_tasks()
+    if unfinished:
+        print("\n未完成的任务:")
+        for task_id, info in unfinished:
+            status = info.get('status', 'unknown')
+            error = info.get('info', {}).get('error')
+            line = f"{describe_task(task_id, info)}: {TASK_STATUSES.get(status, status)} ({info.get('last_updated', '-')})"
+            print(f"{line} - {error}" if error else line)
+        queued = sorted((info for _, info in unfinished if info.get('schedule')),
+                        key=lambda info: info['schedule']['position'])
+        if queued:
+            policy = queued[0]['schedule']['policy']
+            print(f"\n排队顺序（调度策略: {SCHEDULE_POLICIES.get(policy, policy)}，最近一次运行时记录）:")
+            for position, info in enumerate(queued, 1):
+                schedule = info['schedule']
+                line = f"  {position:>3}. {describe_task(None, info)} 优先级 {schedule['priority']}"
+                if schedule.get('deadline'):
+                    overdue = time.time() > parse_deadline(schedule['deadline'].replace(' ', 'T'))
+                    line += f", 截止 {schedule['deadline']}" + ("（已超时）" if overdue else "")
+                print(line)
+    return 0 if failed_count == 0 else 1
+
+
+def apply_directory_options(args):
+    """把命令行指定的临时目录和输出目录应用到全局配置"""
+    global SCRATCH_DIR, OUTPUT_DIR
+    SCRATCH_DIR = args.scratch_dir
+    OUTPUT_DIR = args.output_dir
+
+
+def apply_network_options(args):
+    """把命令行的网络选项应用到全局配置：接收缓冲区大小、预热连接数、代理池
+
+    代理（--proxy、--proxy-file）都未指定时保留PROXY_LIST。
+    """
+    global PREWARM_CONNECTIONS
+    set_receive_buffer_size(args.buffer_size)
+    PREWARM_CONNECTIONS = args.prewarm
+    specs = list(args.proxy or [])
+    if args.proxy_file:
+        with open(args.proxy_file, 'r', encoding='utf-8') as f:
+            specs += [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    if specs:
+        PROXY_POOL.configure(specs)
+    if PROXY_POOL:
+        print(f"使用代理池: {len(PROXY_POOL)}个代理")
+
+
+def run_batch_command(jobs, args, resume=False):
+    """run/resume子命令共用：处理剧集并返回退出码，被SIGINT/SIGTERM中断时返回130
+
+    指定--profile时在整个批次期间运行采样分析器，结束（包括被中断）时输出分析结果。
+    """
+    cancel = CancelToken()
+    apply_network_options(args)
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler()
+        profiler.start()
+    with handle_shutdown_signals(cancel):
+        try:
+            ok = run_batch(jobs, resume=resume, max_workers=args.workers, lookahead=args.lookahead,
+                           play_sound=not args.no_sound, disk_budget=args.disk_budget, cancel=cancel,
+                           policy=args.policy, gap_tolerance=args.gap_tolerance)
+        except KeyboardInterrupt:
+            print("\n已强制退出，部分进行中的片段需要重新下载")
+            logging.warning("收到多次中断信号，强制退出")
+            return 130
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                lines = profiler.write_report(args.profile)
+                print('\n' + '\n'.join(lines))
+                print(f"折叠调用栈已保存到 {args.profile}.collapsed（可用flamegraph.pl或speedscope生成火焰图）")
+                logging.info("采样分析结果:\n" + '\n'.join(lines))
+    if cancel.cancelled:
+        return 130
+    return 0 if ok else 1
+
+
+def cmd_run(args):
+    """run子命令：从头处理列表文件中的所有剧集（可以指定多个文件，'-'表示标准输入，边读边处理）"""
+    setup_logging()
+    apply_directory_options(args)
+    jobs = open_job_stream(args.file, dedupe=not args.no_dedupe)
+    if jobs is None:
+        return 1
+    return run_batch_command(jobs, args)
+
+
+def cmd_resume(args):
+    """resume子命令：不经询问，按断点续传规划只处理剩余的工作
+
+    未指定列表文件时，从任务状态中恢复所有作品的未完成剧集。
+    """
+    setup_logging()
+    apply_directory_options(args)
+    if args.file:
+        jobs = open_job_stream(args.file, dedupe=not args.no_dedupe)
+        if jobs is None:
+            return 1
+    else:
+        jobs = jobs_from_status()
+        print(f"从任务状态中恢复 {len(jobs)} 个未完成的剧集")
+    return run_batch_command(jobs, args, resume=True)
+
+
+def cmd_discover(args):
+    """discover子命令：只解析播放列表，列出每集的片段数、时长和加密情况，不下载"""
+    setup_logging()
+    works_list = load_works(args.file)
+    if not works_list:
+        return 1
+    urls = [url for work in works_list for url in work['urls']]
+    with futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        playlists = dict(zip(urls, executor.map(lambda u: resolve_playlist(u, verbose=False), urls)))
+    
+    failed = 0
+    for work in works_list:
+        print(f"\n[{work['title']}]")
+        for episode_num, url in enumerate(work['urls'], 1):
+            playlist = playlists[url]
+            if not playlist:
+                failed += 1
+                print(f"  第{episode_num:02d}集: 解析失败 {url}")
+                continue
+            segments = playlist['segments']
+            duration = sum(segment['duration'] for segment in segments)
+            encrypted = '加密' if any(segment['key'] for segment in segments) else '未加密'
+            variant = ' (多码率变体)' if playlist['media_url'] != url else ''
+            print(f"  第{episode_num:02d}集: {len(segments)}个片段, 时长 {format_duration(duration)}, "
+                  f"{encrypted}{variant}")
+    print(f"\n共 {len(urls)} 集，解析失败 {failed} 集")
+    return 0 if failed == 0 else 1
+
+
+def build_arg_parser():
+    """构建命令行参数解析器"""
+    import argparse
+    parser = argparse.ArgumentParser(description="m3u8视频批量下载工具（不带参数运行时进入交互模式）")
+    subparsers = parser.add_subparsers(dest='command')
+    
+    def add_batch_arguments(sub, default_file='text.txt'):
+        if default_file:
+            file_help = "存储m3u8地址的txt文件，可以指定多个，'-'表示标准输入（默认text.txt）"
+        else:
+            file_help = "存储m3u8地址的txt文件，可以指定多个，'-'表示标准输入（省略时从任务状态中恢复）"
+        sub.add_argument('file', nargs='*', default=[default_file] if default_file else [], help=file_help)
+        sub.add_argument('--workers', type=int, default=8, help="每集的下载线程数（默认8）")
+        sub.add_argument('--lookahead', type=int, default=PREFETCH_LOOKAHEAD,
+                         help=f"后台预取后续几集的播放列表（默认{PREFETCH_LOOKAHEAD}）")
+        sub.add_argument('--no-sound', action='store_true', help="结束时不播放提示音")
+        sub.add_argument('--no-dedupe', action='store_true',
+                         help="不跳过同一作品中重复的m3u8地址（默认跳过，跳过的地址仍占用集数）")
+        sub.add_argument('--scratch-dir', default=SCRATCH_DIR,
+                         help=f"片段临时目录（默认{SCRATCH_DIR}，可指向tmpfs等单独的磁盘）")
+        sub.add_argument('--output-dir', default=OUTPUT_DIR, help=f"最终视频目录（默认{OUTPUT_DIR}）")
+        sub.add_argument('--disk-budget', type=parse_size, default=DISK_BUDGET,
+                         help="本批次最多新占用的磁盘空间，如 50G（默认只受剩余空间限制）")
+        sub.add_argument('--buffer-size', type=parse_size, default=RECEIVE_BUFFER_SIZE,
+                         help=f"片段接收缓冲区大小，攒满后一次写入磁盘，如 4M（默认{format_size(RECEIVE_BUFFER_SIZE)}）")
+        sub.add_argument('--prewarm', type=int, default=PREWARM_CONNECTIONS, metavar='N',
+                         help=f"解析播放列表后立即与片段主机建立N个连接（默认{PREWARM_CONNECTIONS}，0表示不预热）")
+        sub.add_argument('--proxy', action='append', default=None, metavar='URL',
+                         help="下载片段使用的HTTP/SOCKS代理，可以指定多次组成代理池，如 http://10.0.0.2:3128、"
+                              "'socks5h://10.0.0.3:1080 2'（空格后为权重），默认使用PROXY_LIST")
+        sub.add_argument('--proxy-file', default=None,
+                         help="代理列表文件，每行一个代理（格式同--proxy），#开头为注释")
+        sub.add_argument('--gap-tolerance', type=int, default=GAP_TOLERANCE, metavar='N',
+                         help=f"修复后每集仍允许缺失的视频/音频片段数，超过时不合并、标记为失败（默认{GAP_TOLERANCE}）")
+        sub.add_argument('--policy', choices=list(SCHEDULE_POLICIES), default=SCHEDULE_POLICY,
+                         help=f"剧集调度策略：fifo列表顺序，priority按优先级和截止时间，round_robin各作品轮流，"
+                              f"sjf短剧集优先（默认{SCHEDULE_POLICY}）")
+        sub.add_argument('--profile', nargs='?', const='demo2_profile', default=None, metavar='PREFIX',
+                         help="运行采样分析器，结束时输出 PREFIX.collapsed（折叠调用栈）和 PREFIX.txt"
+                              "（各阶段耗时汇总），默认PREFIX为demo2_profile")
+    
+    sub = subparsers.add_parser('run', help="处理列表文件中的所有剧集")
+    add_batch_arguments(sub)
+    sub.set_defaults(func=cmd_run)
+    
+    sub = subparsers.add_parser('resume', help="按断点续传规划，只处理剩余的片段、合并和转码")
+    add_batch_arguments(sub, default_file=None)
+    sub.set_defaults(func=cmd_resume)
+    
+    sub = subparsers.add_parser('status', help="查询任务状态")
+    sub.add_argument('--json', action='store_true', help="以JSON格式输出完整状态")
+    sub.set_defaults(func=cmd_status)
+    
+    sub = subparsers.add_parser('discover', help="只解析播放列表，列出每集的片段信息")
+    sub.add_argument('file', nargs='?', default='text.txt', help="存储m3u8地址的txt文件（默认text.txt）")
+    sub.add_argument('--workers', type=int, default=8, help="并发解析的线程数（默认8）")
+    sub.set_defaults(func=cmd_discover)
+    return parser
+
+
+def cli(argv=None):
+    """命令行入口：没有子命令时进入原来的交互模式"""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        setup_logging()
+        main()
+        return 0
+    args = build_arg_parser().parse_args(argv)
+    if args.command is None:
+        setup_logging()
+        main()
+        return 0
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(cli())